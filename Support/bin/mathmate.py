@@ -2,56 +2,296 @@
 import os
 import sys
 import time
+
+# Taken before the rest of the imports, for MATHMATE_TRACE
+IMPORT_START = time.time()
+
+# With MATHMATE_PROFILE the whole command runs under the profiler
+from mathmate_profile import start_profiling
+start_profiling()
+
 import string
 import socket
+import select
 import shutil
 import subprocess
 import traceback
 import plistlib
+import json
+import bisect
+import hashlib
+import cPickle
+import re
+import array
+
+from mathmate_env import TMJLINK_CACHE_FOLDER, MATHMATE_CACHE_FOLDER, write_cache_file, get_sessid, find_line_starts, find_pos, find_symbol_at
+# The commands take these from mathmate with import *
+from mathmate_env import is_valid_mathematica_symbol, exit_discard, exit_replace_text, exit_replace_document, exit_insert_text
+from mathmate_env import exit_insert_snippet, exit_show_html, exit_show_tool_tip, exit_create_new_document
+from mathmate_client import BufferedSocket, Session, ServerException, run_command
+from mathmate_shim import get_completion_prefix, show_suggestions, parse_suggestions, load_completion_index, save_completion_index
+from mathmate_defaults import read_preferences, read_preference
+from mathmate_results import get_statement_keys, RecordingOutput, ResultsCache
+from mathmate_parallel import ParallelRun
+from mathmate_graph import DependencyGraph, extract_symbols
+from mathmate_trace import trace_command, trace_phase, trace_since
+
+MATHEMATICA_PATH = os.environ.get('MATHMATE_MATHEMATICA_PATH', '/Applications/Mathematica.app')
+
+# Bytes read at a time when reformatting a stream
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Statements either side of the current one that Show Statement looks through
+# for the statements it needs and affects
+SHOW_STATEMENT_RANGE = 200
+
+# Seconds to wait for a newly launched TextMateJLink server to start listening
+TMJLINK_STARTUP_TIMEOUT = float(os.environ.get('MATHMATE_STARTUP_TIMEOUT', '60'))
+
+class Statement(object):
+    # A statement of a parsed block, kept as offsets. Its text is sliced from
+    # the block and its reformatted text produced when first asked for, by
+    # parsing it again from the state it starts in.
+    __slots__ = ("parser", "block", "start", "end", "indent_level", "do_indent", "formatted")
+    
+    def __init__(self, parser, block, start, end, indent_level, do_indent, formatted = None):
+        self.parser = parser
+        self.block = block
+        self.start = start
+        self.end = end
+        self.indent_level = indent_level
+        self.do_indent = do_indent
+        self.formatted = formatted
+    
+    @property
+    def text(self):
+        return self.block[self.start:self.end]
+    
+    @property
+    def reformatted(self):
+        if self.formatted is None:
+            self.parser.format_statements([self])
+        return self.formatted
+
+def get_common_prefix_length(a, b, chunk_size = 65536):
+    # Compare a chunk at a time, then narrow down within the first one that differs
+    size = min(len(a), len(b))
+    pos = 0
+    while pos < size and a[pos:pos+chunk_size] == b[pos:pos+chunk_size]:
+        pos += chunk_size
+    end = min(pos + chunk_size, size)
+    while pos < end and a[pos] == b[pos]:
+        pos += 1
+    return min(pos, size)
+
+class NonSpaceIndex(object):
+    # Next/previous non-space (not " " or "\t") character lookups. Lookups never
+    # cross a new line, so the tables are built a line at a time, in one pass
+    # over the line's white space runs, as the parser advances.
+    SPACE_RUN = re.compile(r"[ \t]+")
+    
+    def __init__(self, block):
+        self.block = block
+        self.size = len(block)
+        self.start = -1
+        self.end = -1
+    
+    def index_line(self, pos):
+        start = self.block.rfind("\n", 0, pos) + 1
+        end = self.block.find("\n", pos)
+        if end == -1:
+            end = self.size
+        
+        # Tables cover [start, end], where end is the new line (or end of block)
+        self.next_ns = array.array('i', xrange(start, end + 1))
+        self.prev_ns = array.array('i', xrange(start, end + 1))
+        for match in self.SPACE_RUN.finditer(self.block, start, end):
+            run_start, run_end = match.span()
+            self.next_ns[run_start - start:run_end - start] = array.array('i', [run_end]) * (run_end - run_start)
+            self.prev_ns[run_start - start:run_end - start] = array.array('i', [run_start - 1]) * (run_end - run_start)
+        
+        self.start = start
+        self.end = end
+    
+    def next_char(self, pos):
+        # First non-space character at or after pos on the same line
+        if pos >= self.size or self.block[pos] == "\n":
+            return None
+        if pos < self.start or pos > self.end:
+            self.index_line(pos)
+        i = self.next_ns[pos - self.start]
+        if i == self.end:
+            return None
+        return self.block[i]
+    
+    def prev_char(self, pos):
+        # Last non-space character at or before pos on the same line
+        if pos < 0 or self.block[pos] == "\n":
+            return None
+        if pos < self.start or pos > self.end:
+            self.index_line(pos)
+        i = self.prev_ns[pos - self.start]
+        if i < self.start:
+            return None
+        return self.block[i]
+    
+    def is_end_of_line(self, pos):
+        return self.next_char(pos) is None
+
+def read_tmjlink_port(cache_folder):
+    try:
+        portfp = open(os.path.join(cache_folder, "tmjlink.port"), 'r')
+    except IOError:
+        # Servers built before the port file only announce it in their log
+        return read_logged_tmjlink_port(cache_folder)
+    try:
+        return int(portfp.read())
+    finally:
+        portfp.close()
+
+def read_logged_tmjlink_port(cache_folder):
+    try:
+        logfp = open(os.path.join(cache_folder, "tmjlink.log"), 'r')
+    except IOError:
+        return None
+    try:
+        for line in logfp:
+            # A line still being written may hold part of the port
+            if line.startswith("Server started on port: ") and line.endswith("\n"):
+                return int(line.strip()[24:])
+    finally:
+        logfp.close()
+    return None
+
+def get_tmjlink_port(cache_folder, timeout = TMJLINK_STARTUP_TIMEOUT):
+    # The server writes its port file (or, built before that, logs its port)
+    # as soon as it is listening, and the command that launched it has
+    # already waited for that. Only a command
+    # racing a launch from another process can get here before the file
+    # exists, so it just checks again until the deadline.
+    deadline = time.time() + timeout
+    while True:
+        port = read_tmjlink_port(cache_folder)
+        if port is not None:
+            return port
+        if time.time() > deadline:
+            raise Exception("Timed out waiting for the TextMateJLink server to start.")
+        time.sleep(0.01)
+
+def wait_for_tmjlink(proc, ready, cache_folder, timeout = TMJLINK_STARTUP_TIMEOUT):
+    # Block until the server connects back to the ready socket, waking up
+    # now and then to notice if it died during startup. Servers built before
+    # the ready socket never connect; they only log their port.
+    deadline = time.time() + timeout
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Exception("Timed out waiting for the TextMateJLink server to start.")
+
+            readable, writable, errors = select.select([ready], [], [], min(remaining, 0.25))
+            if len(readable) > 0:
+                conn, address = ready.accept()
+                conn.settimeout(remaining)
+                line = BufferedSocket(conn).readline()
+                conn.close()
+                if line is None:
+                    raise Exception("The TextMateJLink server did not report its port.")
+                return int(line)
+
+            port = read_logged_tmjlink_port(cache_folder)
+            if port is not None:
+                return port
+
+            if proc.poll() is not None:
+                raise Exception("The TextMateJLink server exited during startup (status %d), see tmjlink.log." % proc.returncode)
+    finally:
+        ready.close()
+
+def read_process_table():
+    # pid -> (parent pid, command) for every process, from a single ps
+    proc = subprocess.Popen(["ps", "-A", "-o", "pid=,ppid=,command="], stdout=subprocess.PIPE)
+    table = {}
+    for line in proc.communicate()[0].splitlines():
+        fields = line.split(None, 2)
+        if len(fields) == 3:
+            table[int(fields[0])] = (int(fields[1]), fields[2])
+    return table
+
+def read_proc_entry(pid):
+    # (parent pid, command) for one process from /proc, without forking
+    fp = open("/proc/%d/stat" % pid, 'r')
+    stat = fp.read()
+    fp.close()
+    fp = open("/proc/%d/cmdline" % pid, 'r')
+    command = fp.read().replace("\0", " ")
+    fp.close()
+    return int(stat[stat.rindex(")") + 2:].split()[1]), command
+
+def find_ancestor_pid(command):
+    # Nearest ancestor of this process whose command line contains command
+    if os.path.exists("/proc/self/stat"):
+        get_process = read_proc_entry
+    else:
+        table = read_process_table()
+        get_process = lambda pid: table[pid]
+
+    current_pid = os.getpid()
+    while current_pid > 1:
+        try:
+            parent_pid, current_command = get_process(current_pid)
+        except (KeyError, IOError):
+            return None
+        if command in current_command:
+            return current_pid
+        current_pid = parent_pid
+    return None
+
+def get_mathematica_version():
+    try:
+        info = plistlib.readPlist(os.path.join(MATHEMATICA_PATH, "Contents", "Info.plist"))
+        return info.get('CFBundleVersion')
+    except Exception:
+        return None
 
-MATHEMATICA_PATH = '/Applications/Mathematica.app'
-JLINK_JAR_PATH = subprocess.check_output(['find', MATHEMATICA_PATH, '-name', 'JLink.jar']).strip()
-MATHKERNEL_PATH = subprocess.check_output(['find', MATHEMATICA_PATH, '-name', 'MathKernel']).strip()
-
-VALID_SYMBOL_CHARS = string.ascii_letters + string.digits + "$"
-
-def exit_discard():
-    sys.exit(200)
-
-def exit_replace_text(out = None):
-    if out is not None:
-        sys.stdout.write(out)
-    sys.exit(201)
-
-def exit_replace_document(out = None):
-    if out is not None:
-        sys.stdout.write(out)
-    sys.exit(202)
-
-def exit_insert_text(out = None):
-    if out is not None:
-        sys.stdout.write(out)
-    sys.exit(203)
-
-def exit_insert_snippet(out = None):
-    if out is not None:
-        sys.stdout.write(out)
-    sys.exit(204)
-
-def exit_show_html(out = None):
-    if out is not None:
-        sys.stdout.write(out)
-    sys.exit(205)
-
-def exit_show_tool_tip(out = None):
-    if out is not None:
-        sys.stdout.write(out)
-    sys.exit(206)
-
-def exit_create_new_document(out = None):
-    if out is not None:
-        sys.stdout.write(out)
-    sys.exit(207)
+def find_mathematica_files():
+    # Search the installation once for every file we need and cache the
+    # result, keyed by the installation's mtime and version.
+    key = {"path": MATHEMATICA_PATH,
+           "mtime": os.path.getmtime(MATHEMATICA_PATH),
+           "version": get_mathematica_version()}
+    cachefile = os.path.join(MATHMATE_CACHE_FOLDER, "paths.json")
+
+    try:
+        cache = json.load(open(cachefile, 'r'))
+        if cache["key"] == key and all(map(os.path.exists, cache["files"].values())):
+            return cache["files"]
+    except Exception:
+        pass
+
+    files = {}
+    output = subprocess.check_output(['find', MATHEMATICA_PATH, '(', '-name', 'JLink.jar', '-o', '-name', 'MathKernel', ')'])
+    for path in output.splitlines():
+        name = os.path.basename(path)
+        if name not in files:
+            files[name] = path
+
+    for name in ("JLink.jar", "MathKernel"):
+        if name not in files:
+            raise Exception("Could not find %s in %s." % (name, MATHEMATICA_PATH))
+
+    write_cache_file(cachefile, json.dumps({"key": key, "files": files}))
+    return files
+
+def get_jlink_jar_path():
+    if os.environ.get('MATHMATE_JLINK_JAR'):
+        return os.environ['MATHMATE_JLINK_JAR']
+    return find_mathematica_files()["JLink.jar"]
+
+def get_mathkernel_path():
+    if os.environ.get('MATHMATE_MATHKERNEL'):
+        return os.environ['MATHMATE_MATHKERNEL']
+    return find_mathematica_files()["MathKernel"]
 
 def return_focus_to_textmate():
     osascript = """
@@ -62,21 +302,18 @@ def return_focus_to_textmate():
     """
     # subprocess.call(["osascript", "-e", osascript])
 
-def is_valid_mathematica_symbol(symbol):
-    if len(symbol) == 0:
-        return False
-        
-    for char in symbol:
-        if char not in VALID_SYMBOL_CHARS:
-            return False
-    return True
-
 class MathMate(object):
-    def __init__(self, input_file = None, process_entire_document = False, process_up_to_cursor = False):
-        self.cacheFolder = '/tmp/tmjlink'
-        self.mlargs = ["-linkmode", "launch", "-linkname", MATHKERNEL_PATH, "-mathlink"]
-        
+    # Whether this process started a broker; a command can connect several
+    # times before it is listening
+    broker_launched = False
+    
+    def __init__(self, input_file = None, process_entire_document = False, process_up_to_cursor = False, doc = None, reformat_all = False):
+        self.cacheFolder = TMJLINK_CACHE_FOLDER
+
         self.parse_tree_level = None
+        self.line_starts = None
+        self.graph = DependencyGraph()
+        self.parse_cache = None
         
         self.tmjlink_pid = None
         pidfile = os.path.join(self.cacheFolder, "tmjlink.pid")
@@ -85,12 +322,15 @@ class MathMate(object):
             self.tmjlink_pid = int(pidfp.read())
             pidfp.close()
         
-        if input_file is None:
-            self.doc = sys.stdin.read()
-        else:
-            fp = open(input_file, 'r')
-            self.doc = fp.read()
-            fp.close()
+        with trace_phase("read"):
+            if doc is not None:
+                self.doc = doc
+            elif input_file is None:
+                self.doc = sys.stdin.read()
+            else:
+                fp = open(input_file, 'r')
+                self.doc = fp.read()
+                fp.close()
         
         self.indent_size = int(os.environ['TM_TAB_SIZE'])
         if os.environ.get('TM_SOFT_TABS') == "YES":
@@ -104,13 +344,12 @@ class MathMate(object):
         self.selected_text = os.environ.get('TM_SELECTED_TEXT')
         self.process_entire_document = process_entire_document
         self.process_up_to_cursor = process_up_to_cursor
-        self.statements = self.parse(self.doc)
-            
-        sessid = os.path.split(os.environ.get('TM_FILEPATH', 'mathmate-default'))[-1]
-        if sessid.endswith(".m"):
-            self.sessid = sessid[:-2]
-        else:
-            self.sessid = sessid
+        # Statements are reformatted when first asked for, unless the command
+        # is going to reformat all of them anyway
+        with trace_phase("parse"):
+            self.statements = self.parse_document(reformat_all)
+        self.statement_starts = [statement.start for statement in self.statements]
+        self.sessid = get_sessid()
     
     def signal_tmjlink(self, signal = 1):
         try:
@@ -124,34 +363,51 @@ class MathMate(object):
         return self.signal_tmjlink(0)
     
     def get_textmate_pid(self):
-        current_pid = os.getpid()
-        while current_pid != 1:
-            shell = subprocess.Popen(["ps", "-p", str(current_pid), "-o", "pid,ppid,command"], stdout=subprocess.PIPE)
-            process = map(lambda x: x[:11].split() + [x[12:]], shell.stdout.read().rstrip().split("\n"))[1]
-            if "TextMate.app/Contents/MacOS/TextMate" in process[2]:
-                return current_pid
-            current_pid = int(process[1])
-        raise Exception("Could not determine TextMate.app pid.")
+        # Reuse the pid found for the last launch for as long as it is alive
+        try:
+            pidfp = open(os.path.join(self.cacheFolder, "textmate.pid"), 'r')
+            textmate_pid = int(pidfp.read())
+            pidfp.close()
+            os.kill(textmate_pid, 0)
+            return textmate_pid
+        except (IOError, ValueError, OSError):
+            pass
+        
+        textmate_pid = find_ancestor_pid("TextMate.app/Contents/MacOS/TextMate")
+        if textmate_pid is None:
+            raise Exception("Could not determine TextMate.app pid.")
+        return textmate_pid
 
     def launch_tmjlink(self):
         if self.is_tmjlink_alive():
             return
-        
+        with trace_phase("launch"):
+            self.start_tmjlink()
+    
+    def start_tmjlink(self):
         classpath = []
         classpath.append(os.path.join(os.environ.get('TM_BUNDLE_SUPPORT'), "tmjlink/dist/tmjlink.jar"))
-        classpath.append(JLINK_JAR_PATH)
+        classpath.append(get_jlink_jar_path())
+        mlargs = ["-linkmode", "launch", "-linkname", get_mathkernel_path(), "-mathlink"]
+
+        textmate_pid = self.get_textmate_pid()
         
         if os.path.exists(self.cacheFolder):
             shutil.rmtree(self.cacheFolder) 
         os.mkdir(self.cacheFolder, 0777)
         
+        # The server connects back to this socket once it is listening
+        ready = socket.socket()
+        ready.bind(("localhost", 0))
+        ready.listen(1)
+        
         # Launch TextMateJLink
-        textmate_pid = self.get_textmate_pid()
         logfp = open(os.path.join(self.cacheFolder, "tmjlink.log"), 'w')
         proc = subprocess.Popen(['/usr/bin/java', 
+                '-Dtextmatejlink.notify=%d' % ready.getsockname()[1],
                 '-cp', ":".join(classpath), 
                 'com.shadanan.textmatejlink.TextMateJLink', 
-                self.cacheFolder, str(textmate_pid)] + self.mlargs,
+                self.cacheFolder, str(textmate_pid)] + mlargs,
             stdout=logfp, stderr=subprocess.STDOUT)
         logfp.close()
         
@@ -159,89 +415,121 @@ class MathMate(object):
         pidfp = open(os.path.join(self.cacheFolder, "tmjlink.pid"), 'w')
         pidfp.write(str(proc.pid))
         pidfp.close()
-    
-    def readtotal(self, sock, count):
-        result = []
-        total_read = 0
-        
-        while total_read != count:
-            buff = sock.recv(count - total_read)
-            
-            if buff == "":
-                raise Exception("The server quit unexpectedly.")
-                
-            result.append(buff)
-            total_read += len(buff)
+        pidfp = open(os.path.join(self.cacheFolder, "textmate.pid"), 'w')
+        pidfp.write(str(textmate_pid))
+        pidfp.close()
         
-        return "".join(result)
-    
-    def readline(self, sock):
-        result = []
-        while True:
-            char = sock.recv(1)
-            
-            if char == "\r":
-                continue
-                
-            if char == "\n":
-                break
-                
-            if char == "":
-                return None
-                
-            result.append(char)
-            
-        return "".join(result)
+        wait_for_tmjlink(proc, ready, self.cacheFolder)
     
     def connect(self):
         self.launch_tmjlink()
         
-        # Wait for server to be ready and get listen port
-        logfp = open(os.path.join(self.cacheFolder, "tmjlink.log"), 'r')
-        while True:
-            line = logfp.readline()
-            if line == "":
-                time.sleep(0.1)
-                continue
-            if line.strip().startswith("Server started on port: "):
-                port = int(line.strip()[24:])
-                break
+        # Prefer the broker's warm, already authenticated connections
+        with trace_phase("connect broker"):
+            sock = self.connect_broker()
+        if sock is not None:
+            return sock
+        
+        with trace_phase("connect"):
+            sock = socket.socket()
+            sock.connect(("localhost", get_tmjlink_port(self.cacheFolder)))
+            # Commands and payloads go out as separate small writes
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return BufferedSocket(sock)
+    
+    def connect_broker(self):
+        if os.environ.get('MATHMATE_BROKER') == "NO":
+            return None
+        
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.connect(os.path.join(self.cacheFolder, "broker.sock"))
+            return BufferedSocket(sock)
+        except socket.error:
+            sock.close()
+        
+        # Not running: start it for the next command and connect directly this time
+        self.launch_broker()
+        return None
+    
+    def launch_broker(self):
+        if MathMate.broker_launched:
+            return
+        MathMate.broker_launched = True
+        devnull = open(os.devnull, 'r+')
+        logfp = open(os.path.join(self.cacheFolder, "broker.log"), 'a')
+        subprocess.Popen([sys.executable, "-u", os.path.join(os.path.dirname(os.path.abspath(__file__)), "mathmate_broker.py"), self.cacheFolder],
+            stdin=devnull, stdout=logfp, stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid)
         logfp.close()
+        devnull.close()
     
-        sock = socket.socket()
-        sock.connect(("localhost", port))
-        return sock
+    def open_session(self, timeout = None, sessid = None):
+        return Session(self.connect(), sessid or self.sessid, timeout, self.supports_batches())
     
-    def read(self, sock):
-        line = self.readline(sock)
-
-        if line is None:
-            raise Exception("The server quit unexpectedly.")
-            
-        if line.find(" -- ") != -1:
-            response = line[0:line.find(" -- ")]
-            comment = line[line.find(" -- ")+4:]
-        else:
-            response = line
-            comment = None
-            
-        words = response.split(" ")
-        return (line, response, words, comment)
+    def supports_batches(self):
+        # tmjlink.jar builds from before batches answer "batch" with an
+        # exception, and are sent one statement at a time. Asked once per
+        # server launch, which clears the cache folder.
+        path = os.path.join(self.cacheFolder, "tmjlink.batches")
+        try:
+            return open(path).read() == "yes"
+        except IOError:
+            pass
+        try:
+            self.run_command("batch 0")
+            batches = True
+        except ServerException:
+            batches = False
+        write_cache_file(path, "yes" if batches else "no")
+        return batches
+    
+    def supports_lookups(self):
+        # tmjlink.jar builds from before "lookup" read definitions with
+        # "intexec", which newer builds count as changing them. Asked once
+        # per server launch, like batches.
+        path = os.path.join(self.cacheFolder, "tmjlink.lookups")
+        try:
+            return open(path).read() == "yes"
+        except IOError:
+            pass
+        try:
+            self.run_command("lookup 0")
+            lookups = True
+        except ServerException:
+            lookups = False
+        write_cache_file(path, "yes" if lookups else "no")
+        return lookups
+    
+    def get_lookup_command(self):
+        return "lookup" if self.supports_lookups() else "intexec"
+    
+    def supports_generations(self):
+        # tmjlink.jar builds from before generations answer "suggest" with
+        # the names alone, so incremental runs cannot tell whether anything
+        # else ran in the session, and run every statement
+        try:
+            return open(os.path.join(self.cacheFolder, "tmjlink.generations")).read() != "no"
+        except IOError:
+            return True
+    
+    def run_command(self, command, payload = ""):
+        return run_command(self.connect(), self.sessid, command, payload)
     
     def read_default(self, key, default = None):
-        proc = subprocess.Popen(["defaults", "read", "com.wolfram.mathmate", key], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        exit_code = proc.wait()
-        if exit_code != 0:
-            return default
-        return proc.stdout.read().strip()
+        return read_preference(key, default)
     
-    def inline(self, statements, force_image = False):
-        white_space = self.read_default("white_space", "Normal")
+    def inline(self, statements, force_image = False, incremental = False, parallel = False):
+        trace_command("inline" + " image" * force_image + " incremental" * incremental + " parallel" * parallel)
+        preferences = read_preferences()
+        white_space = preferences.get("white_space", "Normal")
         white_space_mode = "pre" if white_space == "Pre" else "normal"
         
-        show_times = self.read_default("show_times", "Hidden")
+        show_times = preferences.get("show_times", "Hidden")
         show_times_mode = "block" if show_times == "Visible" else "none"
         
+        results_cache = preferences.get("results_cache", "Off")
+        kernels = int(preferences.get("kernels", "1")) if parallel else 1
+        
         # Output header (stylesheet, js, etc)
         sys.stdout.write("""
           <?xml version="1.0" encoding="UTF-8"?>
@@ -297,11 +585,11 @@ class MathMate(object):
                     if ($(this).html() == "Normal") {
                       $(this).html("Pre");
                       $('div.cell div.content').css('white-space', 'pre');
-                      TextMate.system("defaults write com.wolfram.mathmate white_space Pre");
+                      TextMate.system("python '%(tm_bundle_support)s/bin/mathmate_defaults.py' write white_space Pre");
                     } else {
                       $(this).html("Normal");
                       $('div.cell div.content').css('white-space', 'normal');
-                      TextMate.system("defaults write com.wolfram.mathmate white_space Normal");
+                      TextMate.system("python '%(tm_bundle_support)s/bin/mathmate_defaults.py' write white_space Normal");
                     }
                   });
                 
@@ -309,11 +597,21 @@ class MathMate(object):
                     if ($(this).html() == "Hidden") {
                       $(this).html("Visible");
                       $('.time').show();
-                      TextMate.system("defaults write com.wolfram.mathmate show_times Visible");
+                      TextMate.system("python '%(tm_bundle_support)s/bin/mathmate_defaults.py' write show_times Visible");
                     } else {
                       $(this).html("Hidden");
                       $('.time').hide();
-                      TextMate.system("defaults write com.wolfram.mathmate show_times Hidden");
+                      TextMate.system("python '%(tm_bundle_support)s/bin/mathmate_defaults.py' write show_times Hidden");
+                    }
+                  });
+                
+                  $('#results_cache .value').click(function() {
+                    if ($(this).html() == "Off") {
+                      $(this).html("On");
+                      TextMate.system("python '%(tm_bundle_support)s/bin/mathmate_defaults.py' write results_cache On");
+                    } else {
+                      $(this).html("Off");
+                      TextMate.system("python '%(tm_bundle_support)s/bin/mathmate_defaults.py' write results_cache Off");
                     }
                   });
                 });
@@ -343,6 +641,11 @@ class MathMate(object):
                     <span class="label">Execution Times:</span>
                     <span class="value">%(show_times)s</span>
                   </div>
+              
+                  <div id="results_cache" class="field_label">
+                    <span class="label">Results Cache:</span>
+                    <span class="value">%(results_cache)s</span>
+                  </div>
                 </div>
                 
                 <br style="clear: both" />
@@ -352,93 +655,70 @@ class MathMate(object):
                "show_times": show_times,
                "show_times_mode": show_times_mode,
                "white_space": white_space,
-               "white_space_mode": white_space_mode})
+               "white_space_mode": white_space_mode,
+               "results_cache": results_cache})
         sys.stdout.flush()
         
         try:
-            sock = self.connect()
-
-            state = 0
-            readsize = None
-            while True:
-                if readsize is not None:
-                    content = self.readtotal(sock, readsize)
-                else:
-                    line, response, words, comment = self.read(sock)
-
-                if state == 0:
-                    if response == "okay":
-                        sock.send("sessid %s\n" % self.sessid)
-                        state = 1
-                        continue
-
-                    if response == "exception":
-                        raise Exception("TextMateJLink Exception: " + comment)
-
-                    raise Exception("Unexpected message from JLink server: " + line)
-            
-                if state == 1:
-                    if response == "okay":
-                        sock.send("header\n")
-                        state = 2
-                        continue
-                    
-                    if response == "exception":
-                        raise Exception("TextMateJLink Exception: " + comment)
-
-                    raise Exception("Unexpected message from JLink server: " + line)
-            
-                if state == 2:
-                    if response == "okay":
-                        statement = None
-                        
-                        while len(statements) > 0:
-                            statement = statements.pop(0).rstrip()
-                            if statement != "":
-                                break
-                            statement = None
-                        
-                        if statement is None:
-                            sock.send("quit\n")
-                            state = 4
-                            continue
-                            
-                        if force_image:
-                            sock.send("image %d\n" % len(statement))
-                        else:
-                            sock.send("execute %d\n" % len(statement))
-                        sock.send(statement)
-                        continue
-
-                    if words[0] == "inline":
-                        readsize = int(words[1])
-                        state = 3
-                        continue
-
-                    if response == "exception":
-                        raise Exception("TextMateJLink Exception: " + comment)
-
-                    raise Exception("Unexpected message from JLink server: " + line)
+            session = self.open_session()
+
+            # Stream the whole conversation up front; the server answers in
+            # order and skips the rest of a batch after an exception
+            mark = time.time()
+            statements = [statement.rstrip() for statement in statements]
+            indexes = self.get_statement_indexes(statements)
+            if results_cache == "On":
+                keys = self.get_results_keys(indexes, force_image)
+            else:
+                keys = [None] * len(statements)
+            keys = [key for statement, key in zip(statements, keys) if statement != ""]
+            indexes = [index for statement, index in zip(statements, indexes) if statement != ""]
+            statements = [statement for statement in statements if statement != ""]
             
-                if state == 3:
-                    sys.stdout.write(content)
-                    sys.stdout.flush()
-                    readsize = None
-                    state = 2
-                    continue
+            # Leave out what the session already ran
+            skipped = 0
+            if incremental:
+                self.format_statements([self.statements[index] for index in indexes if index is not None])
+                hashes = [self.get_statement_hash(statement, index) for statement, index in zip(statements, indexes)]
+                skipped = self.get_executed_prefix(session, hashes)
+                keys = keys[skipped:]
+                indexes = indexes[skipped:]
+                statements = statements[skipped:]
             
-                if state == 4:
-                    if response == "okay":
-                        sock.close()
-                        break
-
-                    if response == "exception":
-                        raise Exception("TextMateJLink Exception: " + comment)
-
-                    raise Exception("Unexpected message from JLink server: " + line)
+            cache = ResultsCache()
+            cached = [cache.load(key) if key is not None else None for key in keys]
+            trace_since("prepare", mark)
+            mark = time.time()
+            if kernels > 1:
+                self.run_parallel(session, kernels, force_image, statements, indexes, keys, cached, cache)
+            else:
+                # Replies owed before the statements': the greeting, the
+                # session ID, the reset if there was one, and the header
+                preamble = session.pending + 1
+                session.send("header")
+                session.send_batch("image" if force_image else "execute",
+                    [statement for statement, html in zip(statements, cached) if html is None])
+                generations = incremental and self.supports_generations()
+                if generations:
+                    session.send("suggest -")
+                session.send("quit")
+                executed, replies, errors = self.receive_results(session, cache, keys, cached, preamble, skipped)
+                session.close()
+                
+                # Nothing is saved when the suggestions did not come back
+                if generations and replies[-2] is not None and replies[-2][2][0] == "suggestions":
+                    line, response, words, comment = replies[-2]
+                    generation, names = parse_suggestions(line)
+                    if generation is not None:
+                        save_completion_index(self.sessid, generation, names)
+                        self.save_executed_log(generation, hashes[:skipped + executed])
+                    else:
+                        # Every run sends them all again, so stop asking
+                        write_cache_file(os.path.join(self.cacheFolder, "tmjlink.generations"), "no")
+                if len(errors) > 0:
+                    raise errors[0]
+            trace_since("run", mark)
 
-                raise Exception("Invalid state: " + state)
-            
         except Exception:
             sys.stdout.write('<div class="exception">%s</div>' % traceback.format_exc())
             sys.stdout.flush()
@@ -450,267 +730,195 @@ class MathMate(object):
         """)
         sys.stdout.flush()
     
-    def execute(self, command):
-        result = None
-        sock = self.connect()
-        
-        state = 0
-        readsize = None
-        while True:
-            if readsize is not None:
-                content = self.readtotal(sock, readsize)
-            else:
-                line, response, words, comment = self.read(sock)
-            
-            if state == 0:
-                if response == "okay":
-                    sock.send("sessid %s\n" % self.sessid)
-                    state = 1
-                    continue
-            
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-                
-            if state == 1:
-                if response == "okay":
-                    sock.send("intexec %d\n" % len(command))
-                    sock.send(command)
-                    state = 2
-                    continue
-                        
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-            
-            if state == 2:
-                if response == "okay":
-                    sock.send("quit\n")
-                    state = 4
-                    continue
-
-                if words[0] == "inline":
-                    readsize = int(words[1])
-                    state = 3
-                    continue
-
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-                
-            if state == 3:
-                result = content
-                readsize = None
-                state = 2
-                continue
-            
-            if state == 4:
-                if response == "okay":
-                    sock.close()
-                    break
-
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-                
-            raise Exception("Invalid state: " + state)
+    def run_parallel(self, session, kernels, force_image, statements, indexes, keys, cached, cache):
+        # What each statement defines and references, from the document's
+        # dependency graph where the statement is the document's own
+        graph = self.get_dependency_graph()
+        symbols = [(graph.get_defines(index), graph.get_references(index)) if index is not None
+            else extract_symbols(statement) for statement, index in zip(statements, indexes)]
         
+        # The rest of the pool are sibling sessions, each with its own kernel
+        session.send("header")
+        session.receive_all(output=sys.stdout)
+        sessions = [session]
+        try:
+            for number in range(1, kernels):
+                sessions.append(self.open_session(sessid="%s-kernel%d" % (self.sessid, number)))
+            ParallelRun(sessions, "image" if force_image else "execute", self.get_lookup_command(),
+                statements, symbols, keys, cached, cache, sys.stdout).run()
+            for pooled in sessions:
+                pooled.quit()
+        finally:
+            for pooled in sessions:
+                pooled.close()
+    
+    def get_statement_indexes(self, statements):
+        # Where each of the statements being run is in the document. They are
+        # the document's own, in order.
+        result = []
+        index = 0
+        for statement in statements:
+            while index < len(self.statements) and self.statements[index].text.rstrip() != statement:
+                index += 1
+            result.append(index if index < len(self.statements) else None)
+            index += 1
         return result
     
-    def clear(self):
-        sock = self.connect()
+    def get_statement_hash(self, statement, index):
+        # Changes to white space alone leave the reformatted text as it was
+        if index is not None:
+            statement = self.statements[index].reformatted.strip()
+        return hashlib.sha1(statement).hexdigest()
+    
+    def get_results_keys(self, indexes, force_image = False):
+        # Keys come from the reformatted text of every statement in the
+        # document, so definitions made before the ones being run count. A
+        # selection comes without the rest of the document, so none of it is
+        # replayed.
+        if self.selected_text is not None:
+            return [None] * len(indexes)
+        self.format_statements(self.statements)
+        keys = get_statement_keys([statement.reformatted for statement in self.statements],
+            "%s\0%s" % (self.sessid, "image" if force_image else "execute"))
+        return [keys[index] if index is not None else None for index in indexes]
+    
+    def get_executed_log_path(self):
+        return os.path.join(self.cacheFolder, "executed", self.sessid)
+    
+    def load_executed_log(self):
+        # Hashes of the statements run in the session by the last incremental
+        # run, in order, and the generation of the session's definitions
+        # after them
+        try:
+            fp = open(self.get_executed_log_path(), 'rb')
+        except IOError:
+            return None, []
+        try:
+            return cPickle.load(fp)
+        except Exception:
+            return None, []
+        finally:
+            fp.close()
+    
+    def save_executed_log(self, generation, hashes):
+        write_cache_file(self.get_executed_log_path(), cPickle.dumps((generation, hashes), cPickle.HIGHEST_PROTOCOL))
+    
+    def get_executed_prefix(self, session, hashes):
+        # How many of the statements the session already ran, unchanged and
+        # in order. When an earlier statement changed, or anything else ran
+        # in the session since, it is reset to run them all again.
+        generation, executed = self.load_executed_log()
+        if generation is None:
+            return 0
         
-        state = 0
-        while True:
-            line, response, words, comment = self.read(sock)
-            
-            if state == 0:
-                if response == "okay":
-                    sock.send("sessid %s\n" % self.sessid)
-                    state = 1
-                    continue
-            
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-                
-            if state == 1:
-                if response == "okay":
-                    sock.send("clear\n")
-                    state = 2
-                    continue
-                        
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-            
-            if state == 2:
-                if response == "okay":
-                    sock.send("quit\n")
-                    state = 3
-                    continue
-            
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-                
-            if state == 3:
-                if response == "okay":
-                    sock.close()
-                    break
-            
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
+        reply, inlines = session.request("suggest %s" % generation)
+        line, response, words, comment = reply
+        count = 0
+        while count < min(len(executed), len(hashes)) and executed[count] == hashes[count]:
+            count += 1
+        if words[0] == "okay" and count == len(executed):
+            return count
+        
+        session.send("reset")
+        return 0
+    
+    def receive_results(self, session, cache, keys, cached, preamble, skipped = 0):
+        # Writes the stored output of cached statements in between the
+        # server's answers for the rest, in order, and stores the new answers.
+        # Returns how many statements ran before the first exception, the
+        # replies that followed the statements, and the exceptions.
+        output = RecordingOutput(sys.stdout)
+        errors = []
+        
+        def receive():
+            try:
+                return session.receive(output=output)[0]
+            except ServerException, e:
+                errors.append(e)
+                return None
+        
+        for reply in range(preamble):
+            receive()
+        if skipped > 0:
+            sys.stdout.write("<div class='cell text'><div class='margin'></div><div class='content'>%d unchanged statements already run</div></div>" % skipped)
+            sys.stdout.flush()
+        
+        executed = 0
+        stored = False
+        for key, html in zip(keys, cached):
+            if html is not None:
+                # The server would have skipped it after an exception
+                if len(errors) == 0:
+                    sys.stdout.write(html)
+                    sys.stdout.flush()
+                    executed += 1
+                continue
             
-            raise Exception("Invalid state: " + state)
+            # Only statements with a key are kept, so the rest stream through
+            # in constant memory
+            if key is not None:
+                output.start()
+            succeeded = receive() is not None
+            if key is not None:
+                html = output.stop()
+            if succeeded and len(errors) == 0:
+                executed += 1
+            if succeeded and key is not None:
+                cache.store(key, html)
+                stored = True
         
+        replies = []
+        while session.pending > 0:
+            replies.append(receive())
+        if stored:
+            cache.evict()
+        return executed, replies, errors
+    
+    def execute(self, command):
+        trace_command("execute")
+        reply, inlines = self.run_command("%s %d" % (self.get_lookup_command(), len(command)), command)
+        return inlines[-1] if len(inlines) > 0 else None
+    
+    def clear(self):
+        trace_command("clear")
+        self.run_command("clear")
         return "Session Cleared"
             
     def reset(self):
-        sock = self.connect()
-
-        state = 0
-        while True:
-            line, response, words, comment = self.read(sock)
-
-            if state == 0:
-                if response == "okay":
-                    sock.send("sessid %s\n" % self.sessid)
-                    state = 1
-                    continue
-
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-
-            if state == 1:
-                if response == "okay":
-                    sock.send("reset\n")
-                    state = 2
-                    continue
-
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-
-            if state == 2:
-                if response == "okay":
-                    sock.send("quit\n")
-                    state = 3
-                    continue
-
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-
-            if state == 3:
-                if response == "okay":
-                    sock.close()
-                    break
-
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-
-            raise Exception("Invalid state: " + state)
-
+        trace_command("reset")
+        self.run_command("reset")
         return "Session Reset"
 
     def get_symbols(self):
-        sock = self.connect()
-
-        state = 0
-        while True:
-            line, response, words, comment = self.read(sock)
-
-            if state == 0:
-                if response == "okay":
-                    sock.send("sessid %s\n" % self.sessid)
-                    state = 1
-                    continue
-
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-
-            if state == 1:
-                if response == "okay":
-                    sock.send("suggest\n")
-                    state = 2
-                    continue
-
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-
-            if state == 2:
-                if words[0] == "suggestions":
-                    result = eval(words[1])
-                    sock.send("quit\n")
-                    state = 3
-                    continue
-
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-
-            if state == 3:
-                if response == "okay":
-                    sock.close()
-                    break
-
-                if response == "exception":
-                    raise Exception("TextMateJLink Exception: " + comment)
-
-                raise Exception("Unexpected message from JLink server: " + line)
-
-            raise Exception("Invalid state: " + state)
-
+        generation, result = load_completion_index(self.sessid)
+        reply, inlines = self.run_command("suggest %s" % (generation or "-"))
+
+        # Otherwise nothing changed since the index was saved
+        line, response, words, comment = reply
+        if words[0] == "suggestions":
+            generation, result = parse_suggestions(line)
+            if generation is not None:
+                save_completion_index(self.sessid, generation, result)
         return result
 
-    def get_pos(self, line, column):
-        line_index = 1
-        line_pos = 0
+    def get_line_starts(self):
+        # Offset of the first character of every line, built once per document
+        if self.line_starts is None:
+            self.line_starts = find_line_starts(self.doc)
+        return self.line_starts
     
-        for pos, char in enumerate(self.doc):
-            if line == line_index and column == pos - line_pos:
-                return pos
-        
-            if char == "\n":
-                line_index += 1
-                line_pos = pos + 1
-        
-        return len(self.doc)
+    def get_pos(self, line, column):
+        return find_pos(self.doc, self.get_line_starts(), line, column)
         
     def get_line_col(self, posq):
-        line_index = 1
-        line_pos = 0
-        
-        for pos, char in enumerate(self.doc):
-            if posq == pos:
-                return (line_index, pos - line_pos)
+        line_starts = self.get_line_starts()
         
-            if char == "\n":
-                line_index += 1
-                line_pos = pos + 1
+        # Positions outside the document report the last character's position
+        if posq < 0 or posq >= len(self.doc):
+            return (len(line_starts), len(self.doc) - 1 - line_starts[-1])
         
-        return (line_index, pos - line_pos)
+        line = bisect.bisect_right(line_starts, posq)
+        return (line, posq - line_starts[line - 1])
 
     def count_indents(self, line):
         count = 0
@@ -727,39 +935,107 @@ class MathMate(object):
                 break
         return count
     
-    def get_next_non_space_char(self, pos):
-        for i in xrange(pos, len(self.doc)):
-            if self.doc[i] in (" ", "\t"):
-                continue
-            if self.doc[i] == "\n":
-                return None
-            return self.doc[i]
-        return None
+    def parse(self, block, initial_indent_level = None, reformat = False):
+        if initial_indent_level is None:
+            initial_indent_level = self.count_indents(block)
+        
+        statements, states = self.parse_from(block, initial_indent_level, reformat=reformat)
+        return statements
     
-    def get_prev_non_space_char(self, pos):
-        for i in xrange(pos, -1, -1):
-            if self.doc[i] in (" ", "\t"):
-                continue
-            if self.doc[i] == "\n":
-                return None
-            return self.doc[i]
-        return None
-
-    def is_end_of_line(self, pos):
-        return self.get_next_non_space_char(pos) == None
+    def iter_reformatted(self, input, initial_indent_level = None, chunk_size = STREAM_CHUNK_SIZE):
+        # Reformatted statements of a file of any size, holding only the text
+        # of the statement being parsed and the next chunk of lines
+        pending = ""
+        resume = 0
+        do_indent = True
+        read_size = chunk_size
+        while True:
+            data = input.read(read_size)
+            if data != "" and not data.endswith("\n"):
+                # Lookahead never crosses a new line, so whole lines suffice
+                data += input.readline()
+            final = data == ""
+            block = pending + data
+            if initial_indent_level is None:
+                # Taken from the first line with something on it
+                if not final and block.strip() == "":
+                    pending = block
+                    continue
+                initial_indent_level = self.count_indents(block)
+            
+            for statement, state in self.iter_statements(block, initial_indent_level, resume, do_indent, final=final, reformat=True):
+                if statement is not None:
+                    yield statement.formatted
+            if final:
+                return
+            
+            # Parse the open statement again with the next chunk. Read more
+            # at once while one statement spans whole chunks, so that it is
+            # parsed a bounded number of times.
+            pos, do_indent = state
+            read_size = chunk_size if pos > resume else read_size * 2
+            
+            # The parser looks back from a statement's start at the last
+            # non-space character on its line (after a "]" or "}", say), so
+            # that is kept with it
+            keep = pos
+            while keep > 0 and block[keep - 1] in " \t":
+                keep -= 1
+            if keep > 0 and block[keep - 1] != "\n":
+                keep -= 1
+            pending = block[keep:]
+            resume = pos - keep
     
-    def parse(self, block, initial_indent_level = None):
+    def reformat_stream(self, input, output, initial_indent_level = None, chunk_size = STREAM_CHUNK_SIZE):
+        for statement in self.iter_reformatted(input, initial_indent_level, chunk_size):
+            output.write(statement)
+    
+    def parse_from(self, block, initial_indent_level, pos = 0, do_indent = True, stop = None, reformat = False, track_cursor = False):
         statements = []
+        states = []
+        for statement, state in self.iter_statements(block, initial_indent_level, pos, do_indent, stop,
+                reformat=reformat, track_cursor=track_cursor):
+            statements.append(statement)
+            states.append(state)
+        return statements, states
+    
+    def format_statements(self, statements):
+        # Reformat statements of a block, in order, in one pass from the
+        # first to the last of them not yet reformatted
+        statements = [statement for statement in statements if statement.formatted is None]
+        if len(statements) == 0:
+            return
+        first = statements[0]
+        index = 0
+        for reformatted, state in self.iter_statements(first.block, first.indent_level, first.start, first.do_indent,
+                stop=statements[-1].start, reformat=True):
+            if reformatted.start == statements[index].start:
+                statements[index].formatted = reformatted.formatted
+                index += 1
+                if index == len(statements):
+                    break
+    
+    def iter_statements(self, block, initial_indent_level, pos = 0, do_indent = True, stop = None, final = True, reformat = False, track_cursor = False):
+        # Yields each statement with the parser state at its start, as soon as
+        # the next one begins. Unless final, the block may be cut short: the
+        # statement still open at its end is left out, and (None, state) is
+        # yielded last so that parsing can resume there with more text.
+        # Without reformat only the boundaries are found, and statements are
+        # reformatted when their text is first asked for. With track_cursor
+        # the scope at the cursor is recorded as the parse tree level; the
+        # passes that reformat statements later leave it alone.
         
-        pos = 0
-        ss_pos = 0
+        # The scope stack is always empty on a statement boundary, so do_indent
+        # is all we need to resume.
+        state = (pos, do_indent)
+        
+        ss_pos = pos
         current = []
+        pending = False
         scope = []
-        do_indent = True
         vsc = string.ascii_letters + string.digits
         
-        if initial_indent_level is None:
-            initial_indent_level = self.count_indents(block)
+        nsi = NonSpaceIndex(block)
         
         while pos < len(block):
             c1 = block[pos]
@@ -767,16 +1043,7 @@ class MathMate(object):
             c3 = block[pos:pos+3]
             pc = block[pos-1] if pos > 0 else None
 
-            nnsc = None
-            for i in xrange(pos + 1, len(block)):
-                if block[i] == "\n":
-                    break
-                    
-                if block[i] not in (" ", "\t"):
-                    nnsc = block[i]
-                    break
-
-            if pos == self.tmcursor:
+            if track_cursor and pos == self.tmcursor:
                 self.parse_tree_level = ".".join(scope)
 
             if len(scope) == 0:
@@ -785,26 +1052,35 @@ class MathMate(object):
                     # Preserve lines between statements
                     if c1 == "\n":
                         do_indent = True
-                        current += c1
+                        pending = True
+                        if reformat:
+                            current += c1
                     
                     pos += 1
                     continue
                 
                 # New statement token encountered. Save current statement.
-                if current != []:
+                if pending:
                     # Two statements on the same line. Add a space between them.
-                    if do_indent is False:
+                    if reformat and do_indent is False:
                         current += " "
                     
                     # Save statement and reset buffer
-                    statements.append((ss_pos, pos, "".join(current), block[ss_pos:pos]))
+                    yield Statement(self, block, ss_pos, pos, initial_indent_level, state[1],
+                        "".join(current) if reformat else None), state
                     current = []
+                    pending = False
+                    
+                    if stop is not None and pos > stop:
+                        return
+                    state = (pos, do_indent)
                 
                 ss_pos = pos
                 scope.append("root")
+                pending = True
                 
                 # Add indentation if current is on a new line (do_indent is True).
-                if do_indent is True:
+                if reformat and do_indent is True:
                     current += (self.indent * initial_indent_level)
                 
                 # Do not advance cursor
@@ -812,104 +1088,123 @@ class MathMate(object):
 
             if scope[-1] == "string":
                 if c2 == '\\"':
-                    current += c2
+                    if reformat:
+                        current += c2
                     pos += 2
                     continue
 
                 if c1 == '"':
                     scope.pop()
-                    current += c1
+                    if reformat:
+                        current += c1
                     pos += 1
                     continue
 
-                current += c1
+                if reformat:
+                    current += c1
                 pos += 1
                 continue
 
             if scope[-1] == "comment":
                 if c3 == '\\*)':
-                    current += c3
+                    if reformat:
+                        current += c3
                     pos += 3
                     continue
                 
                 if c2 == '(*':
                     scope.append("comment")
-                    current += c2
+                    if reformat:
+                        current += c2
                     pos += 2
                     continue
                 
                 if c2 == '*)':
                     scope.pop()
-                    current += c2
+                    if reformat:
+                        current += c2
                     pos += 2
                     continue
 
-                current += c1
+                if reformat:
+                    current += c1
                 pos += 1
                 continue
 
             if c1 in (" ", "\t"):
-                if pc is not None and nnsc is not None and pc in (vsc + "]})") and nnsc in vsc:
-                    current += " "
+                if reformat and pc is not None and pc in (vsc + "]})"):
+                    nnsc = nsi.next_char(pos + 1)
+                    if nnsc is not None and nnsc in vsc:
+                        current += " "
                 pos += 1
                 continue
         
             if c3 in ("===", "=!=", ">>>", "^:=", "//@", "//."):
-                if self.is_end_of_line(pos + 3):
+                if nsi.is_end_of_line(pos + 3):
                     scope += ("binop", "start")
-                current += " ", c3, " "
+                if reformat:
+                    current += " ", c3, " "
                 pos += 3
                 continue
 
             if c3 == "@@@":
-                if self.is_end_of_line(pos + 3):
+                if nsi.is_end_of_line(pos + 3):
                     scope += ("binop", "start")
-                current += " ", c3, " "
+                if reformat:
+                    current += " ", c3, " "
                 pos += 3
                 continue
             
             if c3 == "...":
-                current += " ", c3
+                if reformat:
+                    current += " ", c3
                 pos += 3
                 continue
 
             if c2 in ("*^", "&&", "||", "==", "!=", ">=", "<=", ";;", "/.", "->", ":>", "<>", ">>", 
                       "/@", "/;", "/:", "//", "~~", ":=", "^=", "+=", "-=", "*=", "/="):
-                if self.is_end_of_line(pos + 2):
+                if nsi.is_end_of_line(pos + 2):
                     scope += ("binop", "start")
-                current += " ", c2, " "
+                if reformat:
+                    current += " ", c2, " "
                 pos += 2
                 continue
             
             if c2 == "@@":
-                if self.is_end_of_line(pos + 2):
+                if nsi.is_end_of_line(pos + 2):
                     scope += ("binop", "start")
-                current += " ", c2, " "
+                if reformat:
+                    current += " ", c2, " "
                 pos += 2
                 continue
             
             if c2 in ("++", "--", "<<"):
-                current += c2
+                if reformat:
+                    current += c2
                 pos += 2
                 continue
 
             if c2 in ("..", "=."):
-                current += " ", c2
+                if reformat:
+                    current += " ", c2
                 pos += 2
                 continue
 
             if c2 == "(*":
-                pnsc = self.get_prev_non_space_char(pos-1)
-                if pnsc is not None and pnsc in vsc:
-                    current += " "
+                if reformat:
+                    pnsc = nsi.prev_char(pos-1)
+                    if pnsc is not None and pnsc in vsc:
+                        current += " "
                 scope.append("comment")
-                current += c2
+                if reformat:
+                    current += c2
                 pos += 2
                 continue
 
             if c2 == "[[":
                 scope.append("part")
-                current += c2
+                if reformat:
+                    current += c2
                 pos += 2
                 continue
         
@@ -917,13 +1212,15 @@ class MathMate(object):
                 while scope[-1] == "binop":
                     scope.pop()
                 scope.pop()
-                current += c2
+                if reformat:
+                    current += c2
                 pos += 2
                 continue
         
             if c1 == "[":
                 scope.append("function")
-                current += c1
+                if reformat:
+                    current += c1
                 pos += 1
                 continue
         
@@ -931,13 +1228,15 @@ class MathMate(object):
                 while scope[-1] == "binop":
                     scope.pop()
                 scope.pop()
-                current += c1
+                if reformat:
+                    current += c1
                 pos += 1
                 continue
         
             if c1 == "{":
                 scope.append("list")
-                current += c1
+                if reformat:
+                    current += c1
                 pos += 1
                 continue
         
@@ -945,13 +1244,15 @@ class MathMate(object):
                 while scope[-1] == "binop":
                     scope.pop()
                 scope.pop()
-                current += c1
+                if reformat:
+                    current += c1
                 pos += 1
                 continue
         
             if c1 == "(":
                 scope.append("group")
-                current += c1
+                if reformat:
+                    current += c1
                 pos += 1
                 continue
         
@@ -959,54 +1260,62 @@ class MathMate(object):
                 while scope[-1] == "binop":
                     scope.pop()
                 scope.pop()
-                current += c1
+                if reformat:
+                    current += c1
                 pos += 1
                 continue
             
             if c1 == "!":
-                current += c1, " "
+                if reformat:
+                    current += c1, " "
                 pos += 1
                 continue
                 
             if c1 == "?":
-                current += c1
+                if reformat:
+                    current += c1
                 pos += 1
                 continue
             
             if c1 in ("*", "/", "^"):
-                if self.is_end_of_line(pos + 1):
+                if nsi.is_end_of_line(pos + 1):
                     scope += ("binop", "start")
-                current += c1
+                if reformat:
+                    current += c1
                 pos += 1
                 continue
             
             if c1 in ("+", ">", "<", "|", "="):
-                if self.is_end_of_line(pos + 1):
+                if nsi.is_end_of_line(pos + 1):
                     scope += ("binop", "start")
-                current += " ", c1, " "
+                if reformat:
+                    current += " ", c1, " "
                 pos += 1
                 continue
             
             if c1 == "-":
-                if self.is_end_of_line(pos + 1):
+                if nsi.is_end_of_line(pos + 1):
                     scope += ("binop", "start")
                     
-                if self.get_prev_non_space_char(pos-1) not in (None, ";", "{", "(", "[", ",", "="):
-                    current += " ", c1, " "
-                else:
-                    current += c1
+                if reformat:
+                    if nsi.prev_char(pos-1) not in (None, ";", "{", "(", "[", ",", "="):
+                        current += " ", c1, " "
+                    else:
+                        current += c1
                 pos += 1
                 continue
 
             if c1 == "&":
-                current += " ", c1
+                if reformat:
+                    current += " ", c1
                 pos += 1
                 continue
             
             if c1 == ",":
                 while scope[-1] == "binop":
                     scope.pop()
-                current += c1, " "
+                if reformat:
+                    current += c1, " "
                 pos += 1
                 continue
 
@@ -1016,7 +1325,8 @@ class MathMate(object):
                 if scope[-1] == "root":
                     do_indent = False
                     scope.pop()
-                current += c1
+                if reformat:
+                    current += c1
                 pos += 1
                 continue
 
@@ -1028,171 +1338,226 @@ class MathMate(object):
                 if scope[-1] == "root":
                     do_indent = True
                     scope.pop()
-                current += c1
                 pos += 1
 
-                indent_level = len(scope) + initial_indent_level - 1
-                if nnsc in ("]", "}", ")"):
-                    current += (self.indent * (indent_level - 1))
-                else:
-                    current += (self.indent * indent_level)
+                if reformat:
+                    current += c1
+                    nnsc = nsi.next_char(pos)
+                    indent_level = len(scope) + initial_indent_level - 1
+                    if nnsc in ("]", "}", ")"):
+                        current += (self.indent * (indent_level - 1))
+                    else:
+                        current += (self.indent * indent_level)
 
                 continue
                 
             if c1 == '"':
                 scope.append("string")
-                current += c1
+                if reformat:
+                    current += c1
                 pos += 1
                 continue
             
-            if pc is not None and pc in "]})" and c1 in vsc:
+            if reformat and pc is not None and pc in "]})" and c1 in vsc:
                 current += " "
             
-            current += c1
+            if reformat:
+                current += c1
             pos += 1
             continue
 
-        if current != []:
-            statements.append((ss_pos, pos, "".join(current), block[ss_pos:pos]))
+        if not final:
+            yield None, state
+        elif pending:
+            yield Statement(self, block, ss_pos, pos, initial_indent_level, state[1],
+                "".join(current) if reformat else None), state
+    
+    def parse_document(self, reformat = False):
+        initial_indent_level = self.count_indents(self.doc)
+        
+        filepath = os.environ.get('TM_FILEPATH')
+        if filepath is None or self.selected_text is not None:
+            return self.parse_from(self.doc, initial_indent_level, reformat=reformat, track_cursor=True)[0]
+        
+        cachefile = os.path.join(MATHMATE_CACHE_FOLDER, "parse", hashlib.sha1(filepath).hexdigest())
+        docid = hashlib.sha1(self.doc).hexdigest()
+        # Caches holding statements in another form do not match
+        config = (self.indent, initial_indent_level, "offsets")
+        
+        # Statements are kept as (start, end) pairs into the document they
+        # were parsed from, which is kept with them
+        cache = {"docid": None, "doc": "", "statements": [], "states": [], "graph": None}
+        try:
+            fp = open(cachefile, 'rb')
+            data = cPickle.load(fp)
+            fp.close()
+            if data["config"] == config:
+                cache = data
+        except Exception:
+            pass
+        
+        statements = cache["statements"]
+        states = cache["states"]
+        
+        if cache["docid"] == docid:
+            index = len(statements)
+        else:
+            # Find the first cached statement that no longer matches the document
+            unchanged = get_common_prefix_length(cache["doc"], self.doc)
+            index = bisect.bisect_right([esp for ssp, esp in statements], unchanged)
+            if index < len(statements):
+                change_pos = statements[index][0]
+            else:
+                change_pos = statements[-1][1] if len(statements) > 0 else 0
+            
+            # Lookahead stops at the end of a line, so every statement starting on
+            # a line before the edit is unaffected by it. Resume from the last one.
+            newline_pos = self.doc.rfind("\n", 0, change_pos)
+            index = min(index, len(statements) - 1)
+            while index > 0 and states[index][0] > newline_pos:
+                index -= 1
+        
+        # The dependency graph is filled in on demand, so only keep the part
+        # that still matches
+        if cache.get("graph") is not None:
+            self.graph = cache["graph"]
+            self.graph.truncate(max(min(index, len(self.graph)), 0))
+        
+        if len(statements) == 0:
+            statements, states = self.parse_from(self.doc, initial_indent_level, reformat=reformat, track_cursor=True)
+        else:
+            statements = [Statement(self, self.doc, ssp, esp, initial_indent_level, do_indent)
+                for (ssp, esp), (pos, do_indent) in zip(statements[:index], states)]
+            if index < len(states):
+                tail_statements, tail_states = self.parse_from(self.doc, initial_indent_level, *states[index],
+                    reformat=reformat, track_cursor=True)
+                statements += tail_statements
+                states = states[:index] + tail_states
+            
+            # The parse tree level is only recorded while parsing over the cursor,
+            # so replay the statement holding the cursor if it was reused.
+            if index == len(states) or self.tmcursor < states[index][0]:
+                cursor_index = bisect.bisect_right(states, (self.tmcursor, True)) - 1
+                if cursor_index >= 0:
+                    self.parse_from(self.doc, initial_indent_level, *states[cursor_index], stop=self.tmcursor, track_cursor=True)
+        
+        self.parse_cache = (cachefile, {"docid": docid, "config": config, "doc": self.doc,
+            "statements": [(statement.start, statement.end) for statement in statements], "states": states, "graph": self.graph})
+        if cache["docid"] != docid:
+            self.save_parse_cache()
+        
         return statements
     
+    def save_parse_cache(self):
+        cachefile, data = self.parse_cache
+        try:
+            write_cache_file(cachefile, cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError):
+            pass
+    
+    def get_dependency_graph(self):
+        # Symbols defined and referenced by each statement, extracted from the
+        # statements not covered by the cached graph
+        if len(self.graph) < len(self.statements):
+            for statement in self.statements[len(self.graph):]:
+                self.graph.append(statement.text)
+            if self.parse_cache is not None:
+                self.save_parse_cache()
+        return self.graph
+    
     def get_current_statement_index(self):
-        for index, (ssp, esp, reformatted_statement, current_statement) in enumerate(self.statements):
-            if self.tmcursor >= ssp and self.tmcursor < esp:
-                return index
+        index = bisect.bisect_right(self.statement_starts, self.tmcursor) - 1
+        if index >= 0 and self.tmcursor < self.statements[index].end:
+            return index
         return len(self.statements) - 1
             
     def get_current_statement(self):
         return self.statements[self.get_current_statement_index()]
     
     def get_current_statements(self, process_entire_document = False, process_up_to_cursor = False):
-        statements = []
-        
+        return [statement.text for statement in self.select_statements(process_entire_document, process_up_to_cursor)]
+    
+    def select_statements(self, process_entire_document = False, process_up_to_cursor = False):
         if process_up_to_cursor:
-            for ssp, esp, reformatted_statement, current_statement in self.statements:
-                if ssp < self.tmcursor:
-                    statements.append(current_statement)
+            return self.statements[:bisect.bisect_left(self.statement_starts, self.tmcursor)]
         
         elif self.selected_text is not None or process_entire_document:
-            for ssp, esp, reformatted_statement, current_statement in self.statements:
-                statements.append(current_statement)
+            return self.statements
         
         else:
-            ssp, esp, reformatted_statement, current_statement = self.get_current_statement()
-            statements.append(current_statement)
-            
-        return statements
+            return [self.get_current_statement()]
         
     def reformat(self, process_entire_document = False, process_up_to_cursor = False):
-        result = []
+        trace_command("reformat")
+        statements = self.select_statements(process_entire_document, process_up_to_cursor)
+        self.format_statements(statements)
+        result = [statement.formatted for statement in statements]
         
-        if process_up_to_cursor:
-            for ssp, esp, reformatted_statement, current_statement in self.statements:
-                if ssp < self.tmcursor:
-                    result.append(reformatted_statement)
-                    
-        elif self.selected_text is not None or process_entire_document:
-            for ssp, esp, reformatted_statement, current_statement in self.statements:
-                result.append(reformatted_statement)
-                
-        else:
-            ssp, esp, reformatted_statement, current_statement = self.get_current_statement()
-            result.append(self.doc[0:ssp])
-            result.append(reformatted_statement)
-            result.append(self.doc[esp:])
+        if not process_up_to_cursor and not process_entire_document and self.selected_text is None:
+            statement = statements[0]
+            result = [self.doc[0:statement.start], statement.formatted, self.doc[statement.end:]]
             
-        if "".join(result) == self.doc:
+        result = "".join(result)
+        if result == self.doc:
             exit_show_tool_tip("No reformat required.")
         else:
-            exit_replace_document("".join(result))
+            exit_replace_document(result)
 
     def show(self):
+        trace_command("show")
         result = []
         result.append("Cursor: (Line: %d, Index: %d, Pos: %s, Tree: %s)" % (self.tmln, self.tmli, self.tmcursor, self.parse_tree_level))
 
-        if self.process_up_to_cursor:
-            for index, (ssp, esp, reformatted_statement, current_statement) in enumerate(self.statements):
-                if ssp < self.tmcursor:
-                    ssln, ssli = self.get_line_col(ssp)
-                    esln, esli = self.get_line_col(esp)
-                    result.append("Statement %d Boundaries: (Line: %d, Index: %d) -> (Line: %d, Index: %d)" % (index, ssln, ssli, esln, esli))
-                    if len(reformatted_statement.strip()) != 0:
-                        result.append(reformatted_statement.rstrip())
-                    else:
-                        result.append("*** Empty Statement ***")
-                    result.append("")
-            
-        elif self.selected_text is not None or self.process_entire_document:
-            for index, (ssp, esp, reformatted_statement, current_statement) in enumerate(self.statements):
-                ssln, ssli = self.get_line_col(ssp)
-                esln, esli = self.get_line_col(esp)
+        if self.process_up_to_cursor or self.selected_text is not None or self.process_entire_document:
+            statements = self.select_statements(self.process_entire_document, self.process_up_to_cursor)
+            self.format_statements(statements)
+            for index, statement in enumerate(statements):
+                ssln, ssli = self.get_line_col(statement.start)
+                esln, esli = self.get_line_col(statement.end)
                 result.append("Statement %d Boundaries: (Line: %d, Index: %d) -> (Line: %d, Index: %d)" % (index, ssln, ssli, esln, esli))
-                if len(reformatted_statement.strip()) != 0:
-                    result.append(reformatted_statement.rstrip())
+                if len(statement.formatted.strip()) != 0:
+                    result.append(statement.formatted.rstrip())
                 else:
                     result.append("*** Empty Statement ***")
                 result.append("")
                 
         else:
-            ssp, esp, reformatted_statement, current_statement = self.get_current_statement()
-            ssln, ssli = self.get_line_col(ssp)
-            esln, esli = self.get_line_col(esp)
+            statement = self.get_current_statement()
+            ssln, ssli = self.get_line_col(statement.start)
+            esln, esli = self.get_line_col(statement.end)
             result.append("Statement Boundaries: (Line: %d, Index: %d) -> (Line: %d, Index: %d)" % (ssln, ssli, esln, esli))
-            result.append(reformatted_statement)
+            result.append(statement.reformatted)
+
+            index = self.get_current_statement_index()
+            if index >= 0:
+                # Only the statements around it are scanned, so that it costs
+                # the same in any size of document
+                first = max(index - SHOW_STATEMENT_RANGE, 0)
+                last = min(index + SHOW_STATEMENT_RANGE, len(self.statements) - 1)
+                graph = DependencyGraph()
+                for statement in self.statements[first:last + 1]:
+                    graph.append(statement.text)
+                local = index - first
+                needs = [first + other for other in graph.get_needs(local)]
+                impact = [first + other for other in graph.get_impact(local)]
+                
+                result.append("")
+                result.append("Statement %d Defines: %s" % (index, ", ".join(sorted(graph.get_defines(local))) or "-"))
+                result.append("Statement %d References: %s" % (index, ", ".join(sorted(graph.get_references(local))) or "-"))
+                result.append("Statement %d Needs Statements (from %d): %s" % (index, first, ", ".join(map(str, needs)) or "-"))
+                result.append("Statement %d Affects Statements (to %d): %s" % (index, last, ", ".join(map(str, impact)) or "-"))
 
         return "\n".join(result)
     
     def suggest(self):
+        trace_command("suggest")
         # Get currently typed function
-        fnname = []
-        pos = self.tmcursor - 1
-        
-        while pos >= 0:
-            if self.doc[pos] not in VALID_SYMBOL_CHARS:
-                break
-            fnname.insert(0, self.doc[pos])
-            pos -= 1
-        
-        while len(fnname) > 0 and fnname[0] in string.digits:
-            fnname.pop(0)
-        
-        fnname = "".join(fnname)
-        
-        suggestions = filter(lambda x: x != "?" and x.startswith(fnname), self.get_symbols())
-        
-        if len(suggestions) == 0:
-            exit_show_tool_tip("No suggestions.")
-        
-        if len(suggestions) == 1:
-            exit_insert_text(suggestions[0][len(fnname):])
-        
-        data = {}
-        data['suggestions'] = map(lambda x: {'display': x}, suggestions)
-        
-        command = [os.environ.get('DIALOG'), "popup", "--alreadyTyped", fnname]
-        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        proc.stdin.write(plistlib.writePlistToString(data))
-        proc.stdin.close()
-        
-        out = proc.stdout.read()
-        if out != "":
-            exit_show_tool_tip(out)
-        exit_discard()
+        fnname = get_completion_prefix(self.doc, self.tmcursor)
+        show_suggestions(fnname, self.get_symbols())
     
     def get_current_symbol(self):
         if self.selected_text is not None:
             return self.selected_text
-        
-        start = self.tmcursor
-        while start > 0:
-            if self.doc[start - 1] not in VALID_SYMBOL_CHARS:
-                break
-            start -= 1
-        
-        end = self.tmcursor
-        while end < len(self.doc):
-            if self.doc[end] not in VALID_SYMBOL_CHARS:
-                break
-            end += 1
-        
-        return self.doc[start:end]
+        return find_symbol_at(self.doc, self.tmcursor)
+
+trace_since("import", IMPORT_START)
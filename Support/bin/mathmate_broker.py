@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# Long-lived broker between bundle commands and the TextMateJLink server.
+#
+# Commands connect to broker.sock in the cache folder and speak the usual
+# TextMateJLink protocol. The broker keeps a pool of server connections that
+# have already completed the okay/sessid handshake, hands one to each command
+# for its session ID, and takes it back when the command says quit, so most
+# commands never open a TCP connection or wait on the handshake.
+import os
+import sys
+import time
+import socket
+import threading
+import traceback
+import SocketServer
+
+from mathmate import get_tmjlink_port
+from mathmate_client import BufferedSocket, TERMINAL_REPLIES
+
+# Commands followed by a payload of the given size
+PAYLOAD_COMMANDS = ("execute", "image", "intexec", "lookup")
+
+IDLE_TIMEOUT = 30 * 60
+
+class Upstream(object):
+    def __init__(self, sock, sessid_reply, resets):
+        self.sock = sock
+        self.sessid_reply = sessid_reply
+        # The session's reset count when it connected
+        self.resets = resets
+
+class Broker(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, cache_folder):
+        self.cache_folder = cache_folder
+        self.socket_path = os.path.join(cache_folder, "broker.sock")
+        self.pool_lock = threading.Lock()
+        self.pool = {}
+        self.resets = {}
+        self.last_active = time.time()
+
+        SocketServer.UnixStreamServer.__init__(self, self.socket_path, BrokerHandler)
+        self.socket_inode = os.stat(self.socket_path).st_ino
+
+    def acquire(self, sessid):
+        with self.pool_lock:
+            self.last_active = time.time()
+            if len(self.pool.get(sessid, [])) > 0:
+                return self.pool[sessid].pop(), None
+            resets = self.resets.get(sessid, 0)
+
+        sock = socket.socket()
+        sock.connect(("localhost", get_tmjlink_port(self.cache_folder)))
+        # Commands and payloads go out as separate small writes
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock = BufferedSocket(sock)
+
+        for message in (None, "sessid %s\n" % sessid):
+            if message is not None:
+                sock.send(message)
+            line = sock.readline()
+            if line is None or not line.startswith("okay"):
+                sock.close()
+                return None, line or "exception -- The server quit unexpectedly."
+
+        print "Connected session: %s" % sessid
+        return Upstream(sock, line, resets), None
+
+    def release(self, sessid, upstream):
+        with self.pool_lock:
+            self.last_active = time.time()
+            if self.is_stale(sessid, upstream):
+                upstream.sock.close()
+                return
+            self.pool.setdefault(sessid, []).append(upstream)
+
+    def discard(self, sessid):
+        # The tmjlink.jar that ships binds each connection to the session's
+        # kernel once, and a reset closes that kernel without rebinding them.
+        # Connections made before a reset are dropped instead of reused.
+        with self.pool_lock:
+            self.resets[sessid] = self.resets.get(sessid, 0) + 1
+            upstreams = self.pool.pop(sessid, [])
+        for upstream in upstreams:
+            upstream.sock.close()
+
+    def is_stale(self, sessid, upstream):
+        return upstream.resets != self.resets.get(sessid, 0)
+
+    def close_pool(self):
+        with self.pool_lock:
+            for upstreams in self.pool.values():
+                for upstream in upstreams:
+                    upstream.sock.close()
+            self.pool = {}
+
+    def is_tmjlink_alive(self):
+        try:
+            pidfp = open(os.path.join(self.cache_folder, "tmjlink.pid"), 'r')
+            pid = int(pidfp.read())
+            pidfp.close()
+            os.kill(pid, 0)
+            return True
+        except Exception:
+            return False
+
+    def is_current(self):
+        # A newer broker (or a server relaunch clearing the cache folder) replaced our socket
+        try:
+            return os.stat(self.socket_path).st_ino == self.socket_inode
+        except OSError:
+            return False
+
+    def watch(self):
+        while True:
+            time.sleep(1)
+            if not self.is_tmjlink_alive():
+                print "TextMateJLink server is gone."
+                break
+            if not self.is_current():
+                print "Broker socket was replaced."
+                break
+            if time.time() - self.last_active > IDLE_TIMEOUT:
+                print "Idle for %d seconds." % IDLE_TIMEOUT
+                break
+        self.shutdown()
+
+class BrokerHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        client = BufferedSocket(self.request)
+        sessid = None
+        upstream = None
+        reusable = False
+
+        try:
+            client.send("okay\n")
+
+            while True:
+                line = client.readline()
+                if line is None:
+                    break
+
+                words = line.split(" ")
+
+                if words[0] == "quit":
+                    client.send("okay -- Good Bye\n")
+                    break
+
+                if upstream is None:
+                    if words[0] != "sessid":
+                        client.send("exception -- Invalid command (0): %s\n" % words[0])
+                        continue
+
+                    sessid = line[7:]
+                    upstream, error = self.server.acquire(sessid)
+                    client.send("%s\n" % (error if upstream is None else upstream.sessid_reply))
+                    reusable = upstream is not None
+                    continue
+
+                # A reset since the command before (from this client or
+                # another) leaves the connection on a closed kernel
+                if self.server.is_stale(sessid, upstream):
+                    upstream.sock.close()
+                    upstream, error = self.server.acquire(sessid)
+                    if upstream is None:
+                        raise Exception(error)
+
+                # Forward the command, then relay the server's answer to it
+                reusable = False
+                self.forward(line, client, upstream.sock)
+
+                # A batch is followed by its statements, each answered in
+                # turn before the reply that closes the batch. They are
+                # forwarded from another thread so the batch stays pipelined.
+                if words[0] == "batch":
+                    forwarder = threading.Thread(target=self.forward_batch, args=(int(words[1]), client, upstream.sock))
+                    forwarder.daemon = True
+                    forwarder.start()
+                    for i in xrange(int(words[1])):
+                        self.relay(upstream.sock, client)
+                    forwarder.join()
+
+                self.relay(upstream.sock, client)
+                if words[0] == "reset":
+                    self.server.discard(sessid)
+                reusable = True
+        except socket.error:
+            # Clients checking whether the broker is up hang up without a word
+            if sessid is not None:
+                traceback.print_exc()
+        except Exception:
+            traceback.print_exc()
+
+        if upstream is not None:
+            if reusable:
+                self.server.release(sessid, upstream)
+            else:
+                upstream.sock.close()
+        client.close()
+
+    def forward(self, line, client, upstream):
+        words = line.split(" ")
+        upstream.send(line + "\n")
+        if words[0] in PAYLOAD_COMMANDS:
+            client.relay(int(words[1]), upstream.send)
+
+    def forward_batch(self, count, client, upstream):
+        try:
+            for i in xrange(count):
+                line = client.readline()
+                if line is None:
+                    raise Exception("The client quit in the middle of a batch.")
+                self.forward(line, client, upstream)
+        except Exception:
+            traceback.print_exc()
+            # Wake up the relay, which would otherwise wait for the rest of the batch
+            upstream.sock.shutdown(socket.SHUT_RDWR)
+
+    def relay(self, upstream, client):
+        while True:
+            line = upstream.readline()
+            if line is None:
+                raise Exception("The server quit unexpectedly.")
+
+            words = line.split(" ")
+            if words[0] == "inline":
+                client.send(line + "\n")
+                upstream.relay(int(words[1]), client.send)
+                continue
+
+            client.send(line + "\n")
+            if words[0] in TERMINAL_REPLIES:
+                return
+
+def main():
+    cache_folder = sys.argv[1]
+    socket_path = os.path.join(cache_folder, "broker.sock")
+
+    # Leave a live broker alone, but replace a stale socket file
+    if os.path.exists(socket_path):
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.connect(socket_path)
+            print "Broker already running."
+            return
+        except socket.error:
+            os.remove(socket_path)
+        finally:
+            sock.close()
+
+    broker = Broker(cache_folder)
+    print "Broker started on: %s (pid %d)" % (socket_path, os.getpid())
+    sys.stdout.flush()
+
+    watcher = threading.Thread(target=broker.watch)
+    watcher.daemon = True
+    watcher.start()
+
+    broker.serve_forever()
+    broker.close_pool()
+    if broker.is_current():
+        os.remove(socket_path)
+    print "Broker shut down."
+
+if __name__ == '__main__':
+    main()
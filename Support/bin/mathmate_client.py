@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# Client for the TextMateJLink protocol, shared by the bundle commands, the
+# shim and the broker.
+#
+# A Session is one connection bound to one session ID. Commands are written
+# from a background thread as soon as they are sent, so any number of them can
+# be in flight, and the replies are read back in order. Every read can be given
+# a timeout. Sessions are independent of each other, so one process can drive
+# several at once from separate threads (see run_concurrently).
+import time
+import socket
+import threading
+import collections
+import Queue
+
+from mathmate_trace import TRACE_ENABLED, trace_round_trip
+
+# Replies that end the server's answer to a command
+TERMINAL_REPLIES = ("okay", "exception", "suggestions")
+
+class ServerException(Exception):
+    pass
+
+class ServerTimeout(Exception):
+    pass
+
+class BufferedSocket(object):
+    # Reads the TextMateJLink protocol in large chunks rather than a byte at a
+    # time. Bytes received past the end of a line stay buffered for the next
+    # read, which is usually the payload announced by that line.
+    RECV_SIZE = 65536
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = ""
+        self.offset = 0
+        self.relay_buffer = None
+    
+    def fill(self, size = RECV_SIZE):
+        self.buffer = self.sock.recv(max(size, self.RECV_SIZE))
+        self.offset = 0
+        return self.buffer != ""
+    
+    def readline(self):
+        result = []
+        while True:
+            index = self.buffer.find("\n", self.offset)
+            if index != -1:
+                result.append(self.buffer[self.offset:index])
+                self.offset = index + 1
+                return "".join(result).replace("\r", "")
+            
+            result.append(self.buffer[self.offset:])
+            if not self.fill():
+                return None
+    
+    def readtotal(self, count):
+        result = []
+        total_read = 0
+        
+        while total_read != count:
+            if self.offset == len(self.buffer) and not self.fill(count - total_read):
+                raise Exception("The server quit unexpectedly.")
+            
+            buff = self.buffer[self.offset:self.offset + count - total_read]
+            self.offset += len(buff)
+            result.append(buff)
+            total_read += len(buff)
+        
+        return "".join(result)
+    
+    def relay(self, count, write):
+        # Hand count bytes to write a chunk at a time instead of assembling
+        # them. The chunks are views of a buffer that is reused for the next
+        # one, so memory stays constant however large the payload is.
+        remaining = count
+        if self.offset < len(self.buffer):
+            size = min(remaining, len(self.buffer) - self.offset)
+            write(buffer(self.buffer, self.offset, size))
+            self.offset += size
+            remaining -= size
+        
+        if remaining > 0 and self.relay_buffer is None:
+            self.relay_buffer = bytearray(self.RECV_SIZE)
+        
+        while remaining > 0:
+            size = self.sock.recv_into(self.relay_buffer, min(remaining, self.RECV_SIZE))
+            if size == 0:
+                raise Exception("The server quit unexpectedly.")
+            write(buffer(self.relay_buffer, 0, size))
+            remaining -= size
+    
+    def send(self, data):
+        self.sock.sendall(data)
+    
+    def close(self):
+        self.sock.close()
+
+def parse_reply(line):
+    if line.find(" -- ") != -1:
+        response = line[0:line.find(" -- ")]
+        comment = line[line.find(" -- ")+4:]
+    else:
+        response = line
+        comment = None
+
+    words = response.split(" ")
+    return (line, response, words, comment)
+
+class Session(object):
+    def __init__(self, sock, sessid, timeout = None, batches = True):
+        self.sock = sock
+        self.sessid = sessid
+        self.timeout = timeout
+
+        # Servers built before batches are sent the statements of one a
+        # time, each once the last one succeeded, and whatever was sent after
+        # the batch is held back until it ends. The replies such a server
+        # would send for a batch are made up here.
+        self.batches = batches
+        self.batch = None
+        self.batch_in_flight = False
+        self.replies_ahead = 0
+        self.held = None
+
+        # Replies owed by the server for everything sent so far; the first is
+        # its greeting
+        self.pending = 1
+
+        # With MATHMATE_TRACE, the command, send time and size behind each
+        # reply owed
+        self.in_flight = None
+        if TRACE_ENABLED:
+            self.in_flight = collections.deque([("greeting", time.time(), 0)])
+            self.unanswered_bytes = 0
+
+        self.outgoing = Queue.Queue()
+        self.writer = threading.Thread(target=self.write_outgoing)
+        self.writer.daemon = True
+        self.writer.start()
+
+        self.send("sessid %s" % sessid)
+
+    def write_outgoing(self):
+        while True:
+            data = self.outgoing.get()
+            if data is None:
+                return
+            try:
+                self.sock.send(data)
+            except socket.error:
+                # The reader finds out when the connection ends
+                return
+
+    def send(self, command, payload = "", replies = 1):
+        data = "%s\n%s" % (command, payload)
+        if self.held is not None:
+            self.held.append(data)
+        else:
+            self.outgoing.put(data)
+        self.pending += replies
+        if self.in_flight is not None:
+            self.track(command.split(" ", 1)[0], len(data), replies)
+
+    def track(self, name, size, replies):
+        # Commands without a reply of their own count towards the next one
+        self.unanswered_bytes += size
+        for reply in range(replies):
+            self.in_flight.append((name, time.time(), self.unanswered_bytes))
+            self.unanswered_bytes = 0
+
+    def send_batch(self, command, payloads):
+        # The server answers each statement, then the batch itself
+        if len(payloads) == 0:
+            return
+        if not self.batches:
+            self.start_batch(command, payloads)
+            return
+        self.send("batch %d" % len(payloads), replies=0)
+        for payload in payloads:
+            self.send("%s %d" % (command, len(payload)), payload)
+        self.pending += 1
+        if self.in_flight is not None:
+            self.track("batch", 0, 1)
+
+    def start_batch(self, command, payloads):
+        # Replies owed for what was sent before come first
+        self.replies_ahead = self.pending
+        self.batch = collections.deque()
+        for payload in payloads:
+            data = "%s %d\n%s" % (command, len(payload), payload)
+            self.batch.append(data)
+            if self.in_flight is not None:
+                self.track(command, len(data), 1)
+        self.pending += len(payloads) + 1
+        if self.in_flight is not None:
+            self.track("batch", 0, 1)
+        self.send_next_statement()
+        self.held = collections.deque()
+
+    def send_next_statement(self):
+        self.outgoing.put(self.batch.popleft())
+        self.batch_in_flight = True
+
+    def get_batch_reply(self):
+        # The reply owed for the batch that the server will not send: a
+        # statement skipped after an exception, or the end of the batch
+        if self.batch is None or self.batch_in_flight:
+            return None
+        if len(self.batch) > 0:
+            self.batch.popleft()
+            return "exception -- Skipped after an earlier exception in this batch"
+        self.batch = None
+        for data in self.held:
+            self.outgoing.put(data)
+        self.held = None
+        return "okay -- Batch complete"
+
+    def receive(self, on_inline = None, timeout = None, output = None):
+        # Read up to the next terminal reply. Inline payloads before it are
+        # streamed to the output file, passed to on_inline, or returned with
+        # the reply, in that order of preference.
+        inlines = []
+        received = 0
+        line = self.get_batch_reply()
+        if line is not None:
+            return self.finish(parse_reply(line), inlines, received)
+
+        self.sock.sock.settimeout(timeout if timeout is not None else self.timeout)
+        try:
+            while True:
+                line = self.sock.readline()
+                if line is None:
+                    raise Exception("The server quit unexpectedly.")
+
+                reply = parse_reply(line)
+                line, response, words, comment = reply
+                received += len(line) + 1
+                if words[0] == "inline":
+                    received += int(words[1])
+                if words[0] == "inline" and output is not None:
+                    self.sock.relay(int(words[1]), output.write)
+                    output.flush()
+                    continue
+
+                if words[0] == "inline":
+                    content = self.sock.readtotal(int(words[1]))
+                    if on_inline is not None:
+                        on_inline(content)
+                    else:
+                        inlines.append(content)
+                    continue
+
+                if words[0] not in TERMINAL_REPLIES:
+                    raise Exception("Unexpected message from JLink server: " + line)
+
+                if self.replies_ahead > 0:
+                    self.replies_ahead -= 1
+                elif self.batch_in_flight:
+                    # The rest are skipped after an exception
+                    self.batch_in_flight = False
+                    if response != "exception" and len(self.batch) > 0:
+                        self.send_next_statement()
+                return self.finish(reply, inlines, received)
+        except socket.timeout:
+            self.close()
+            raise ServerTimeout("Timed out waiting for the TextMateJLink server.")
+
+    def finish(self, reply, inlines, received):
+        line, response, words, comment = reply
+        self.pending -= 1
+        if self.in_flight is not None and len(self.in_flight) > 0:
+            name, start, sent = self.in_flight.popleft()
+            trace_round_trip(name, start, sent, received)
+        if response == "exception":
+            raise ServerException("TextMateJLink Exception: " + comment)
+        return reply, inlines
+
+    def receive_all(self, on_inline = None, timeout = None, output = None):
+        # Answers to everything sent so far, in order. An exception reply is
+        # raised once the rest have been read, so the connection ends cleanly.
+        results = []
+        error = None
+        while self.pending > 0:
+            try:
+                results.append(self.receive(on_inline, timeout, output))
+            except ServerException, e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return results
+
+    def request(self, command, payload = "", timeout = None):
+        self.send(command, payload)
+        return self.receive_all(timeout=timeout)[-1]
+
+    def close(self):
+        # Let the writer return first. Left waiting on the queue, it can fail
+        # noisily as the interpreter shuts down.
+        self.outgoing.put(None)
+        self.writer.join(1)
+        self.sock.close()
+
+    def quit(self, timeout = None):
+        self.request("quit", timeout=timeout)
+        self.close()
+
+def run_command(sock, sessid, command, payload = "", timeout = None):
+    # One command in its own session, sent together with the handshake and
+    # the quit. Returns the command's reply and inline payloads.
+    session = Session(sock, sessid, timeout)
+    try:
+        session.send(command, payload)
+        session.send("quit")
+        return session.receive_all()[-2]
+    finally:
+        session.close()
+
+def run_concurrently(tasks):
+    # Run each callable on its own thread and return their results in order.
+    # The first exception raised by a task is raised again here.
+    results = [None] * len(tasks)
+    errors = []
+
+    def run(index, task):
+        try:
+            results[index] = task()
+        except Exception, e:
+            errors.append((index, e))
+
+    threads = [threading.Thread(target=run, args=(index, task)) for index, task in enumerate(tasks)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        raise min(errors)[1]
+    return results
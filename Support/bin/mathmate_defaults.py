@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# MathMate's preferences (the com.wolfram.mathmate defaults domain), read
+# in-process instead of forking `defaults read` once per key. The whole domain
+# is converted once into a JSON cache file, which is trusted for as long as the
+# domain's plist keeps the same mtime. Where there is no defaults system
+# (Linux), the cache file is the store itself.
+#
+# Run as a script it takes the same read/write arguments as `defaults`, which
+# is how the HTML toggles write through to both.
+import os
+import sys
+import json
+import plistlib
+import subprocess
+
+from mathmate_env import MATHMATE_CACHE_FOLDER, write_cache_file
+
+DOMAIN = 'com.wolfram.mathmate'
+
+PREFERENCES_FILE = os.environ.get('MATHMATE_PREFERENCES', os.path.join(MATHMATE_CACHE_FOLDER, "preferences.json"))
+
+def has_defaults():
+    return sys.platform == 'darwin'
+
+def get_plist_mtime():
+    try:
+        return os.path.getmtime(os.path.expanduser("~/Library/Preferences/%s.plist" % DOMAIN))
+    except OSError:
+        return None
+
+def load_preferences_file():
+    try:
+        fp = open(PREFERENCES_FILE, 'r')
+    except IOError:
+        return None
+    try:
+        return json.load(fp)
+    except ValueError:
+        return None
+    finally:
+        fp.close()
+
+def save_preferences_file(plist_mtime, values):
+    write_cache_file(PREFERENCES_FILE, json.dumps({"plist_mtime": plist_mtime, "values": values}))
+
+def export_domain():
+    # One fork for the whole domain, and only after it changed
+    proc = subprocess.Popen(["defaults", "export", DOMAIN, "-"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        return {}
+    return dict((key, str(value)) for key, value in plistlib.readPlistFromString(out).items())
+
+def read_preferences():
+    cached = load_preferences_file()
+    if not has_defaults():
+        return cached["values"] if cached is not None else {}
+
+    plist_mtime = get_plist_mtime()
+    if cached is not None and cached.get("plist_mtime") == plist_mtime:
+        return cached["values"]
+
+    values = export_domain()
+    save_preferences_file(plist_mtime, values)
+    return values
+
+def read_preference(key, default = None):
+    return read_preferences().get(key, default)
+
+def write_preference(key, value):
+    values = dict(read_preferences())
+    values[key] = value
+
+    plist_mtime = None
+    if has_defaults():
+        subprocess.call(["defaults", "write", DOMAIN, key, value])
+        plist_mtime = get_plist_mtime()
+    save_preferences_file(plist_mtime, values)
+
+def main():
+    args = sys.argv[1:]
+
+    if len(args) == 3 and args[0] == "write":
+        write_preference(args[1], args[2])
+        return 0
+
+    if len(args) == 2 and args[0] == "read":
+        value = read_preference(args[1])
+        if value is None:
+            sys.stderr.write("The domain/default pair of (%s, %s) does not exist\n" % (DOMAIN, args[1]))
+            return 1
+        print value
+        return 0
+
+    sys.stderr.write("Usage: mathmate_defaults.py read <key> | write <key> <value>\n")
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
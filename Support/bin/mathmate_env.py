@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# Helpers shared by mathmate.py and the thin entry points in mathmate_shim.py,
+# which must not import mathmate.py: the TextMate environment, exit codes and
+# cache files.
+import os
+import re
+import sys
+import string
+
+# Where the TextMateJLink server keeps its files; cleared when it is launched
+TMJLINK_CACHE_FOLDER = '/tmp/tmjlink'
+
+# Client side caches that must survive a restart of the TextMateJLink server
+MATHMATE_CACHE_FOLDER = '/tmp/mathmate'
+
+VALID_SYMBOL_CHARS = string.ascii_letters + string.digits + "$"
+
+def exit_discard():
+    sys.exit(200)
+
+def exit_replace_text(out = None):
+    if out is not None:
+        sys.stdout.write(out)
+    sys.exit(201)
+
+def exit_replace_document(out = None):
+    if out is not None:
+        sys.stdout.write(out)
+    sys.exit(202)
+
+def exit_insert_text(out = None):
+    if out is not None:
+        sys.stdout.write(out)
+    sys.exit(203)
+
+def exit_insert_snippet(out = None):
+    if out is not None:
+        sys.stdout.write(out)
+    sys.exit(204)
+
+def exit_show_html(out = None):
+    if out is not None:
+        sys.stdout.write(out)
+    sys.exit(205)
+
+def exit_show_tool_tip(out = None):
+    if out is not None:
+        sys.stdout.write(out)
+    sys.exit(206)
+
+def exit_create_new_document(out = None):
+    if out is not None:
+        sys.stdout.write(out)
+    sys.exit(207)
+
+def is_valid_mathematica_symbol(symbol):
+    if len(symbol) == 0:
+        return False
+
+    for char in symbol:
+        if char not in VALID_SYMBOL_CHARS:
+            return False
+    return True
+
+def get_sessid():
+    # One session per file name, without the .m
+    sessid = os.path.split(os.environ.get('TM_FILEPATH', 'mathmate-default'))[-1]
+    if sessid.endswith(".m"):
+        return sessid[:-2]
+    return sessid
+
+def find_line_starts(doc):
+    # Offset of the first character of every line
+    return [0] + [match.end() for match in re.finditer("\n", doc)]
+
+def find_pos(doc, line_starts, line, column):
+    # Offset of a line and column, or the end of the document for positions
+    # outside it
+    if line < 1 or line > len(line_starts) or column < 0:
+        return len(doc)
+
+    # The column may point at the new line ending the line, but not past it
+    if line < len(line_starts):
+        line_length = line_starts[line] - line_starts[line - 1] - 1
+    else:
+        line_length = len(doc) - line_starts[line - 1] - 1
+
+    if column > line_length:
+        return len(doc)
+    return line_starts[line - 1] + column
+
+def find_symbol_at(doc, pos):
+    # The symbol around pos, or "" if there is none
+    start = pos
+    while start > 0 and doc[start - 1] in VALID_SYMBOL_CHARS:
+        start -= 1
+
+    end = pos
+    while end < len(doc) and doc[end] in VALID_SYMBOL_CHARS:
+        end += 1
+
+    return doc[start:end]
+
+def write_cache_file(path, data):
+    # Write to a temporary file first so readers never see a partial file
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    fp = open(tmp_path, 'wb')
+    fp.write(data)
+    fp.close()
+    os.rename(tmp_path, path)
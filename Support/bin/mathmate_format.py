@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# Reformats Mathematica files from the command line with the parser behind
+# the Reformat commands. The indentation is given as options rather than
+# through TM_TAB_SIZE and TM_SOFT_TABS. Files are streamed a statement at a
+# time, so memory stays flat however large they are:
+#
+#   python mathmate_format.py [--indent 2 | --tabs] [--check] [--jobs N] [file or folder ...]
+#
+# Files are rewritten in place, and folders searched for .m files. Without
+# any, standard input is reformatted to standard output. With --check nothing
+# is written; the files that would change are listed and the exit status is 1.
+#
+# Files are spread over a pool of processes, each reformatting many of them.
+# The hashes of files found formatted are kept in /tmp/mathmate/format.cache
+# (--cache to keep it elsewhere, say between CI runs) for each indentation and
+# version of the parser, and files with a known hash are not parsed again.
+import os
+import sys
+import shutil
+import hashlib
+import cPickle
+import optparse
+import multiprocessing
+
+import mathmate
+from mathmate import MathMate, MATHMATE_CACHE_FOLDER
+from mathmate_env import write_cache_file
+
+FORMAT_CACHE_FILE = os.path.join(MATHMATE_CACHE_FOLDER, "format.cache")
+
+# Bytes hashed at a time
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Files handed to a worker at a time
+POOL_CHUNK_SIZE = 8
+
+class Formatter(MathMate):
+    # The reformatting parser alone, without a document, a cursor or the TM_
+    # environment
+    def __init__(self, indent_size = 2, soft_tabs = True):
+        self.indent_size = indent_size
+        self.indent = " " * indent_size if soft_tabs else "\t"
+        self.tmcursor = -1
+        self.parse_tree_level = None
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    fp = open(path, 'rb')
+    try:
+        while True:
+            data = fp.read(HASH_CHUNK_SIZE)
+            if data == "":
+                break
+            digest.update(data)
+    finally:
+        fp.close()
+    return digest.hexdigest()
+
+def reformat_file(formatter, path, check = False):
+    # Returns whether the file changed (or would change, checking) and the
+    # hash of its reformatted text. The output is compared with the file as
+    # it is written, and the file is only replaced when they differ.
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    digest = hashlib.sha1()
+    changed = False
+    input = open(path, 'rb')
+    original = open(path, 'rb')
+    output = None if check else open(tmp_path, 'wb')
+    try:
+        for statement in formatter.iter_reformatted(input):
+            if not changed and original.read(len(statement)) != statement:
+                changed = True
+                if check:
+                    break
+            if output is not None:
+                output.write(statement)
+            digest.update(statement)
+        if not changed and original.read(1) != "":
+            # Trailing white space the parser drops
+            changed = True
+    except:
+        if output is not None:
+            output.close()
+            os.remove(tmp_path)
+        raise
+    finally:
+        input.close()
+        original.close()
+    if output is not None:
+        output.close()
+        if changed:
+            shutil.copymode(path, tmp_path)
+            os.rename(tmp_path, path)
+        else:
+            os.remove(tmp_path)
+    return changed, digest.hexdigest()
+
+def find_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for folder, folders, filenames in os.walk(path):
+            folders.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(".m"):
+                    yield os.path.join(folder, filename)
+
+def get_cache_key(indent_size, soft_tabs):
+    # Formatting changes with the indentation and with the parser itself
+    source = mathmate.__file__
+    if source.endswith(".pyc") or source.endswith(".pyo"):
+        source = source[:-1]
+    return "%d-%s-%s" % (indent_size, "spaces" if soft_tabs else "tabs", hash_file(source))
+
+def load_cache(path):
+    # {cache key: set of hashes of formatted files}
+    try:
+        fp = open(path, 'rb')
+    except IOError:
+        return {}
+    try:
+        try:
+            cache = cPickle.load(fp)
+        except Exception:
+            return {}
+    finally:
+        fp.close()
+    return cache if isinstance(cache, dict) else {}
+
+# Set in each worker by start_worker
+formatter = None
+known_hashes = set()
+check_only = False
+
+def start_worker(indent_size, soft_tabs, known, check):
+    global formatter, known_hashes, check_only
+    formatter = Formatter(indent_size, soft_tabs)
+    known_hashes = known
+    check_only = check
+
+def format_one(path):
+    # (path, status, hash of the formatted text or None, error or None)
+    try:
+        content_hash = hash_file(path)
+        if content_hash in known_hashes:
+            return path, "cached", content_hash, None
+        changed, formatted_hash = reformat_file(formatter, path, check_only)
+        if not changed:
+            return path, "unchanged", content_hash, None
+        if check_only:
+            return path, "would reformat", None, None
+        return path, "reformatted", formatted_hash, None
+    except Exception, e:
+        return path, "error", None, "%s: %s" % (e.__class__.__name__, e)
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options] [file or folder ...]")
+    parser.add_option("--indent", type = "int", default = 2, help = "spaces per indentation level (default 2)")
+    parser.add_option("--tabs", action = "store_true", help = "indent with tabs")
+    parser.add_option("--check", action = "store_true", help = "list the files that would change, and change none")
+    parser.add_option("--jobs", type = "int", default = multiprocessing.cpu_count(),
+        help = "processes to reformat with (default %default)")
+    parser.add_option("--cache", default = FORMAT_CACHE_FILE, metavar = "FILE",
+        help = "hashes of formatted files (default %default)")
+    parser.add_option("--no-cache", action = "store_true", help = "parse every file")
+    parser.add_option("--quiet", action = "store_true", help = "only report errors and the totals")
+    options, args = parser.parse_args()
+
+    soft_tabs = not options.tabs
+    if len(args) == 0:
+        Formatter(options.indent, soft_tabs).reformat_stream(sys.stdin, sys.stdout)
+        return
+
+    key = get_cache_key(options.indent, soft_tabs)
+    cache = {} if options.no_cache else load_cache(options.cache)
+    known = cache.get(key, set())
+
+    paths = list(find_files(args))
+    worker_args = (options.indent, soft_tabs, known, options.check)
+    if options.jobs > 1 and len(paths) > 1:
+        # One parser per worker, set up once rather than once per file
+        pool = multiprocessing.Pool(min(options.jobs, len(paths)), start_worker, worker_args)
+        results = pool.imap_unordered(format_one, paths, POOL_CHUNK_SIZE)
+    else:
+        pool = None
+        start_worker(*worker_args)
+        results = (format_one(path) for path in paths)
+
+    counts = {}
+    formatted = set()
+    for path, status, content_hash, error in results:
+        counts[status] = counts.get(status, 0) + 1
+        if content_hash is not None:
+            formatted.add(content_hash)
+        if status == "error":
+            sys.stderr.write("%s: %s\n" % (path, error))
+        elif status != "unchanged" and status != "cached" and not options.quiet:
+            print "%s %s" % (status, path)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if not options.no_cache and not formatted <= known:
+        # Hashes stored for an older parser can never match again
+        parser_hash = key.split("-")[-1]
+        for stale in [other for other in cache if other.split("-")[-1] != parser_hash]:
+            del cache[stale]
+        cache[key] = known | formatted
+        try:
+            write_cache_file(options.cache, cPickle.dumps(cache, cPickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError):
+            pass
+
+    print "%d files: %s" % (len(paths), ", ".join(["%d %s" % (counts[status], status) for status in
+        ("reformatted", "would reformat", "unchanged", "cached", "error") if status in counts]))
+    if counts.get("error", 0) > 0:
+        sys.exit(2)
+    if counts.get("would reformat", 0) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# Symbol dependency graph of a document, without asking a kernel. Each
+# statement is scanned for the symbols it defines (the targets of =, :=, ^=,
+# ^:=, /: and the assignment operators, and the symbols handed to AppendTo,
+# Clear and the like) and the symbols it references. Built-in symbols, pattern
+# names and the local variables of Module, Table and the like are left out.
+#
+# The graph interns every name once and keeps each statement's symbols as an
+# array of ids, so it pickles small enough to live in the parse cache. It is
+# extended a statement at a time, along with the parse, and truncated back to
+# the first statement an edit touched.
+import re
+import array
+
+from mathmate_symbols import open_symbol_table
+
+TOKEN = re.compile(r"""
+    (?P<string>"(?:\\.|[^"\\])*"?)
+  | (?P<open_comment>\(\*)
+  | (?P<close_comment>\*\))
+  | (?P<named>\\\[[A-Za-z]+\]|::[A-Za-z$][A-Za-z0-9$]*)
+  | (?P<out>%+[0-9]*)
+  | (?P<stream>>>>|>>|<<)
+  | (?P<symbol>[A-Za-z$][A-Za-z0-9$`]*)(?P<blank>_*)
+  | (?P<compare>===|=!=|==|!=|<=|>=)
+  | (?P<assign>\^:=|\^=|:=|=\.|\+=|-=|\*=|/=|/:|=)
+  | (?P<increment>\+\+|--)
+  | (?P<open>[\[{(])
+  | (?P<close>[\]})])
+  | (?P<separator>[,;])
+""", re.X)
+
+# %, %% and %n are read as Out, and the stream operators as their symbols
+STREAM_SYMBOLS = {">>>": "PutAppend", ">>": "Put", "<<": "Get"}
+
+# Symbols localized by their first argument, and by iterator lists after it
+SCOPING_SYMBOLS = set("Module Block With DynamicModule Function Compile".split())
+ITERATING_SYMBOLS = set("""
+    Table Do Sum Product NSum NProduct ParallelTable ParallelDo ParallelSum
+    Plot Plot3D ParametricPlot ParametricPlot3D ContourPlot DensityPlot
+    RegionPlot LogPlot LogLogPlot LogLinearPlot PolarPlot Manipulate Animate
+    Integrate NIntegrate FindRoot FindMinimum FindMaximum NMinimize NMaximize
+    Minimize Maximize NDSolve DSolve Limit Series D
+""".split())
+
+# Built-ins that change their first argument, or all of their arguments
+MUTATING_SYMBOLS = set("""
+    AppendTo PrependTo AddTo SubtractFrom TimesBy DivideBy Increment Decrement
+    PreIncrement PreDecrement Unset AssociateTo KeyDropFrom SetAttributes
+    ClearAttributes SetOptions Set SetDelayed
+""".split())
+CLEARING_SYMBOLS = set("Clear ClearAll Remove Protect Unprotect".split())
+
+_table = None
+_builtins = {}
+
+def is_builtin(name):
+    # The same few names come up over and over
+    global _table
+    if name not in _builtins:
+        if _table is None:
+            _table = open_symbol_table()
+        _builtins[name] = _table.contains(name)
+    return _builtins[name]
+
+def tokenize(text):
+    # Tokens outside comments: kind, value, bracket depth and the enclosing
+    # brackets, as (bracket, head, index of the first token inside) frames
+    tokens = []
+    frames = ()
+    comment_depth = 0
+    for match in TOKEN.finditer(text):
+        kind = match.lastgroup
+        if kind == "blank":
+            kind = "symbol"
+        if kind == "open_comment":
+            comment_depth += 1
+            continue
+        if comment_depth > 0:
+            if kind == "close_comment":
+                comment_depth -= 1
+            continue
+        if kind in ("string", "named", "close_comment", "compare"):
+            continue
+
+        if kind == "symbol":
+            tokens.append(("symbol", match.group("symbol"), frames, match.group("blank") != ""))
+        elif kind == "out":
+            tokens.append(("symbol", "Out", frames, False))
+        elif kind == "stream":
+            tokens.append(("symbol", STREAM_SYMBOLS[match.group(kind)], frames, False))
+        elif kind == "open":
+            tokens.append(("open", match.group(kind), frames, False))
+            head = tokens[-2][1] if len(tokens) > 1 and tokens[-2][0] == "symbol" and match.group(kind) == "[" else None
+            frames = frames + ((match.group(kind), head, len(tokens)),)
+        elif kind == "close":
+            frames = frames[:-1]
+            tokens.append(("close", match.group(kind), frames, False))
+        else:
+            tokens.append((kind, match.group(kind), frames, False))
+    return tokens
+
+def get_segment_start(tokens, index):
+    # The first token of the operand that ends just before tokens[index]
+    frames = tokens[index][2]
+    start = frames[-1][2] if len(frames) > 0 else 0
+    for position in xrange(index - 1, start - 1, -1):
+        kind, value, token_frames, pattern = tokens[position]
+        if token_frames == frames and kind in ("separator", "assign"):
+            return position + 1
+    return start
+
+def get_argument_heads(tokens, start, end, frames):
+    # The first symbol of each element directly inside the bracket that
+    # opens at tokens[start], up to end
+    heads = []
+    expect = True
+    for position in xrange(start + 1, end):
+        kind, value, token_frames, pattern = tokens[position]
+        if len(token_frames) == len(frames) + 1:
+            if kind == "separator":
+                expect = True
+            elif kind == "symbol" and expect:
+                heads.append(position)
+                expect = False
+            elif kind != "open":
+                expect = False
+    return heads
+
+def get_targets(tokens, start, end, unprotected):
+    # Positions of the symbols an assignment to tokens[start:end] defines
+    if start >= end:
+        return []
+    frames = tokens[start][2]
+    if tokens[start][0] == "open" and tokens[start][1] == "{":
+        # {a, b} = ...
+        return get_argument_heads(tokens, start, end, frames)
+
+    symbols = [position for position in xrange(start, end) if tokens[position][0] == "symbol"]
+    if len(symbols) == 0:
+        return []
+    head = symbols[0]
+    if unprotected or not is_builtin(tokens[head][1]):
+        return [head]
+    # Options[f] = ..., N[f[x_]] := ..., Format[f[x_]] := ...
+    for position in symbols:
+        if not tokens[position][3] and not is_builtin(tokens[position][1]):
+            return [position]
+    return []
+
+def find_scope_locals(tokens):
+    # Frames of Module, Table and the like, with the names they localize
+    locals_by_frame = {}
+    for position, (kind, value, frames, pattern) in enumerate(tokens):
+        if kind != "open" or len(frames) == 0:
+            continue
+        bracket, head, first = frames[-1]
+        if bracket != "[" or head not in SCOPING_SYMBOLS and head not in ITERATING_SYMBOLS:
+            continue
+
+        # Which argument of the construct this token starts
+        argument = 0
+        for other in xrange(first, position):
+            if tokens[other][2] == frames and tokens[other][0] == "separator":
+                argument += 1
+        starts_argument = position == first or (tokens[position - 1][2] == frames and tokens[position - 1][0] == "separator")
+        if not starts_argument or value != "{":
+            continue
+        if head in SCOPING_SYMBOLS and argument != 0 or head in ITERATING_SYMBOLS and argument == 0:
+            continue
+
+        # {a, b = 1} declares a and b; {i, 10} and {x, 0, 1} declare i and x
+        end = position + 1
+        while end < len(tokens) and len(tokens[end][2]) > len(frames):
+            end += 1
+        heads = get_argument_heads(tokens, position, end, frames)
+        if head in ITERATING_SYMBOLS:
+            heads = heads[:1]
+        names = locals_by_frame.setdefault(frames[-1], set())
+        names.update(tokens[other][1] for other in heads)
+
+    # Function[x, ...] declares x
+    for position, (kind, value, frames, pattern) in enumerate(tokens):
+        if kind == "symbol" and len(frames) > 0 and frames[-1][1] == "Function" and frames[-1][2] == position:
+            if position + 1 < len(tokens) and tokens[position + 1][0] == "separator":
+                locals_by_frame.setdefault(frames[-1], set()).add(value)
+    return locals_by_frame
+
+def extract_symbols(text, tokens = None):
+    # The names a statement defines and the names it references, from its
+    # tokens if the caller has them already
+    if tokens is None:
+        tokens = tokenize(text)
+    unprotected = any(token[0] == "symbol" and token[1] == "Unprotect" for token in tokens)
+    locals_by_frame = find_scope_locals(tokens)
+    pattern_names = set(token[1] for token in tokens if token[0] == "symbol" and token[3])
+
+    targets = set()
+    replaced = set()
+    tagged = set()
+    for position, (kind, value, frames, pattern) in enumerate(tokens):
+        if kind == "assign":
+            start = get_segment_start(tokens, position)
+            if (start, frames) in tagged:
+                # The definition was attached to the tag already
+                continue
+            if value in ("^=", "^:="):
+                # g[f[x_]] ^:= ... defines f
+                if start < position and tokens[start][0] == "symbol" and position > start + 1:
+                    heads = get_argument_heads(tokens, start + 1, position, frames)
+                    targets.update(head for head in heads if unprotected or not is_builtin(tokens[head][1]))
+                continue
+
+            positions = get_targets(tokens, start, position, unprotected)
+            targets.update(positions)
+            if value in ("=", ":="):
+                replaced.update(positions)
+            if value == "/:":
+                tagged.add((position + 1, frames))
+
+        elif kind == "increment":
+            if position > 0 and tokens[position - 1][0] == "symbol" and tokens[position - 1][2] == frames:
+                targets.add(position - 1)
+            elif position + 1 < len(tokens) and tokens[position + 1][0] == "symbol":
+                targets.add(position + 1)
+
+        elif kind == "open" and value == "[" and position > 0 and tokens[position - 1][0] == "symbol":
+            head = tokens[position - 1][1]
+            if head in MUTATING_SYMBOLS or head in CLEARING_SYMBOLS:
+                end = position + 1
+                while end < len(tokens) and len(tokens[end][2]) > len(frames):
+                    end += 1
+                arguments = [other for other in xrange(position + 1, end) if tokens[other][0] == "symbol"]
+                if head in MUTATING_SYMBOLS:
+                    arguments = arguments[:1]
+                targets.update(other for other in arguments if unprotected or not is_builtin(tokens[other][1]))
+
+    defines = set()
+    references = set()
+    for position, (kind, value, frames, pattern) in enumerate(tokens):
+        if kind != "symbol":
+            continue
+        if any(value in locals_by_frame.get(frame, ()) for frame in frames):
+            continue
+        if position in targets:
+            defines.add(value)
+        if position in replaced or value in pattern_names:
+            continue
+        if unprotected or not is_builtin(value):
+            references.add(value)
+    return defines, references
+
+class SymbolSets(object):
+    # One set of symbol ids per statement, all in one array, with the offset
+    # of each statement's set in a second
+    def __init__(self):
+        self.ids = array.array('I')
+        self.offsets = array.array('I', [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getstate__(self):
+        return (self.ids.tostring(), self.offsets.tostring())
+
+    def __setstate__(self, state):
+        self.ids = array.array('I')
+        self.ids.fromstring(state[0])
+        self.offsets = array.array('I')
+        self.offsets.fromstring(state[1])
+
+    def __getitem__(self, index):
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def append(self, ids):
+        self.ids.extend(ids)
+        self.offsets.append(len(self.ids))
+
+    def truncate(self, count):
+        del self.ids[self.offsets[count]:]
+        del self.offsets[count + 1:]
+
+class DependencyGraph(object):
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.defines = SymbolSets()
+        self.references = SymbolSets()
+
+    def __len__(self):
+        return len(self.defines)
+
+    def __getstate__(self):
+        return (self.names, self.defines, self.references)
+
+    def __setstate__(self, state):
+        self.names, self.defines, self.references = state
+        self.ids = dict((name, number) for number, name in enumerate(self.names))
+
+    def intern(self, names):
+        result = []
+        for name in sorted(names):
+            if name not in self.ids:
+                self.ids[name] = len(self.names)
+                self.names.append(name)
+            result.append(self.ids[name])
+        return result
+
+    def append(self, text):
+        defines, references = extract_symbols(text)
+        self.defines.append(self.intern(defines))
+        self.references.append(self.intern(references))
+
+    def truncate(self, count):
+        # Names stay interned; they cost a few bytes each
+        self.defines.truncate(count)
+        self.references.truncate(count)
+
+    def get_defines(self, index):
+        return set(self.names[number] for number in self.defines[index])
+
+    def get_references(self, index):
+        return set(self.names[number] for number in self.references[index])
+
+    def get_definers(self, index):
+        # The last statement before index to define each name
+        definers = {}
+        for other in xrange(index):
+            for number in self.defines[other]:
+                definers[number] = other
+        return definers
+
+    def get_needs(self, index):
+        # Statements that must have run for statement index to work: the
+        # last definers of what it references, and of what they reference
+        definers = self.get_definers(index)
+        needed = set()
+        pending = list(self.references[index])
+        seen = set()
+        while len(pending) > 0:
+            number = pending.pop()
+            if number in seen:
+                continue
+            seen.add(number)
+            if number in definers:
+                needed.add(definers[number])
+                pending.extend(self.references[definers[number]])
+        return sorted(needed)
+
+    def get_impact(self, index):
+        # Later statements to run again after statement index changes: those
+        # referencing what it defines, and what they define in turn, until
+        # the names are defined again
+        changed = set(self.defines[index])
+        impact = []
+        for other in xrange(index + 1, len(self.defines)):
+            if not changed.isdisjoint(self.references[other]):
+                impact.append(other)
+                changed.update(self.defines[other])
+            else:
+                changed.difference_update(self.defines[other])
+        return impact
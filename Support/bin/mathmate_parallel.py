@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# Runs a document's statements across a pool of kernels. The pool is the
+# session's own kernel plus sibling sessions on the same server, each of which
+# has a kernel of its own. A statement waits only for the earlier statements
+# that define what it uses, use what it defines, or define it too; everything
+# else overlaps. Output is written in document order all the same.
+#
+# Definitions are moved between kernels as compressed
+# Language`ExtendedDefinition expressions. Each one is exported from the kernel
+# that made it right after the statement that made it, installed in any other
+# kernel before a statement there needs it, and installed in the session's own
+# kernel at the end, so that the session is left as if it had run everything.
+import re
+import heapq
+import Queue
+import threading
+
+from mathmate_client import ServerException
+from mathmate_results import analyze_statement, relabel_cells
+from mathmate_graph import tokenize
+
+# Statements naming these change state besides their symbols, so they run in
+# the session's kernel after everything before them and before everything after
+GLOBAL_SYMBOLS = set("""
+    Get Needs BeginPackage EndPackage Begin End SetDirectory ResetDirectory
+    Protect Unprotect SetOptions SetSystemOptions On Off Install Uninstall In
+    Out InString
+""".split())
+
+EXPORT_SYMBOL = 'Compress[ToExpression["%s", InputForm, Language`ExtendedDefinition]]'
+INSTALL = 'Scan[(Language`ExtendedFullDefinition[] = Uncompress[#]) &, {%s}]'
+CLEAR = 'ClearAll["Global`*"]'
+COMPRESSED = re.compile(r'"?([^",{}\s]+)"?')
+
+def analyze_dependencies(statements, symbols):
+    # For each statement: the symbols it names, the ones it may define, the
+    # ones it needs defined (with those their definitions use in turn),
+    # whether it must run in order in the session's kernel, and the earlier
+    # statements it has to wait for. symbols holds the (defines, references)
+    # of each statement, from the document's dependency graph.
+    result = []
+    last_definer = {}
+    readers = {}
+    last_serial = None
+    since_serial = []
+
+    for index, statement in enumerate(statements):
+        named, pure, tainting, loads = analyze_statement(tokenize(statement))
+        serial = loads or not GLOBAL_SYMBOLS.isdisjoint(named)
+        defines, references = symbols[index]
+        names = set(defines) | set(references)
+        defines = set(defines)
+
+        needs = set()
+        pending = list(names)
+        while len(pending) > 0:
+            name = pending.pop()
+            if name in needs:
+                continue
+            needs.add(name)
+            if name in last_definer:
+                definer = result[last_definer[name]]
+                pending.extend(definer[0])
+                # Calling a definition may also set what its body assigns
+                defines.update(definer[1] - set([name]))
+
+        after = set(last_definer[name] for name in needs if name in last_definer)
+        for name in defines:
+            after.update(readers.get(name, []))
+        if serial:
+            after.update(since_serial)
+        if last_serial is not None:
+            after.add(last_serial)
+
+        for name in needs:
+            readers.setdefault(name, []).append(index)
+        for name in defines:
+            last_definer[name] = index
+            readers[name] = []
+        if serial:
+            last_serial = index
+            since_serial = []
+        else:
+            since_serial.append(index)
+
+        result.append((names, defines, needs, serial, after))
+    return result
+
+def parse_exports(inlines):
+    # intexec answers with the list of compressed strings, if anything
+    if len(inlines) == 0:
+        return []
+    return COMPRESSED.findall(inlines[-1].strip())
+
+class Kernel(object):
+    # One session of the pool, driven from its own thread
+    def __init__(self, number, session, command, lookup, completions):
+        self.number = number
+        self.session = session
+        self.command = command
+        self.lookup = lookup
+        self.completions = completions
+        self.tasks = Queue.Queue()
+        self.busy = False
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, code, command = "intexec"):
+        self.session.send("%s %d" % (command, len(code)), code)
+
+    def work(self):
+        # Definitions left over from the last run
+        if self.number > 0:
+            self.request(CLEAR)
+        try:
+            self.session.receive_all()
+        except Exception:
+            pass
+
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            index, statement, installs, exports = task
+            chunks = []
+            exported = []
+            error = None
+
+            try:
+                if len(installs) > 0:
+                    self.request(INSTALL % ", ".join('"%s"' % data for data in installs))
+                    self.session.receive()
+                self.session.send("%s %d" % (self.command, len(statement)), statement)
+                if len(exports) > 0:
+                    self.request("{%s}" % ", ".join(EXPORT_SYMBOL % name for name in exports), self.lookup)
+
+                # The export is answered even after the statement fails
+                try:
+                    self.session.receive(chunks.append)
+                except ServerException, e:
+                    error = e
+                if len(exports) > 0:
+                    reply, inlines = self.session.receive()
+                    exported = parse_exports(inlines)
+            except Exception, e:
+                error = error or e
+            self.completions.put((self, index, "".join(chunks), dict(zip(exports, exported)), error))
+
+class ParallelRun(object):
+    def __init__(self, sessions, command, lookup, statements, symbols, keys, cached, cache, output):
+        self.statements = statements
+        self.keys = keys
+        self.cache = cache
+        self.output = output
+        self.dependencies = analyze_dependencies(statements, symbols)
+
+        self.completions = Queue.Queue()
+        self.kernels = [Kernel(number, session, command, lookup, self.completions) for number, session in enumerate(sessions)]
+
+        # Which kernels hold the latest definition of each symbol, and that
+        # definition compressed, once exported
+        self.holders = {}
+        self.exported = {}
+
+        self.waiting = [len(after) for names, defines, needs, serial, after in self.dependencies]
+        self.dependents = [[] for statement in statements]
+        self.last_need = {}
+        for index, (names, defines, needs, serial, after) in enumerate(self.dependencies):
+            for other in after:
+                self.dependents[other].append(index)
+            for name in needs:
+                self.last_need[name] = index
+
+        self.outputs = dict((index, html) for index, html in enumerate(cached) if html is not None)
+        self.cached = set(self.outputs)
+        self.errors = {}
+        self.next_output = 0
+        self.running = 0
+        self.ready = []
+        for index in range(len(statements)):
+            if self.waiting[index] == 0:
+                heapq.heappush(self.ready, index)
+
+    def run(self):
+        while True:
+            if len(self.errors) == 0:
+                self.dispatch()
+            self.write_outputs()
+            if self.running == 0:
+                break
+            self.complete(*self.completions.get())
+
+        missing = self.synchronize()
+        for kernel in self.kernels:
+            kernel.tasks.put(None)
+        for kernel in self.kernels:
+            kernel.thread.join()
+        if len(self.errors) > 0:
+            raise self.errors[min(self.errors)]
+        if len(missing) > 0:
+            raise Exception("Definitions of %s could not be copied into the session's kernel." % ", ".join(missing))
+
+    def dispatch(self):
+        deferred = []
+        while len(self.ready) > 0:
+            index = heapq.heappop(self.ready)
+            if index in self.cached:
+                # Replayed from the results cache; it defines nothing
+                self.finish(index)
+                continue
+
+            kernels = self.get_kernels(index)
+            if len(kernels) == 0:
+                names, defines, needs, serial, after = self.dependencies[index]
+                self.errors[index] = Exception("No kernel holds every definition statement %d needs (%s); some could not be copied between kernels." % (
+                    index, ", ".join(sorted(name for name in needs if name in self.holders and name not in self.exported))))
+                break
+            kernel = self.choose_kernel(index, kernels)
+            if kernel is None:
+                deferred.append(index)
+                continue
+            self.start(index, kernel)
+
+        for index in deferred:
+            heapq.heappush(self.ready, index)
+
+    def get_kernels(self, index):
+        # The kernels the statement can run in. A definition that could not
+        # be exported is only in the kernel that made it.
+        names, defines, needs, serial, after = self.dependencies[index]
+        kernels = self.kernels
+        if serial:
+            kernels = [kernel for kernel in kernels if kernel.number == 0]
+        for name in needs:
+            if name in self.holders and name not in self.exported:
+                kernels = [kernel for kernel in kernels if kernel.number in self.holders[name]]
+        return kernels
+
+    def choose_kernel(self, index, kernels):
+        # The free kernel already holding most of what the statement needs
+        names, defines, needs, serial, after = self.dependencies[index]
+        free = [kernel for kernel in kernels if not kernel.busy]
+        if len(free) == 0:
+            return None
+        def held(kernel):
+            return sum(1 for name in needs if kernel.number in self.holders.get(name, ()))
+        return max(free, key=lambda kernel: (held(kernel), -kernel.number))
+
+    def start(self, index, kernel):
+        names, defines, needs, serial, after = self.dependencies[index]
+        installs = []
+        for name in sorted(needs):
+            # get_kernels only allows kernels without a definition that was exported
+            holders = self.holders.get(name)
+            if holders is not None and kernel.number not in holders:
+                installs.append(self.exported[name])
+                holders.add(kernel.number)
+
+        # The session's kernel keeps its own definitions; the others hand
+        # theirs back at the end
+        exports = sorted(name for name in defines if kernel.number > 0 or self.last_need.get(name, index) > index)
+
+        kernel.busy = True
+        self.running += 1
+        kernel.tasks.put((index, self.statements[index], installs, exports))
+
+    def complete(self, kernel, index, html, exported, error):
+        kernel.busy = False
+        self.running -= 1
+        if error is not None:
+            self.errors[index] = error
+            return
+
+        if self.keys[index] is not None:
+            self.cache.store(self.keys[index], html)
+        if kernel.number > 0:
+            html = relabel_cells(html, "kernel%d" % kernel.number)
+        self.outputs[index] = html
+
+        names, defines, needs, serial, after = self.dependencies[index]
+        for name in defines:
+            self.holders[name] = set([kernel.number])
+            if name in exported:
+                self.exported[name] = exported[name]
+            else:
+                self.exported.pop(name, None)
+        self.finish(index)
+
+    def finish(self, index):
+        for other in self.dependents[index]:
+            self.waiting[other] -= 1
+            if self.waiting[other] == 0:
+                heapq.heappush(self.ready, other)
+
+    def write_outputs(self):
+        # In document order, up to the first statement that failed
+        while self.next_output in self.outputs:
+            self.output.write(self.outputs.pop(self.next_output))
+            self.output.flush()
+            self.next_output += 1
+
+    def synchronize(self):
+        # Leave the session's kernel with every definition made elsewhere.
+        # Returns the names of those that were not exported.
+        elsewhere = sorted(name for name, holders in self.holders.items() if 0 not in holders)
+        installs = [self.exported[name] for name in elsewhere if name in self.exported]
+        if len(installs) > 0:
+            session = self.kernels[0].session
+            code = INSTALL % ", ".join('"%s"' % data for data in installs)
+            session.send("intexec %d" % len(code), code)
+            session.receive_all()
+        return [name for name in elsewhere if name not in self.exported]
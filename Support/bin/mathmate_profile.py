@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# Opt-in profiling of bundle commands as TextMate runs them. With
+# MATHMATE_PROFILE=YES the command runs under cProfile from the moment
+# mathmate.py or mathmate_shim.py is imported, and on exit the profile is
+# written to /tmp/tmjlink/profiles (MATHMATE_PROFILE_FOLDER to put it
+# elsewhere) as <command>--<document>--<time>-<pid>.prof. The TM_ variables
+# the command ran with are saved next to it, in a .json file of the same
+# name, so that the invocation can be reproduced.
+#
+# Support/tools/profile_summary.py merges profiles into a hot function table.
+import os
+import re
+import sys
+import time
+import atexit
+
+from mathmate_trace import get_command
+
+PROFILE_ENABLED = os.environ.get('MATHMATE_PROFILE') == "YES"
+PROFILE_FOLDER = os.environ.get('MATHMATE_PROFILE_FOLDER', '/tmp/tmjlink/profiles')
+
+UNSAFE_NAME_CHARS = re.compile(r"[^A-Za-z0-9._-]+")
+
+profiler = None
+
+def get_profile_name():
+    document = os.path.basename(os.environ.get('TM_FILEPATH', 'untitled'))
+    name = "%s--%s--%s-%d" % (get_command(), document, time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+    return UNSAFE_NAME_CHARS.sub("_", name)
+
+def start_profiling():
+    global profiler
+    if not PROFILE_ENABLED or profiler is not None:
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    atexit.register(save_profile)
+    profiler.enable()
+
+def save_profile():
+    import json
+    profiler.disable()
+    try:
+        if not os.path.exists(PROFILE_FOLDER):
+            os.makedirs(PROFILE_FOLDER)
+        path = os.path.join(PROFILE_FOLDER, get_profile_name())
+        profiler.dump_stats(path + ".prof")
+
+        environment = dict((key, value) for key, value in os.environ.items() if key.startswith("TM_"))
+        fp = open(path + ".json", 'w')
+        json.dump({"command": get_command(), "argv": sys.argv, "environment": environment}, fp, indent=2, sort_keys=True)
+        fp.close()
+    except (IOError, OSError):
+        pass
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# Results cache for pure statements, so that running a document again only
+# sends the kernel what changed. A statement is pure when it assigns nothing
+# and calls nothing with side effects; its output is then determined by its
+# text and by the definitions of the symbols it uses. The key is the
+# statement's reformatted text plus a fingerprint of those definitions, taken
+# from the statements before it in the document. A definition's fingerprint
+# includes the fingerprints of the symbols it uses in turn, so editing a
+# definition misses every statement that depends on it, however indirectly.
+#
+# Entries are folders under /tmp/mathmate/results holding the statement's HTML
+# and copies of its images. The least recently used are removed once the
+# folder grows past MATHMATE_RESULTS_CACHE_MB megabytes.
+import os
+import re
+import shutil
+import hashlib
+
+from mathmate_env import MATHMATE_CACHE_FOLDER
+from mathmate_graph import tokenize, extract_symbols
+
+RESULTS_FOLDER = os.path.join(MATHMATE_CACHE_FOLDER, "results")
+
+RESULTS_CACHE_SIZE = int(float(os.environ.get('MATHMATE_RESULTS_CACHE_MB', '64')) * 1024 * 1024)
+
+# Built-ins whose result depends on more than their arguments, or that change
+# something besides their result
+IMPURE_SYMBOLS = set("""
+    Set SetDelayed UpSet UpSetDelayed TagSet TagSetDelayed Unset Clear ClearAll
+    Remove SetAttributes ClearAttributes Protect Unprotect SetOptions AppendTo
+    PrependTo AddTo SubtractFrom TimesBy DivideBy Increment Decrement
+    PreIncrement PreDecrement Get Needs Put PutAppend Import Export Save
+    DumpSave Read ReadList ReadLine OpenRead OpenWrite OpenAppend Close Write
+    WriteString Print Message Echo Run RunProcess StartProcess Install
+    Uninstall LinkWrite LinkRead Input InputString Pause Abort Quit Exit
+    Begin End BeginPackage EndPackage SetDirectory ResetDirectory CreateFile
+    DeleteFile CopyFile RenameFile CreateDirectory DeleteDirectory URLFetch
+    URLExecute URLRead URLDownload URLSave Random RandomReal RandomInteger
+    RandomComplex RandomChoice RandomSample RandomVariate RandomPrime
+    RandomGraph RandomImage SeedRandom Date DateList DateString DateObject Now
+    Today AbsoluteTime SessionTime TimeUsed Timing AbsoluteTiming
+    RepeatedTiming MemoryInUse MaxMemoryUsed In Out InString Dynamic Refresh
+    On Off SetSystemOptions SetEnvironment Environment Share ParallelEvaluate
+    LaunchKernels CloseKernels DistributeDefinitions SetSharedVariable
+""".split())
+
+# Statements that load code define symbols nothing else in the document names
+LOADING_SYMBOLS = set(["Get", "Needs", "BeginPackage", "Install", "DumpGet"])
+
+def analyze_statement(tokens):
+    # Returns the symbols a statement names, built-ins included, whether it is
+    # pure, whether its side effects may reach callers of what it defines,
+    # and whether it loads code. The tokens are those of mathmate_graph.
+    symbols = set(value for kind, value, frames, pattern in tokens if kind == "symbol")
+    impure_symbols = symbols & IMPURE_SYMBOLS
+    assignments = [frames for kind, value, frames, pattern in tokens if kind in ("assign", "increment")]
+    nested_assignments = [frames for frames in assignments if len(frames) > 0]
+
+    pure = len(assignments) == 0 and len(impure_symbols) == 0
+    pure = pure and not any(symbol.startswith("$") for symbol in symbols)
+    # A definition whose body assigns or has side effects makes every later
+    # use of what it defines impure too
+    tainting = len(assignments) > 0 and (len(nested_assignments) > 0 or len(impure_symbols - set(["Set", "SetDelayed"])) > 0)
+    loads = len(symbols & LOADING_SYMBOLS) > 0
+    return symbols, pure, tainting, loads
+
+def hash_parts(*parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part)
+        digest.update("\0")
+    return digest.hexdigest()
+
+def get_statement_keys(statements, salt):
+    # One key per statement, or None for statements that must run. Every
+    # statement in the document is walked, in order, so definitions made
+    # before the ones being run are accounted for.
+    definitions = {}
+    tainted = set()
+    environment = ""
+    keys = []
+
+    for statement in statements:
+        text = statement.strip()
+        if text == "":
+            keys.append(None)
+            continue
+
+        tokens = tokenize(text)
+        symbols, pure, tainting, loads = analyze_statement(tokens)
+        defines, references = extract_symbols(text, tokens)
+        names = sorted(defines | references)
+        fingerprint = hash_parts(environment, *["%s=%s" % (name, definitions.get(name, "")) for name in names])
+
+        if pure and tainted.isdisjoint(names):
+            keys.append(hash_parts(salt, text, fingerprint))
+            continue
+        keys.append(None)
+
+        # Anything named here may have been (re)defined by it
+        if not pure:
+            definition = hash_parts(text, fingerprint)
+            for name in names:
+                definitions[name] = definition
+            if tainting or not tainted.isdisjoint(names):
+                tainted.update(names)
+            if loads:
+                environment = definition
+
+    return keys
+
+class RecordingOutput(object):
+    # Passes writes through to the output, keeping a copy while recording
+    def __init__(self, output):
+        self.output = output
+        self.chunks = None
+
+    def write(self, data):
+        self.output.write(data)
+        if self.chunks is not None:
+            self.chunks.append(str(data))
+
+    def flush(self):
+        self.output.flush()
+
+    def start(self):
+        self.chunks = []
+
+    def stop(self):
+        data = "".join(self.chunks)
+        self.chunks = None
+        return data
+
+IMAGE_SOURCE = re.compile(r"src='file://([^']+)'")
+CELL_LABEL = re.compile(r"resource_(\d+)|toggle\((\d+)\)")
+
+def relabel_cells(html, label):
+    # Cells rendered by another kernel, or in another run, must not clash
+    # with the ids of the cells the server renders now
+    def relabel(match):
+        if match.group(1) is not None:
+            return "resource_%s_%s" % (label, match.group(1))
+        return "toggle(&quot;%s_%s&quot;)" % (label, match.group(2))
+    return CELL_LABEL.sub(relabel, html)
+
+class ResultsCache(object):
+    def __init__(self, folder = RESULTS_FOLDER, max_size = RESULTS_CACHE_SIZE):
+        self.folder = folder
+        self.max_size = max_size
+        self.replayed = 0
+
+    def get_entry_path(self, key):
+        return os.path.join(self.folder, key)
+
+    def load(self, key):
+        entry = self.get_entry_path(key)
+        try:
+            fp = open(os.path.join(entry, "output.html"), 'rb')
+            html = fp.read()
+            fp.close()
+            # Most recently used
+            os.utime(entry, None)
+        except (IOError, OSError):
+            return None
+
+        self.replayed += 1
+        return relabel_cells(html, "cached%d" % self.replayed)
+
+    def store(self, key, html):
+        entry = self.get_entry_path(key)
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        tmp_entry = "%s.%d.tmp" % (entry, os.getpid())
+        os.mkdir(tmp_entry)
+
+        # Images live in the server's cache folder, which a restart wipes
+        def copy_image(match):
+            path = match.group(1)
+            if not os.path.isfile(path):
+                return match.group(0)
+            name = os.path.basename(path)
+            shutil.copyfile(path, os.path.join(tmp_entry, name))
+            return "src='file://%s'" % os.path.join(entry, name)
+
+        fp = open(os.path.join(tmp_entry, "output.html"), 'wb')
+        fp.write(IMAGE_SOURCE.sub(copy_image, html))
+        fp.close()
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Stored meanwhile by another command
+            shutil.rmtree(tmp_entry, True)
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.folder):
+            entry = os.path.join(self.folder, name)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                continue
+            total_size += size
+
+        entries.sort()
+        for mtime, size, entry in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, True)
+            total_size -= size
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# Thin entry points for interactive commands (Show Symbol Value, Command
+# Completion). They send their request straight to the broker's warm
+# connection instead of importing mathmate.py and parsing the document. When
+# no broker is running they fall back to MathMate, which also starts one.
+import os
+import re
+import sys
+import bisect
+import string
+import socket
+import cPickle
+
+from mathmate_profile import start_profiling
+start_profiling()
+
+from mathmate_env import TMJLINK_CACHE_FOLDER, VALID_SYMBOL_CHARS, write_cache_file, get_sessid
+from mathmate_env import find_line_starts, find_pos, find_symbol_at, is_valid_mathematica_symbol
+from mathmate_env import exit_discard, exit_insert_text, exit_show_tool_tip
+from mathmate_client import BufferedSocket, run_command
+from mathmate_trace import trace_command
+from mathmate_symbols import open_symbol_table
+
+SUGGESTION_NAME = re.compile(r'"([^"]*)"')
+
+class BrokerUnavailable(Exception):
+    pass
+
+def get_cursor(doc):
+    return find_pos(doc, find_line_starts(doc), int(os.environ.get('TM_LINE_NUMBER')), int(os.environ.get('TM_LINE_INDEX')))
+
+def get_current_symbol(doc):
+    if os.environ.get('TM_SELECTED_TEXT') is not None:
+        return os.environ.get('TM_SELECTED_TEXT')
+    return find_symbol_at(doc, get_cursor(doc))
+
+def get_completion_prefix(doc, cursor):
+    start = cursor
+    while start > 0 and doc[start - 1] in VALID_SYMBOL_CHARS:
+        start -= 1
+    return doc[start:cursor].lstrip(string.digits)
+
+def parse_suggestions(reply):
+    # "suggestions [generation] ["Name",...]" -> (generation, sorted names).
+    # The shipped tmjlink.jar sends no generation, and the names every time.
+    words = reply.split(" ", 2)
+    generation = words[1] if len(words) == 3 else None
+    return generation, sorted(set(SUGGESTION_NAME.findall(reply)))
+
+def get_completion_index_path(sessid):
+    return os.path.join(TMJLINK_CACHE_FOLDER, "completion", sessid)
+
+def load_completion_index(sessid):
+    # The names the server last suggested for the session, and the generation
+    # of the session's definitions they came from
+    try:
+        fp = open(get_completion_index_path(sessid), 'rb')
+    except IOError:
+        return None, []
+    try:
+        return cPickle.load(fp)
+    except Exception:
+        return None, []
+    finally:
+        fp.close()
+
+def save_completion_index(sessid, generation, names):
+    write_cache_file(get_completion_index_path(sessid), cPickle.dumps((generation, names), cPickle.HIGHEST_PROTOCOL))
+
+def is_server_running():
+    try:
+        pidfp = open(os.path.join(TMJLINK_CACHE_FOLDER, "tmjlink.pid"), 'r')
+        pid = int(pidfp.read())
+        pidfp.close()
+        os.kill(pid, 0)
+        return True
+    except (IOError, ValueError, OSError):
+        return False
+
+def request(command, payload = ""):
+    # Run one command on the broker. Returns the final reply line and the
+    # inline payloads that preceded it.
+    if os.environ.get('MATHMATE_BROKER') == "NO":
+        raise BrokerUnavailable()
+
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(os.path.join(TMJLINK_CACHE_FOLDER, "broker.sock"))
+    except socket.error:
+        sock.close()
+        raise BrokerUnavailable()
+
+    reply, inlines = run_command(BufferedSocket(sock), get_sessid(), command, payload)
+    return reply[0], inlines
+
+def get_lookup_command():
+    # As MathMate.get_lookup_command, once MathMate has asked the server
+    try:
+        if open(os.path.join(TMJLINK_CACHE_FOLDER, "tmjlink.lookups")).read() == "yes":
+            return "lookup"
+    except IOError:
+        pass
+    return "intexec"
+
+def fallback(doc):
+    from mathmate import MathMate
+    return MathMate(doc=doc)
+
+def show_symbol_value():
+    trace_command("show symbol value")
+    doc = sys.stdin.read()
+    symbol = get_current_symbol(doc)
+    if not is_valid_mathematica_symbol(symbol):
+        exit_show_tool_tip("Invalid Symbol: %s" % symbol)
+
+    try:
+        reply, inlines = request("%s %d" % (get_lookup_command(), len(symbol)), symbol)
+        result = inlines[-1] if len(inlines) > 0 else None
+    except BrokerUnavailable:
+        result = fallback(doc).execute(symbol)
+
+    if result is None:
+        exit_show_tool_tip("%s is Null" % symbol)
+    else:
+        exit_show_tool_tip("%s = %s" % (symbol, result))
+
+def complete():
+    trace_command("complete")
+    doc = sys.stdin.read()
+
+    # The server only sends the names when the session changed since the index was saved
+    sessid = get_sessid()
+    generation, names = load_completion_index(sessid)
+    try:
+        reply, inlines = request("suggest %s" % (generation or "-"))
+    except BrokerUnavailable:
+        # Without a running server there are only the built-in symbols, and
+        # they don't need a kernel
+        if not is_server_running():
+            show_suggestions(get_completion_prefix(doc, get_cursor(doc)), [])
+        return fallback(doc).suggest()
+
+    if reply.startswith("suggestions"):
+        generation, names = parse_suggestions(reply)
+        if generation is not None:
+            save_completion_index(sessid, generation, names)
+
+    show_suggestions(get_completion_prefix(doc, get_cursor(doc)), names)
+
+def show_suggestions(fnname, names):
+    # names is sorted, so the matches are one contiguous run. They are merged
+    # with the built-in symbols, which are there even before a kernel is.
+    start = bisect.bisect_left(names, fnname)
+    end = bisect.bisect_right(names, fnname + "\xff", start)
+    suggestions = set(open_symbol_table().match_prefix(fnname))
+    suggestions.update(names[start:end])
+    suggestions.discard("?")
+    suggestions = sorted(suggestions)
+
+    if len(suggestions) == 0:
+        exit_show_tool_tip("No suggestions.")
+
+    if len(suggestions) == 1:
+        exit_insert_text(suggestions[0][len(fnname):])
+
+    import plistlib
+    import subprocess
+
+    data = {}
+    data['suggestions'] = map(lambda x: {'display': x}, suggestions)
+
+    command = [os.environ.get('DIALOG'), "popup", "--alreadyTyped", fnname]
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    proc.stdin.write(plistlib.writePlistToString(data))
+    proc.stdin.close()
+
+    out = proc.stdout.read()
+    if out != "":
+        exit_show_tool_tip(out)
+    exit_discard()
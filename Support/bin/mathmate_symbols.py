@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Completion of built-in symbols without a kernel. Support/tools/symbols.json
+# is compiled once into a compact table: the names sorted and concatenated into
+# one blob, preceded by an array of their offsets. The table is memory-mapped
+# and binary-searched in place, so a lookup only reads the names it touches.
+#
+# Run as a script to (re)compile the table.
+import os
+import json
+import mmap
+import array
+import struct
+
+from mathmate_env import MATHMATE_CACHE_FOLDER, write_cache_file
+
+SYMBOLS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools", "symbols.json")
+
+TABLE_FILE = os.path.join(MATHMATE_CACHE_FOLDER, "symbols.table")
+
+# Magic, then the number of names, then count + 1 offsets into the blob
+MAGIC = "MMSYMTB1"
+HEADER_SIZE = len(MAGIC) + 4
+
+class SymbolTable(object):
+    def __init__(self, path):
+        fp = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a symbol table: %s" % path)
+        self.count = struct.unpack_from("=I", self.data, len(MAGIC))[0]
+        self.blob_start = HEADER_SIZE + 4 * (self.count + 1)
+
+    def get_offset(self, index):
+        return self.blob_start + struct.unpack_from("=I", self.data, HEADER_SIZE + 4 * index)[0]
+
+    def get_name(self, index):
+        return self.data[self.get_offset(index):self.get_offset(index + 1)]
+
+    def bisect(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_name(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def contains(self, name):
+        index = self.bisect(name)
+        return index < self.count and self.get_name(index) == name
+
+    def match_prefix(self, prefix):
+        start = self.bisect(prefix)
+        end = self.bisect(prefix + "\xff")
+        return [self.get_name(index) for index in xrange(start, end)]
+
+def compile_symbol_table(symbols_file = SYMBOLS_FILE, table_file = TABLE_FILE):
+    fp = open(symbols_file, 'r')
+    functions, symbols = json.load(fp)
+    fp.close()
+
+    names = sorted(set(name.encode('ascii') for name in functions + symbols))
+    offsets = array.array('I', [0])
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+
+    write_cache_file(table_file, MAGIC + struct.pack("=I", len(names)) + offsets.tostring() + "".join(names))
+    return len(names)
+
+def open_symbol_table():
+    # Compiled on first use, and again whenever symbols.json is newer
+    try:
+        if os.path.getmtime(TABLE_FILE) >= os.path.getmtime(SYMBOLS_FILE):
+            return SymbolTable(TABLE_FILE)
+    except (EnvironmentError, ValueError):
+        pass
+
+    compile_symbol_table()
+    return SymbolTable(TABLE_FILE)
+
+def main():
+    count = compile_symbol_table()
+    print "Compiled %d symbols into %s" % (count, TABLE_FILE)
+
+if __name__ == '__main__':
+    main()
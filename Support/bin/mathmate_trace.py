@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Opt-in timing of what a bundle command spends its time on. With
+# MATHMATE_TRACE=YES each command appends one JSON record to
+# /tmp/mathmate/trace.jsonl (MATHMATE_TRACE_FILE to put it elsewhere) when it
+# exits: the command, its phases (import, parse, launch, connect, ...) and
+# every protocol round trip with the bytes sent and received. Without it
+# every call here returns at once.
+#
+# Support/tools/trace_summary.py reports percentiles per command.
+import os
+import sys
+import time
+import atexit
+
+from mathmate_env import MATHMATE_CACHE_FOLDER
+
+TRACE_ENABLED = os.environ.get('MATHMATE_TRACE') == "YES"
+TRACE_FILE = os.environ.get('MATHMATE_TRACE_FILE', os.path.join(MATHMATE_CACHE_FOLDER, "trace.jsonl"))
+
+class Phase(object):
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, kind, value, tb):
+        self.trace.phases.append({"name": self.name, "start": self.start - self.trace.start,
+            "seconds": time.time() - self.start, "failed": kind is not None})
+        return False
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, tb):
+        return False
+
+NULL_PHASE = NullPhase()
+
+class Trace(object):
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+        self.round_trips = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        atexit.register(self.write)
+
+    def write(self):
+        import json
+        record = {
+            "command": get_command(),
+            "pid": os.getpid(),
+            "time": self.start,
+            "seconds": time.time() - self.start,
+            "phases": self.phases,
+            "round_trips": self.round_trips,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+        }
+        try:
+            folder = os.path.dirname(TRACE_FILE)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            # One write to a file opened for appending, so records from
+            # commands exiting together do not interleave
+            fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            os.write(fd, json.dumps(record, sort_keys=True) + "\n")
+            os.close(fd)
+        except (IOError, OSError):
+            pass
+
+trace = Trace() if TRACE_ENABLED else None
+command = None
+
+def trace_command(name):
+    # The first command named is the one the process runs
+    global command
+    if command is None:
+        command = name
+
+def get_command():
+    return command or os.path.basename(sys.argv[0] or "python")
+
+def trace_phase(name):
+    if trace is None:
+        return NULL_PHASE
+    return Phase(trace, name)
+
+def trace_since(name, start):
+    # A phase timed by hand, which may have begun before this module was
+    # imported
+    if trace is not None:
+        if start < trace.start:
+            for entry in trace.phases + trace.round_trips:
+                entry["start"] += trace.start - start
+            trace.start = start
+        trace.phases.append({"name": name, "start": start - trace.start,
+            "seconds": time.time() - start, "failed": False})
+
+def trace_round_trip(command, start, sent, received):
+    if trace is not None:
+        trace.round_trips.append({"command": command, "start": start - trace.start,
+            "seconds": time.time() - start, "sent": sent, "received": received})
+        trace.bytes_sent += sent
+        trace.bytes_received += received
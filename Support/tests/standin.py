@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# Runs Support/tools/tmjlink_standin.py, and the broker in front of it if
+# asked, in a temporary cache folder of their own, for tests that talk to a
+# server.
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+BIN = os.path.join(TESTS, "..", "bin")
+TOOLS = os.path.join(TESTS, "..", "tools")
+
+sys.path.insert(0, BIN)
+from mathmate import MathMate, get_tmjlink_port
+from mathmate_client import BufferedSocket
+
+# Seconds to wait for the stand-in or the broker to start listening
+STARTUP_TIMEOUT = 10
+
+class Standin(object):
+    def __init__(self, *options):
+        self.folder = tempfile.mkdtemp(prefix="mathmate-test-")
+        self.processes = []
+        self.start("tmjlink.log", os.path.join(TOOLS, "tmjlink_standin.py"), *options)
+        self.port = get_tmjlink_port(self.folder, STARTUP_TIMEOUT)
+
+    def start(self, log, script, *options):
+        logfp = open(os.path.join(self.folder, log), 'w')
+        self.processes.append(subprocess.Popen([sys.executable, "-u", script] + list(options) + [self.folder],
+            stdout=logfp, stderr=subprocess.STDOUT))
+        logfp.close()
+
+    def start_broker(self):
+        self.start("broker.log", os.path.join(BIN, "mathmate_broker.py"))
+        deadline = time.time() + STARTUP_TIMEOUT
+        while True:
+            try:
+                self.connect_broker().close()
+                return
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.01)
+
+    def connect(self):
+        return BufferedSocket(socket.create_connection(("localhost", self.port)))
+
+    def connect_broker(self):
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.connect(os.path.join(self.folder, "broker.sock"))
+        except socket.error:
+            sock.close()
+            raise
+        return BufferedSocket(sock)
+
+    def open_mathmate(self, doc = ""):
+        # A command's MathMate, as TextMate would run it with the cursor at
+        # the start of doc, that uses the stand-in instead of launching a server
+        os.environ.update(TM_TAB_SIZE="2", TM_SOFT_TABS="YES", TM_LINE_NUMBER="1", TM_LINE_INDEX="0")
+        mathmate = MathMate(doc = doc)
+        mathmate.cacheFolder = self.folder
+        mathmate.launch_tmjlink = lambda: None
+        return mathmate
+
+    def read_log(self, log):
+        fp = open(os.path.join(self.folder, log), 'r')
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+
+    def close(self):
+        for process in reversed(self.processes):
+            process.terminate()
+            process.wait()
+        shutil.rmtree(self.folder, True)
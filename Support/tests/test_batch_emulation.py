@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Batches sent to a server without them, one statement at a time, against the
+# stand-in in --legacy mode.
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate_client import Session, ServerException
+from standin import Standin
+
+class BatchEmulationTest(unittest.TestCase):
+    def setUp(self):
+        self.standin = Standin("--legacy")
+        self.session = Session(self.standin.connect(), "test", 10, batches = False)
+
+    def tearDown(self):
+        self.session.quit()
+        self.standin.close()
+
+    def receive_replies(self):
+        # Every reply owed, exceptions included, as the lines the server sent
+        # or the session made up. The first two answer the greeting and sessid.
+        replies = []
+        while self.session.pending > 0:
+            try:
+                reply, inlines = self.session.receive()
+                replies.append(reply[0])
+            except ServerException, e:
+                replies.append(str(e))
+        return replies
+
+    def lookup(self, symbol):
+        reply, inlines = self.session.request("intexec %d" % len(symbol), symbol)
+        return inlines
+
+    def test_batch(self):
+        self.session.send_batch("execute", ["a = 1", "b = 2"])
+        replies = self.receive_replies()
+        self.assertEqual(replies[2:], ["okay", "okay", "okay -- Batch complete"])
+        self.assertEqual(self.lookup("b"), ["2\n"])
+
+    def test_skipped_after_exception(self):
+        self.session.send_batch("execute", ["a = 1", "Abort[]", "b = 2", "c = 3"])
+        replies = self.receive_replies()
+        self.assertEqual(replies[2:], ["okay",
+            "TextMateJLink Exception: $Aborted",
+            "TextMateJLink Exception: Skipped after an earlier exception in this batch",
+            "TextMateJLink Exception: Skipped after an earlier exception in this batch",
+            "okay -- Batch complete"])
+        # The skipped statements never reached the server
+        self.assertEqual(self.lookup("a"), ["1\n"])
+        self.assertEqual(self.lookup("c"), [])
+
+    def test_held_until_batch_ends(self):
+        # Sent right away, the lookup would overtake the statements
+        self.session.send_batch("execute", ["Pause[0.2]", "b = 2"])
+        self.session.send("intexec 1", "b")
+        self.assertEqual(list(self.session.held), ["intexec 1\nb"])
+        results = []
+        while self.session.pending > 0:
+            results.append(self.session.receive())
+        self.assertEqual(self.session.held, None)
+        self.assertEqual(results[-2][0][0], "okay -- Batch complete")
+        self.assertEqual(results[-1][1], ["2\n"])
+
+    def test_held_after_exception(self):
+        self.session.send_batch("execute", ["Abort[]", "b = 2"])
+        self.session.send("execute 5", "c = 3")
+        replies = self.receive_replies()
+        self.assertEqual(replies[-2:], ["okay -- Batch complete", "okay"])
+        self.assertEqual(self.lookup("b"), [])
+        self.assertEqual(self.lookup("c"), ["3\n"])
+
+    def test_replies_ahead(self):
+        # Replies owed before the batch are read first, without sending the
+        # next statement
+        self.session.send("execute 5", "a = 1")
+        self.session.send_batch("execute", ["b = a", "c = 3"])
+        replies = self.receive_replies()
+        self.assertEqual(replies[2:], ["okay", "okay", "okay", "okay -- Batch complete"])
+        self.assertEqual(self.lookup("c"), ["3\n"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# The broker against the legacy stand-in, which like the shipped jar leaves
+# connections opened before a reset on the closed kernel.
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate import MathMate
+from mathmate_client import Session, ServerException, run_command
+from standin import Standin
+
+class BrokerResetTest(unittest.TestCase):
+    def setUp(self):
+        self.standin = Standin("--legacy")
+        self.standin.start_broker()
+
+    def tearDown(self):
+        self.standin.close()
+
+    def execute(self, sock, statement):
+        return run_command(sock, "test", "execute %d" % len(statement), statement)
+
+    def test_legacy_reset(self):
+        # What the broker works around: the connection that was open keeps
+        # the closed kernel
+        session = Session(self.standin.connect(), "test")
+        session.request("execute 5", "x = 1")
+        run_command(self.standin.connect(), "test", "reset")
+        self.assertRaises(ServerException, session.request, "execute 1", "x")
+        session.quit()
+
+    def test_pooled_after_reset(self):
+        self.execute(self.standin.connect_broker(), "x = 1")
+        run_command(self.standin.connect_broker(), "test", "reset")
+        reply, inlines = self.execute(self.standin.connect_broker(), "x")
+        self.assertEqual(reply[1], "okay")
+
+    def test_open_session_after_reset(self):
+        session = Session(self.standin.connect_broker(), "test")
+        session.request("execute 5", "x = 1")
+        run_command(self.standin.connect_broker(), "test", "reset")
+        reply, inlines = session.request("execute 1", "x")
+        self.assertEqual(reply[1], "okay")
+        session.quit()
+
+class BrokerLaunchTest(unittest.TestCase):
+    def setUp(self):
+        self.standin = Standin("--legacy")
+
+    def tearDown(self):
+        self.standin.close()
+
+    def test_launched_once(self):
+        # Checking for batches connects a second time, before the broker the
+        # session's connection started is listening
+        mathmate = self.standin.open_mathmate()
+        MathMate.broker_launched = False
+        mathmate.open_session().quit()
+
+        deadline = time.time() + 10
+        while "Broker" not in self.standin.read_log("broker.log") and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.5)
+        self.assertEqual(self.standin.read_log("broker.log").count("Broker "), 1)
+
+    def test_probes_are_quiet(self):
+        # Clients that only check whether the broker is up hang up before
+        # the greeting
+        self.standin.start_broker()
+        for i in range(20):
+            self.standin.connect_broker().close()
+        run_command(self.standin.connect_broker(), "test", "execute 1", "x")
+        time.sleep(0.1)
+        self.assertNotIn("Traceback", self.standin.read_log("broker.log"))
+
+if __name__ == '__main__':
+    unittest.main()
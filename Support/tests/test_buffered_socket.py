@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# BufferedSocket against a fake socket that hands out data in fixed chunks, so
+# lines and payloads fall across recv boundaries.
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate_client import BufferedSocket
+
+class FakeSocket(object):
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+        self.receives = 0
+
+    def next_chunk(self, size):
+        self.receives += 1
+        if len(self.chunks) == 0:
+            return ""
+        chunk = self.chunks.pop(0)
+        if len(chunk) > size:
+            self.chunks.insert(0, chunk[size:])
+        return chunk[:size]
+
+    def recv(self, size):
+        return self.next_chunk(size)
+
+    def recv_into(self, target, size):
+        chunk = self.next_chunk(size)
+        target[:len(chunk)] = chunk
+        return len(chunk)
+
+class BufferedSocketTest(unittest.TestCase):
+    def test_readline_across_chunks(self):
+        sock = BufferedSocket(FakeSocket("ok", "ay -", "- Session\r", "\nnext\nla", "st"))
+        self.assertEqual(sock.readline(), "okay -- Session")
+        self.assertEqual(sock.readline(), "next")
+        # A last line without its new line is lost with the connection
+        self.assertEqual(sock.readline(), None)
+
+    def test_readtotal_buffered(self):
+        fake = FakeSocket("inline 3\nabcokay\n")
+        sock = BufferedSocket(fake)
+        self.assertEqual(sock.readline(), "inline 3")
+        self.assertEqual(sock.readtotal(3), "abc")
+        self.assertEqual(sock.readline(), "okay")
+        self.assertEqual(fake.receives, 1)
+
+    def test_readtotal_across_chunks(self):
+        sock = BufferedSocket(FakeSocket("inline 10\nabcd", "efg", "hij\nokay\n"))
+        self.assertEqual(sock.readline(), "inline 10")
+        self.assertEqual(sock.readtotal(10), "abcdefghij")
+        self.assertEqual(sock.readline(), "")
+        self.assertEqual(sock.readline(), "okay")
+
+    def test_readtotal_cut_short(self):
+        sock = BufferedSocket(FakeSocket("inline 10\nabc"))
+        sock.readline()
+        self.assertRaises(Exception, sock.readtotal, 10)
+
+    def test_relay_partly_buffered(self):
+        fake = FakeSocket("inline 10\nabcd", "efg", "hij", "okay\n")
+        sock = BufferedSocket(fake)
+        sock.RECV_SIZE = 2
+        chunks = []
+        self.assertEqual(sock.readline(), "inline 10")
+        sock.relay(10, lambda chunk: chunks.append(str(chunk)))
+        # What was buffered first, then recv_into the reused buffer
+        self.assertEqual(chunks, ["abcd", "ef", "g", "hi", "j"])
+        self.assertEqual(sock.readline(), "okay")
+
+    def test_relay_buffered_payload(self):
+        fake = FakeSocket("inline 3\nabcokay\n")
+        sock = BufferedSocket(fake)
+        chunks = []
+        sock.readline()
+        sock.relay(3, lambda chunk: chunks.append(str(chunk)))
+        self.assertEqual(chunks, ["abc"])
+        self.assertEqual(sock.readline(), "okay")
+        self.assertEqual(fake.receives, 1)
+
+    def test_relay_cut_short(self):
+        sock = BufferedSocket(FakeSocket("inline 10\nabc", "de"))
+        sock.readline()
+        self.assertRaises(Exception, sock.relay, 10, lambda chunk: None)
+
+if __name__ == '__main__':
+    unittest.main()
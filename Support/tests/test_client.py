@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Session, run_command and run_concurrently end to end, against the stand-in.
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate_client import Session, ServerException, ServerTimeout, run_command, run_concurrently
+from standin import Standin
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.standin = Standin()
+
+    def tearDown(self):
+        self.standin.close()
+
+    def execute(self, sessid, statement, timeout = None):
+        return run_command(self.standin.connect(), sessid, "execute %d" % len(statement), statement, timeout)
+
+    def test_run_command(self):
+        reply, inlines = self.execute("test", "x = 1")
+        self.assertEqual(reply[1], "okay")
+        self.assertEqual(len(inlines), 1)
+        self.assertTrue("x = 1" in inlines[0])
+
+    def test_batch_with_exception(self):
+        session = Session(self.standin.connect(), "test", 10)
+        session.send_batch("execute", ["a = 1", "Abort[]", "b = 2"])
+        try:
+            session.receive_all()
+            self.fail("expected the exception")
+        except ServerException, e:
+            self.assertEqual(str(e), "TextMateJLink Exception: $Aborted")
+        self.assertEqual(session.pending, 0)
+
+        # The session carries on after the batch, without b
+        reply, inlines = session.request("intexec 1", "a")
+        self.assertEqual(inlines, ["1\n"])
+        reply, inlines = session.request("intexec 1", "b")
+        self.assertEqual(inlines, [])
+        session.quit()
+
+    def test_timeout(self):
+        session = Session(self.standin.connect(), "test", 0.2)
+        session.send("execute 8", "Pause[2]")
+        start = time.time()
+        self.assertRaises(ServerTimeout, session.receive_all)
+        self.assertTrue(time.time() - start < 1.5)
+
+    def test_concurrent_sessions(self):
+        start = time.time()
+        results = run_concurrently([lambda: self.execute("first", "Pause[0.5]"),
+            lambda: self.execute("second", "Pause[0.5]")])
+        self.assertTrue(time.time() - start < 0.9)
+        self.assertEqual([reply[1] for reply, inlines in results], ["okay", "okay"])
+
+        # Each session has its own definitions
+        run_concurrently([lambda: self.execute("first", "x = 1"), lambda: self.execute("second", "x = 2")])
+        for sessid, value in (("first", "1\n"), ("second", "2\n")):
+            reply, inlines = run_command(self.standin.connect(), sessid, "intexec 1", "x")
+            self.assertEqual(inlines, [value])
+
+    def test_concurrent_exception(self):
+        # The first task's exception is raised, once every task has finished
+        finished = []
+        def slow():
+            reply = self.execute("second", "Pause[0.3]")
+            finished.append(True)
+            return reply
+        try:
+            run_concurrently([lambda: self.execute("first", "Abort[]"), slow])
+            self.fail("expected the exception")
+        except ServerException, e:
+            self.assertEqual(str(e), "TextMateJLink Exception: $Aborted")
+        self.assertEqual(finished, [True])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# The generation of a session's definitions changes with what may change them,
+# and not with lookups.
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate_client import Session
+from mathmate_shim import parse_suggestions
+from standin import Standin
+
+class GenerationTest(unittest.TestCase):
+    def setUp(self):
+        self.standin = Standin()
+        self.session = Session(self.standin.connect(), "test")
+        self.session.request("execute 5", "x = 1")
+
+    def tearDown(self):
+        self.session.quit()
+        self.standin.close()
+
+    def get_generation(self):
+        reply, inlines = self.session.request("suggest -")
+        return parse_suggestions(reply[0])[0]
+
+    def assertUnchanged(self, command, payload):
+        generation = self.get_generation()
+        self.session.request("%s %d" % (command, len(payload)), payload)
+        reply, inlines = self.session.request("suggest %s" % generation)
+        self.assertEqual(reply[2][0], "okay")
+
+    def assertChanged(self, command, payload = ""):
+        generation = self.get_generation()
+        self.session.request(command if payload == "" else "%s %d" % (command, len(payload)), payload)
+        reply, inlines = self.session.request("suggest %s" % generation)
+        self.assertEqual(reply[2][0], "suggestions")
+
+    def test_lookup(self):
+        self.assertUnchanged("lookup", "x")
+        reply, inlines = self.session.request("lookup 1", "x")
+        self.assertEqual(inlines, ["1\n"])
+
+    def test_changes(self):
+        self.assertChanged("execute", "y = 2")
+        self.assertChanged("image", "y = 2")
+        self.assertChanged("intexec", "x")
+        self.assertChanged("reset")
+
+class LookupProbeTest(unittest.TestCase):
+    def test_probe(self):
+        for options, lookups in (((), True), (("--legacy",), False)):
+            standin = Standin(*options)
+            try:
+                mathmate = standin.open_mathmate()
+                self.assertEqual(mathmate.supports_lookups(), lookups)
+                self.assertEqual(mathmate.get_lookup_command(), "lookup" if lookups else "intexec")
+            finally:
+                standin.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# What extract_symbols finds a statement defines and references.
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate_graph import extract_symbols, DependencyGraph
+
+class ExtractSymbolsTest(unittest.TestCase):
+    def assertSymbols(self, text, defines, references):
+        self.assertEqual(extract_symbols(text), (set(defines), set(references)))
+
+    def test_function_definitions(self):
+        # Pattern names are neither defined nor referenced
+        self.assertSymbols("f[x_] := x + a", ["f"], ["a"])
+        self.assertSymbols("f[x_, y_] := g[x] + y", ["f"], ["g"])
+        self.assertSymbols("x = x + 1", ["x"], ["x"])
+        self.assertSymbols("f /: g[f[x_]] := x", ["f"], ["f", "g"])
+
+    def test_scoping_locals(self):
+        self.assertSymbols("Module[{t = 1, u}, t + u + v]", [], ["v"])
+        self.assertSymbols("Block[{w}, w = 1; z]", [], ["z"])
+        self.assertSymbols("Table[i + j, {i, 3}, {j, n}]", [], ["n"])
+        self.assertSymbols("Function[x, x + m]", [], ["m"])
+        # Outside the construct the name is global again
+        self.assertSymbols("Module[{t}, t]; t = 2", ["t"], [])
+
+    def test_string_literals(self):
+        self.assertSymbols('s = "x = y + q"', ["s"], [])
+        self.assertSymbols('h["a\\"b = c"] := k', ["h"], ["k"])
+
+    def test_comments(self):
+        self.assertSymbols("r = 1 (* p = 2; q *)", ["r"], [])
+        self.assertSymbols("r = 1 (* (* nested *) p = 2 *) + s", ["r"], ["s"])
+
+    def test_builtins(self):
+        self.assertSymbols("AppendTo[lst, e1]", ["lst"], ["lst", "e1"])
+        self.assertSymbols("Plot[Sin[x], {x, 0, 1}]", [], [])
+        self.assertSymbols("Unprotect[Sin]; Sin[1] = 2", ["Sin"], ["Sin", "Unprotect"])
+
+    def test_graph(self):
+        graph = DependencyGraph()
+        for text in ("a = 1", "f[x_] := x + a", "b = f[2]", "a = 3", "c = b"):
+            graph.append(text)
+        self.assertEqual(graph.get_needs(2), [0, 1])
+        self.assertEqual(graph.get_impact(0), [1, 2, 4])
+
+if __name__ == '__main__':
+    unittest.main()
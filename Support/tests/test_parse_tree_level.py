@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# The parse tree level is the scope at the cursor as parsing the document
+# found it, whatever is reformatted afterwards.
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate import MathMate
+
+DOC = "a = 1\nf[x_] := Module[{y}, x + y]\nb = {2,\n 3}\n"
+
+class ParseTreeLevelTest(unittest.TestCase):
+    def open_mathmate(self, line, column):
+        os.environ.update(TM_TAB_SIZE="2", TM_SOFT_TABS="YES", TM_LINE_NUMBER=str(line), TM_LINE_INDEX=str(column))
+        return MathMate(doc = DOC)
+
+    def test_levels(self):
+        self.assertEqual(self.open_mathmate(2, 2).parse_tree_level, "root.function")
+        self.assertEqual(self.open_mathmate(4, 1).parse_tree_level, "root.list")
+
+    def test_reformat_keeps_level(self):
+        mathmate = self.open_mathmate(2, 2)
+        mathmate.parse_tree_level = "recorded"
+        mathmate.format_statements(mathmate.statements)
+        self.assertEqual([statement.formatted for statement in mathmate.statements],
+            ["a = 1\n", "f[x_] := Module[{y}, x + y]\n", "b = {2, \n  3}\n"])
+        self.assertEqual(mathmate.parse_tree_level, "recorded")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Line and column lookups through the line start table, against the
+# character-by-character scans they replaced.
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate import MathMate
+from mathmate_env import find_line_starts, find_pos
+
+DOCS = ["a", "\n", "ab\ncd", "ab\ncd\n", "ab\n\ncd\n\n", "x = 1;\r\ny = {1,\n  2}\n(* c *)"]
+
+def scan_pos(doc, line, column):
+    line_index = 1
+    line_pos = 0
+    for pos, char in enumerate(doc):
+        if line == line_index and column == pos - line_pos:
+            return pos
+        if char == "\n":
+            line_index += 1
+            line_pos = pos + 1
+    return len(doc)
+
+def scan_line_col(doc, posq):
+    line_index = 1
+    line_pos = 0
+    for pos, char in enumerate(doc):
+        if posq == pos:
+            return (line_index, pos - line_pos)
+        if char == "\n":
+            line_index += 1
+            line_pos = pos + 1
+    return (line_index, pos - line_pos)
+
+class PositionsTest(unittest.TestCase):
+    def setUp(self):
+        os.environ.update(TM_TAB_SIZE="2", TM_SOFT_TABS="YES", TM_LINE_NUMBER="1", TM_LINE_INDEX="0")
+        self.mathmate = MathMate(doc = "")
+
+    def set_doc(self, doc):
+        self.mathmate.doc = doc
+        self.mathmate.line_starts = None
+
+    def test_find_pos(self):
+        for doc in DOCS + [""]:
+            self.set_doc(doc)
+            line_starts = find_line_starts(doc)
+            for line in range(-1, doc.count("\n") + 3):
+                for column in range(-1, len(doc) + 2):
+                    expected = scan_pos(doc, line, column)
+                    self.assertEqual(find_pos(doc, line_starts, line, column), expected, (doc, line, column))
+                    self.assertEqual(self.mathmate.get_pos(line, column), expected, (doc, line, column))
+
+    def test_get_line_col(self):
+        # The scan failed on an empty document
+        for doc in DOCS:
+            self.set_doc(doc)
+            for pos in range(-2, len(doc) + 2):
+                self.assertEqual(self.mathmate.get_line_col(pos), scan_line_col(doc, pos), (doc, pos))
+
+    def test_round_trip(self):
+        for doc in DOCS:
+            self.set_doc(doc)
+            for pos in range(len(doc)):
+                self.assertEqual(self.mathmate.get_pos(*self.mathmate.get_line_col(pos)), pos)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# Streamed reformatting, chunk by chunk, against reformatting the whole text.
+import os
+import sys
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate_format import Formatter
+
+class ReformatStreamTest(unittest.TestCase):
+    def assertStreamed(self, doc):
+        formatter = Formatter(2, True)
+        expected = "".join(statement.formatted for statement in formatter.parse(doc, reformat = True))
+        for chunk_size in (1, 2, 7, 4096):
+            output = StringIO.StringIO()
+            formatter.reformat_stream(StringIO.StringIO(doc), output, chunk_size = chunk_size)
+            self.assertEqual(output.getvalue(), expected, "chunk size %d" % chunk_size)
+
+    def test_statements(self):
+        self.assertStreamed("a = 1;  b = 2; (* x *) c\n-d\n")
+        self.assertStreamed("f[x_] :=\n  x +\n    1\n(* c *)  ")
+
+    def test_split_after_unbalanced_bracket(self):
+        # The chunk ends inside the statement after the "]" or "}", which is
+        # spaced according to what comes before it on the line
+        self.assertStreamed("a]-b +\n  c\nd\n")
+        self.assertStreamed("f[x]}x +\n  y\n")
+        self.assertStreamed("x = 1]  -y +\n  z\n")
+
+if __name__ == '__main__':
+    unittest.main()
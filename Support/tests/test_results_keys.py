@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# Which statements the results cache may replay, computed as inline does.
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate import MathMate
+
+class ResultsKeysTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ.update(TM_TAB_SIZE="2", TM_SOFT_TABS="YES", TM_LINE_NUMBER="1", TM_LINE_INDEX="0")
+        for name in ("TM_FILEPATH", "TM_SELECTED_TEXT"):
+            os.environ.pop(name, None)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def get_keys(self, doc, selected = False):
+        if selected:
+            os.environ["TM_SELECTED_TEXT"] = doc
+        mm = MathMate(doc = doc)
+        statements = [statement.rstrip() for statement in mm.get_current_statements(process_entire_document = True)]
+        return mm.get_results_keys(mm.get_statement_indexes(statements))
+
+    def test_redefinition_changes_key(self):
+        before = self.get_keys("x = 1\nx\n")
+        after = self.get_keys("x = 2\nx\n")
+        self.assertEqual(before[0], None)
+        self.assertNotEqual(before[1], None)
+        self.assertNotEqual(before[1], after[1])
+
+    def test_scoped_names(self):
+        # The iterator is local to Table, so its global value does not matter
+        before = self.get_keys("i = 1\nTable[i^2, {i, 3}]\n")
+        after = self.get_keys("i = 2\nTable[i^2, {i, 3}]\n")
+        self.assertNotEqual(before[1], None)
+        self.assertEqual(before[1], after[1])
+
+    def test_out_is_impure(self):
+        self.assertEqual(self.get_keys("1 + 1\n% + 1\n")[1], None)
+
+    def test_selection_after_redefinition(self):
+        # x is redefined on its own, then read in another selection that
+        # cannot see the new definition
+        self.assertEqual(self.get_keys("x = 1\n", selected = True), [None])
+        self.assertEqual(self.get_keys("x\n", selected = True), [None])
+        self.assertEqual(self.get_keys("x = 2\n", selected = True), [None])
+        self.assertEqual(self.get_keys("x\n", selected = True), [None])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,12 +28,19 @@ public class Resources implements PacketListener {
 	private ArrayList<Resources.Resource> resources = null;
 	private Session session;
 	
+	// Changes whenever the session's definitions may have changed, and never
+	// repeats within the lifetime of the server (or across restarts)
+	private static final long generationEpoch = System.currentTimeMillis();
+	private static long lastGeneration = 0;
+	private String generation = null;
+	
 	public Resources(String sessionId, String cacheFolder, String[] mlargs) 
 			throws MathLinkException, IOException {
 		this.sessionId = sessionId;
 		this.cacheFolder = cacheFolder;
 		this.mlargs = mlargs;
 		this.resources = new ArrayList<Resources.Resource>();
+		this.generation = nextGeneration();
 		
 		// Allocate the kernel link and register packet listener
 		kernelLink = MathLinkFactory.createKernelLink(mlargs);
@@ -47,6 +54,15 @@ public class Resources implements PacketListener {
 		sessionFolderPointer.mkdir();
 	}
 	
+	private static synchronized String nextGeneration() {
+		lastGeneration++;
+		return generationEpoch + "." + lastGeneration;
+	}
+	
+	public String getGeneration() {
+		return generation;
+	}
+	
 	public static boolean delete(File file) {
 		if (file.isDirectory()) {
 			for (File child : file.listFiles()) {
@@ -148,7 +164,9 @@ public class Resources implements PacketListener {
 		return result.toString();
 	}
 	
-	public String evaluate(String query) throws MathLinkException, IOException {
+	public String evaluate(String query, boolean changesDefinitions) throws MathLinkException, IOException {
+		if (changesDefinitions)
+			generation = nextGeneration();
 		kernelLink.evaluate(query);
 		kernelLink.waitForAnswer();
 		Expr result = kernelLink.getExpr();
@@ -162,6 +180,7 @@ public class Resources implements PacketListener {
 			throws MathLinkException, IOException {
 		long mark = System.currentTimeMillis();
 		this.session = session;
+		generation = nextGeneration();
 		
 		session.sendInline("<div id='resource_" + currentCount + "' class='cellgroup'>");
 		
@@ -1,5 +1,7 @@
 package com.shadanan.textmatejlink;
 
+import java.io.File;
+import java.io.FileWriter;
 import java.io.IOException;
 import java.net.ServerSocket;
 import java.net.Socket;
@@ -39,6 +41,8 @@ public class Server extends Thread {
 			ServerSocket ss = new ServerSocket(0);
 			ss.setSoTimeout(1000);
 			System.out.println("Server started on port: " + ss.getLocalPort());
+			writePortFile(ss.getLocalPort());
+			notifyLauncher(ss.getLocalPort());
 			
 			while (running) {
 				try {
@@ -99,6 +103,32 @@ public class Server extends Thread {
 		System.out.println("Server shut down.");
 	}
 	
+	private void writePortFile(int port) throws IOException {
+		// Written under a temporary name and renamed so readers never see a partial file
+		File portFile = new File(cacheFolder, "tmjlink.port");
+		File tempFile = new File(cacheFolder, "tmjlink.port.tmp");
+		FileWriter writer = new FileWriter(tempFile);
+		writer.write(port + "\n");
+		writer.close();
+		if (!tempFile.renameTo(portFile)) {
+			throw new IOException("Could not write port file: " + portFile);
+		}
+	}
+	
+	private void notifyLauncher(int port) {
+		// The launcher blocks on this socket until the server is listening
+		String notifyPort = System.getProperty("textmatejlink.notify");
+		if (notifyPort == null) return;
+		
+		try {
+			Socket socket = new Socket("localhost", Integer.parseInt(notifyPort));
+			socket.getOutputStream().write((port + "\n").getBytes());
+			socket.close();
+		} catch (IOException e) {
+			e.printStackTrace();
+		}
+	}
+	
 	public boolean isRunning() {
 		return running;
 	}
@@ -128,6 +158,12 @@ public class Server extends Thread {
 		return resources;
 	}
 	
+	public Resources findResources(String sessionId) {
+		synchronized (sessionsLock) {
+			return resourcesMap.get(sessionId);
+		}
+	}
+	
 	public Resources newResources(String sessionId) throws MathLinkException, IOException {
 		Resources resources = resourcesMap.get(sessionId);
 		if (resources != null) {
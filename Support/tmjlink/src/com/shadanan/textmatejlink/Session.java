@@ -18,6 +18,10 @@ public class Session extends Thread {
 	private boolean running = false;
 	private Resources resources = null;
 	
+	// Statements left in the current batch, and whether one of them failed
+	private int batchRemaining = 0;
+	private boolean batchFailed = false;
+	
 	public Session(Server server, Socket socket) {
 		this.server = server;
 		this.socket = socket;
@@ -47,10 +51,17 @@ public class Session extends Thread {
 	}
 	
 	private void resetResources() throws MathLinkException, IOException {
-		server.newResources(resources.getSessionId());
+		resources = server.newResources(resources.getSessionId());
 		System.out.println("Resetting Resources with Session ID: " + resources.getSessionId());
 	}
 	
+	private void refreshResources() {
+		// Connections are kept open between commands, so another connection may
+		// have reset this session's resources since the last command
+		Resources current = server.findResources(resources.getSessionId());
+		if (current != null) resources = current;
+	}
+	
 	private String readLine(InputStreamReader in) {
 		StringBuilder line = new StringBuilder();
 		
@@ -86,6 +97,8 @@ public class Session extends Thread {
 	
 	private String readData(InputStreamReader in, int size) {
 		StringBuilder line = new StringBuilder();
+		if (size == 0)
+			return "";
 		
 		while (running && server.isRunning()) {
 			try {
@@ -122,6 +135,29 @@ public class Session extends Thread {
 		out.println(reply);
 	}
 	
+	private void evaluateStatement(String data, boolean evalToImage) {
+		if (batchFailed) {
+			send("exception -- Skipped after an earlier exception in this batch");
+		} else {
+			try {
+				resources.evaluate(data, evalToImage, this);
+				send("okay");
+			} catch (Exception e) {
+				send("exception -- " + e.getMessage());
+				e.printStackTrace();
+				batchFailed = batchRemaining > 0;
+			}
+		}
+		
+		if (batchRemaining > 0) {
+			batchRemaining--;
+			if (batchRemaining == 0) {
+				batchFailed = false;
+				send("okay -- Batch complete");
+			}
+		}
+	}
+	
 	@Override
   public void run() {
 		try {
@@ -133,6 +169,7 @@ public class Session extends Thread {
 		}
 		
 		int state = 0;
+		boolean changesDefinitions = true;
 		int readsize = -1;
 		send("okay");
 		
@@ -194,6 +231,8 @@ public class Session extends Thread {
 			}
 			
 			if (state == 1) {
+				refreshResources();
+				
 				if (command.equals("quit")) {
 					send("okay -- Good Bye");
 					running = false;
@@ -212,6 +251,13 @@ public class Session extends Thread {
 					continue;
 				}
 				
+				if (command.equals("batch")) {
+					batchRemaining = Integer.parseInt(args);
+					batchFailed = false;
+					if (batchRemaining == 0) send("okay -- Batch complete");
+					continue;
+				}
+				
 				if (command.equals("header")) {
 					try {
 						String renderedHtml = resources.render();
@@ -248,8 +294,15 @@ public class Session extends Thread {
 				
 				if (command.equals("suggest")) {
 					try {
-						String suggestions = resources.getSuggestions();
-						send("suggestions " + suggestions);
+						// Clients that keep a completion index pass the generation they have
+						String generation = resources.getGeneration();
+						if (args == null) {
+							send("suggestions " + resources.getSuggestions());
+						} else if (args.equals(generation)) {
+							send("okay -- Unchanged generation: " + generation);
+						} else {
+							send("suggestions " + generation + " " + resources.getSuggestions());
+						}
 					} catch (MathLinkException e) {
 						send("exception -- " + e.getMessage());
 						e.printStackTrace();
@@ -260,7 +313,9 @@ public class Session extends Thread {
 					continue;
 				}
 				
-				if (command.equals("intexec")) {
+				if (command.equals("intexec") || command.equals("lookup")) {
+					// Lookups only read definitions, and keep the generation
+					changesDefinitions = command.equals("intexec");
 					readsize = Integer.parseInt(args);
 					state = 4;
 					continue;
@@ -271,13 +326,7 @@ public class Session extends Thread {
 			}
 			
 			if (state == 2) {
-				try {
-					resources.evaluate(data, false, this);
-					send("okay");
-				} catch (Exception e) {
-					send("exception -- " + e.getMessage());
-					e.printStackTrace();
-				}
+				evaluateStatement(data, false);
 				
 				readsize = -1;
 				state = 1;
@@ -285,13 +334,7 @@ public class Session extends Thread {
 			}
 			
 			if (state == 3) {
-				try {
-					resources.evaluate(data, true, this);
-					send("okay");
-				} catch (Exception e) {
-					send("exception -- " + e.getMessage());
-					e.printStackTrace();
-				}
+				evaluateStatement(data, true);
 				
 				readsize = -1;
 				state = 1;
@@ -300,7 +343,7 @@ public class Session extends Thread {
 			
 			if (state == 4) {
 				try {
-					String result = resources.evaluate(data);
+					String result = resources.evaluate(data, changesDefinitions);
 					if (result != null) sendInline(result);
 					send("okay");
 				} catch (Exception e) {
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# Drives many concurrent sessions against a TextMateJLink server and reports
+# the client's round trip latency and throughput. By default it starts the
+# stand-in server in a folder of its own, passing it the latency, payload and
+# failure options; with --cache-folder it uses the server (and broker) already
+# running there instead.
+#
+#   python bench_load.py --sessions 16 --requests 200 --latency 0.005
+#   python bench_load.py --command image --batch 10 --fail-rate 0.01 --json -
+#
+# Each round trip sends --batch statements as one batch, or a single command
+# when --batch is 1, and waits for every answer. A failed statement counts as
+# an error; a dropped connection counts as a drop, after which the session
+# reconnects.
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import optparse
+
+TOOLS_PATH = os.path.dirname(os.path.abspath(__file__))
+BIN_PATH = os.path.join(TOOLS_PATH, "..", "bin")
+sys.path.insert(0, BIN_PATH)
+from mathmate import get_tmjlink_port
+from mathmate_client import BufferedSocket, Session, ServerException, ServerTimeout
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def start_standin(cache_folder, options):
+    command = [sys.executable, os.path.join(TOOLS_PATH, "tmjlink_standin.py"),
+        "--latency", str(options.latency), "--jitter", str(options.jitter),
+        "--payload", str(options.payload), "--image-size", str(options.image_size),
+        "--fail-rate", str(options.fail_rate), "--drop-rate", str(options.drop_rate)]
+    if options.seed is not None:
+        command += ["--seed", str(options.seed)]
+    devnull = open(os.devnull, 'w')
+    proc = subprocess.Popen(command + [cache_folder], stdout=devnull, stderr=subprocess.STDOUT)
+    devnull.close()
+    get_tmjlink_port(cache_folder, 10)
+    return proc
+
+def start_broker(cache_folder):
+    devnull = open(os.devnull, 'w')
+    proc = subprocess.Popen([sys.executable, os.path.join(BIN_PATH, "mathmate_broker.py"), cache_folder],
+        stdout=devnull, stderr=subprocess.STDOUT)
+    devnull.close()
+    socket_path = os.path.join(cache_folder, "broker.sock")
+    deadline = time.time() + 10
+    while not os.path.exists(socket_path) and time.time() < deadline:
+        time.sleep(0.01)
+    return proc
+
+def connect(cache_folder, broker):
+    if broker:
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(os.path.join(cache_folder, "broker.sock"))
+        return BufferedSocket(sock)
+    sock = socket.socket()
+    sock.connect(("localhost", get_tmjlink_port(cache_folder)))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return BufferedSocket(sock)
+
+class Driver(object):
+    # One client session, run on its own thread
+    def __init__(self, number, options):
+        self.number = number
+        self.options = options
+        self.latencies = []
+        self.errors = 0
+        self.drops = 0
+        self.statement = options.statement
+        if len(self.statement) < options.statement_size:
+            self.statement += " (* %s *)" % ("x" * (options.statement_size - len(self.statement) - 6))
+
+    def open_session(self):
+        sessid = "load%d" % (self.number % self.options.sessids)
+        session = Session(connect(self.options.cache_folder, self.options.broker), sessid, self.options.timeout)
+        session.receive_all()
+        return session
+
+    def round_trip(self, session):
+        options = self.options
+        if options.batch > 1:
+            session.send_batch(options.command, [self.statement] * options.batch)
+        else:
+            session.send("%s %d" % (options.command, len(self.statement)), self.statement)
+        output = open(os.devnull, 'w')
+        try:
+            session.receive_all(output=output)
+        finally:
+            output.close()
+
+    def run(self):
+        session = None
+        for request in xrange(self.options.requests):
+            try:
+                if session is None:
+                    session = self.open_session()
+                mark = time.time()
+                self.round_trip(session)
+                self.latencies.append(time.time() - mark)
+            except ServerException:
+                self.latencies.append(time.time() - mark)
+                self.errors += 1
+            except (ServerTimeout, socket.error, Exception):
+                self.drops += 1
+                if session is not None:
+                    session.close()
+                session = None
+        if session is not None:
+            try:
+                session.quit(self.options.timeout)
+            except Exception:
+                session.close()
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("--sessions", type = "int", default = 8, help = "concurrent clients (default 8)")
+    parser.add_option("--sessids", type = "int", help = "distinct session IDs among them (default one each)")
+    parser.add_option("--requests", type = "int", default = 100, help = "round trips per client (default 100)")
+    parser.add_option("--command", default = "execute", choices = ["execute", "image", "intexec"],
+        help = "execute, image or intexec (default execute)")
+    parser.add_option("--batch", type = "int", default = 1, help = "statements per round trip (default 1)")
+    parser.add_option("--statement", default = "x = 1 + 1", help = "the statement sent")
+    parser.add_option("--statement-size", type = "int", default = 0, metavar = "BYTES",
+        help = "pad the statement with a comment to this size")
+    parser.add_option("--timeout", type = "float", default = 30, metavar = "SECONDS",
+        help = "give up on a reply after this long (default 30)")
+    parser.add_option("--cache-folder", help = "use the server running for this folder")
+    parser.add_option("--broker", action = "store_true", help = "connect through the broker")
+    parser.add_option("--json", metavar = "FILE", help = "write the report to FILE (- for stdout)")
+    group = optparse.OptionGroup(parser, "Stand-in server options")
+    group.add_option("--latency", type = "float", default = 0, metavar = "SECONDS")
+    group.add_option("--jitter", type = "float", default = 0, metavar = "SECONDS")
+    group.add_option("--payload", type = "int", default = 0, metavar = "BYTES")
+    group.add_option("--image-size", type = "int", default = 1024, metavar = "BYTES")
+    group.add_option("--fail-rate", type = "float", default = 0, metavar = "FRACTION")
+    group.add_option("--drop-rate", type = "float", default = 0, metavar = "FRACTION")
+    group.add_option("--seed", type = "int")
+    parser.add_option_group(group)
+    options, args = parser.parse_args()
+    if options.sessids is None:
+        options.sessids = options.sessions
+
+    processes = []
+    own_folder = options.cache_folder is None
+    if own_folder:
+        options.cache_folder = tempfile.mkdtemp(prefix="tmjlink-load-")
+        processes.append(start_standin(options.cache_folder, options))
+    try:
+        if options.broker and not os.path.exists(os.path.join(options.cache_folder, "broker.sock")):
+            processes.append(start_broker(options.cache_folder))
+
+        drivers = [Driver(number, options) for number in xrange(options.sessions)]
+        threads = [threading.Thread(target=driver.run) for driver in drivers]
+        mark = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - mark
+    finally:
+        for proc in processes:
+            proc.terminate()
+            proc.wait()
+        if own_folder:
+            shutil.rmtree(options.cache_folder, True)
+
+    latencies = sorted(latency for driver in drivers for latency in driver.latencies)
+    round_trips = len(latencies)
+    report = {
+        "sessions": options.sessions,
+        "sessids": options.sessids,
+        "command": options.command,
+        "batch": options.batch,
+        "broker": bool(options.broker),
+        "seconds": elapsed,
+        "round_trips": round_trips,
+        "statements": round_trips * options.batch,
+        "errors": sum(driver.errors for driver in drivers),
+        "drops": sum(driver.drops for driver in drivers),
+        "round_trips_per_second": round_trips / elapsed if elapsed > 0 else None,
+        "statements_per_second": round_trips * options.batch / elapsed if elapsed > 0 else None,
+        "latency_ms": dict((name, value * 1000 if value is not None else None) for name, value in (
+            ("min", latencies[0] if round_trips > 0 else None),
+            ("p50", percentile(latencies, 0.5)),
+            ("p90", percentile(latencies, 0.9)),
+            ("p99", percentile(latencies, 0.99)),
+            ("max", latencies[-1] if round_trips > 0 else None))),
+    }
+
+    log = sys.stderr if options.json == "-" else sys.stdout
+    log.write("%d sessions, %d round trips of %d %s in %.2fs: %.1f round trips/s, %.1f statements/s\n" % (
+        options.sessions, round_trips, options.batch, options.command, elapsed,
+        report["round_trips_per_second"] or 0, report["statements_per_second"] or 0))
+    log.write("Errors: %d, dropped connections: %d\n" % (report["errors"], report["drops"]))
+    if round_trips > 0:
+        log.write("Latency (ms): min %(min).2f, p50 %(p50).2f, p90 %(p90).2f, p99 %(p99).2f, max %(max).2f\n" % report["latency_ms"])
+
+    if options.json is not None:
+        data = json.dumps(report, indent = 2, sort_keys = True)
+        if options.json == "-":
+            sys.stdout.write(data + "\n")
+        else:
+            fp = open(options.json, 'w')
+            fp.write(data + "\n")
+            fp.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# Times MathMate.parse on documents made of a single long line of increasing
+# length: a dense data literal, and a column aligned one whose elements are
+# padded with runs of blanks. Parse time should grow linearly with the line
+# and the padding, so the throughput column should stay roughly flat.
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import mathmate
+
+def make_data_literal(count):
+    return "data = {" + ", ".join("{%d, %d.5, \"x%d\"}" % (i, i, i) for i in xrange(count)) + "};\n"
+
+def make_aligned_literal(count, width = 64):
+    return "data = {" + ",".join("%*d" % (width, i) for i in xrange(count)) + "};\n"
+
+def make_parser():
+    os.environ.setdefault('TM_TAB_SIZE', '2')
+    os.environ.setdefault('TM_SOFT_TABS', 'YES')
+    os.environ.setdefault('TM_LINE_NUMBER', '1')
+    os.environ.setdefault('TM_LINE_INDEX', '0')
+    os.environ.pop('TM_FILEPATH', None)
+
+    devnull = open(os.devnull, 'r')
+    stdin, sys.stdin = sys.stdin, devnull
+    try:
+        return mathmate.MathMate()
+    finally:
+        sys.stdin = stdin
+        devnull.close()
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000, 50000]
+    mm = make_parser()
+
+    print "%-8s %10s %12s %10s %14s" % ("literal", "elements", "line bytes", "seconds", "bytes/second")
+    for name, make_literal in (("dense", make_data_literal), ("aligned", make_aligned_literal)):
+        for size in sizes:
+            doc = make_literal(size)
+            mark = time.time()
+            mm.parse(doc)
+            elapsed = time.time() - mark
+            print "%-8s %10d %12d %10.3f %14d" % (name, size, len(doc), elapsed, len(doc) / elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# Measures what every bundle command pays before it does any work: importing
+# mathmate.py. Also times the eager Mathematica discovery the module used to do
+# at import, and the lazy discovery with a cold and a warm path cache.
+import os
+import sys
+import time
+import subprocess
+
+BIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin")
+sys.path.insert(0, BIN_PATH)
+import mathmate
+
+def timeit(fn, runs):
+    times = []
+    for i in range(runs):
+        mark = time.time()
+        fn()
+        times.append((time.time() - mark) * 1000)
+    times.sort()
+    return times[len(times) // 2]
+
+def import_mathmate():
+    subprocess.check_call([sys.executable, "-c", "import sys; sys.path.insert(0, %r); import mathmate" % BIN_PATH])
+
+def start_interpreter():
+    subprocess.check_call([sys.executable, "-c", "pass"])
+
+def eager_discovery():
+    for name in ("JLink.jar", "MathKernel"):
+        subprocess.check_output(['find', mathmate.MATHEMATICA_PATH, '-name', name])
+
+def cold_discovery():
+    cachefile = os.path.join(mathmate.MATHMATE_CACHE_FOLDER, "paths.json")
+    if os.path.exists(cachefile):
+        os.remove(cachefile)
+    mathmate.find_mathematica_files()
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    baseline = timeit(start_interpreter, runs)
+    print "Interpreter startup:           %8.1f ms" % baseline
+    imported = timeit(import_mathmate, runs)
+    print "Import mathmate.py:            %8.1f ms (+%.1f ms)" % (imported, imported - baseline)
+
+    if not os.path.exists(mathmate.MATHEMATICA_PATH):
+        print "Mathematica not found at %s; skipping discovery timings." % mathmate.MATHEMATICA_PATH
+        return
+
+    eager = timeit(eager_discovery, runs)
+    print "Eager discovery (old import):  %8.1f ms" % eager
+    print "Lazy discovery, cold cache:    %8.1f ms" % timeit(cold_discovery, runs)
+    print "Lazy discovery, warm cache:    %8.1f ms" % timeit(mathmate.find_mathematica_files, runs)
+
+if __name__ == '__main__':
+    main()
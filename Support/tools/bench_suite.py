@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# Benchmarks the work every bundle command does on the document: parsing,
+# reformatting, Show Statement, position lookups and the completion prefix.
+# Each runs over synthetic documents (one long line, deep nesting, many small
+# statements, a 50k line file) and over recorded ones: mathtest.m, scaled up
+# to 50k lines, and any .m files given with --corpus.
+#
+#   python bench_suite.py --json report.json
+#   python bench_suite.py --baseline report.json
+#
+# The report gives, per document and operation, the median and fastest of
+# --runs runs, the throughput, the peak memory growth of one run in a process
+# of its own and the container objects one run leaves behind. With
+# --baseline, timings slower than the baseline's by more than --tolerance are
+# reported and the exit status is 1.
+import os
+import sys
+import gc
+import json
+import time
+import random
+import platform
+import resource
+import optparse
+import subprocess
+
+TOOLS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_PATH, "..", "bin"))
+import mathmate
+from mathmate_shim import get_completion_prefix
+
+from bench_parse import make_data_literal, make_aligned_literal
+
+# Position lookups per run
+LOOKUPS = 100000
+
+DEFINITIONS = [
+    'f%(n)d[x_, y_:1] := Module[{t = x^2, s}, s = Sin[t] + y; If[s > 0, s, -s]]\n',
+    'data%(n)d = Table[{i, N[Sqrt[i]], "row %(n)d"}, {i, 1, 20}];\n',
+    '(* Statement %(n)d: a comment with [brackets] and "quotes" *)\n',
+    'g%(n)d = Plot[Sin[x] E^(-x/%(n)d), {x, 0, 10}, Filling -> Axis]\n',
+    'h%(n)d[list_List] :=\n  Map[\n    Function[{e},\n      e + %(n)d\n    ],\n    list\n  ]\n',
+    'Which[x < %(n)d, "small", x == %(n)d, "equal", True, "large"] // Print\n',
+    '\n',
+]
+
+def make_long_line(count = 20000):
+    return make_data_literal(count)
+
+def make_aligned_line(count = 5000):
+    return make_aligned_literal(count)
+
+def make_deep_nesting(depth = 400, count = 20):
+    statement = "".join("f%d[{" % (level % 7) for level in xrange(depth)) + "x" + "}]" * depth + "\n"
+    return statement * count
+
+def make_small_statements(count = 50000):
+    return "".join("x%d = %d;\n" % (i, i) for i in xrange(count))
+
+def make_large_file(lines = 50000):
+    chunks = []
+    total = 0
+    n = 0
+    while total < lines:
+        chunk = DEFINITIONS[n % len(DEFINITIONS)] % {"n": n}
+        chunks.append(chunk)
+        total += chunk.count("\n")
+        n += 1
+    return "".join(chunks)
+
+def scale_to_lines(doc, lines = 50000):
+    count = max(1, lines // max(doc.count("\n"), 1))
+    return doc.rstrip("\n") + "\n\n" + (doc.rstrip("\n") + "\n\n") * (count - 1)
+
+def read_file(path):
+    fp = open(path, 'r')
+    try:
+        return fp.read()
+    finally:
+        fp.close()
+
+def get_corpora(paths, quick):
+    # (name, function making the document), so that only the documents being
+    # measured are ever in memory
+    scale = 10 if quick else 1
+    recorded = os.path.join(TOOLS_PATH, "mathtest.m")
+    corpora = [
+        ("long line", lambda: make_long_line(20000 // scale)),
+        ("aligned line", lambda: make_aligned_line(5000 // scale)),
+        ("deep nesting", lambda: make_deep_nesting(400, 20 // scale)),
+        ("small statements", lambda: make_small_statements(50000 // scale)),
+        ("50k lines", lambda: make_large_file(50000 // scale)),
+        ("mathtest.m", lambda: read_file(recorded)),
+        ("mathtest.m x50k lines", lambda: scale_to_lines(read_file(recorded), 50000 // scale)),
+    ]
+    for path in paths:
+        corpora.append((os.path.basename(path), lambda path = path: read_file(path)))
+    return corpora
+
+def set_cursor(doc, pos):
+    line = doc.count("\n", 0, pos) + 1
+    os.environ['TM_LINE_NUMBER'] = str(line)
+    os.environ['TM_LINE_INDEX'] = str(pos - (doc.rfind("\n", 0, pos) + 1))
+
+def make_mathmate(doc, pos = 0, reformat_all = False):
+    set_cursor(doc, pos)
+    return mathmate.MathMate(doc = doc, reformat_all = reformat_all)
+
+class Operation(object):
+    # setup returns the state for run, which returns the number of calls made
+    name = None
+
+    def setup(self, doc):
+        return doc
+
+    def run(self, state):
+        return 1
+
+class Parse(Operation):
+    name = "parse"
+
+    def setup(self, doc):
+        return make_mathmate(""), doc
+
+    def run(self, state):
+        mm, doc = state
+        mm.parse(doc)
+        return 1
+
+class Reformat(Operation):
+    # Parse the document and replace it with its reformatted statements, as
+    # Reformat Document does
+    name = "reformat"
+
+    def run(self, doc):
+        mm = make_mathmate(doc, reformat_all = True)
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            mm.reformat(process_entire_document = True)
+        except SystemExit:
+            pass
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        return 1
+
+class Show(Operation):
+    # Show Statement with the cursor halfway through the document
+    name = "show"
+
+    def run(self, doc):
+        mm = make_mathmate(doc, len(doc) // 2)
+        mm.show()
+        return 1
+
+class LookupOperation(Operation):
+    def setup(self, doc):
+        mm = make_mathmate(doc)
+        rng = random.Random(len(doc))
+        return mm, self.make_arguments(mm, doc, rng)
+
+    def make_arguments(self, mm, doc, rng):
+        return []
+
+class GetPos(LookupOperation):
+    name = "get_pos"
+
+    def make_arguments(self, mm, doc, rng):
+        lines = doc.count("\n") + 1
+        return [(rng.randint(1, lines), rng.randint(0, 80)) for i in xrange(LOOKUPS)]
+
+    def run(self, state):
+        mm, arguments = state
+        # The line table is built once per command, so count it in
+        mm.line_starts = None
+        get_pos = mm.get_pos
+        for line, column in arguments:
+            get_pos(line, column)
+        return len(arguments)
+
+class GetLineCol(LookupOperation):
+    name = "get_line_col"
+
+    def make_arguments(self, mm, doc, rng):
+        return [rng.randint(0, len(doc)) for i in xrange(LOOKUPS)]
+
+    def run(self, state):
+        mm, arguments = state
+        mm.line_starts = None
+        get_line_col = mm.get_line_col
+        for pos in arguments:
+            get_line_col(pos)
+        return len(arguments)
+
+class CompletionPrefix(LookupOperation):
+    name = "prefix"
+
+    def make_arguments(self, mm, doc, rng):
+        return [rng.randint(0, len(doc)) for i in xrange(LOOKUPS)]
+
+    def run(self, state):
+        mm, arguments = state
+        doc = mm.doc
+        for pos in arguments:
+            get_completion_prefix(doc, pos)
+        return len(arguments)
+
+OPERATIONS = [Parse(), Reformat(), Show(), GetPos(), GetLineCol(), CompletionPrefix()]
+
+def read_memory_status():
+    # Resident and peak resident kilobytes, where Linux reports them
+    status = {}
+    try:
+        fp = open("/proc/self/status", 'r')
+        for line in fp:
+            field, colon, value = line.partition(":")
+            if field in ("VmRSS", "VmHWM"):
+                status[field] = int(value.split()[0])
+        fp.close()
+    except IOError:
+        pass
+    return status
+
+def reset_peak_rss():
+    # Linux can restart the peak from the current resident size
+    try:
+        fp = open("/proc/self/clear_refs", 'w')
+        fp.write("5")
+        fp.close()
+    except IOError:
+        return False
+    return "VmHWM" in read_memory_status()
+
+def get_peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on Mac OS X, kilobytes elsewhere
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+def measure_memory(operation, index, options):
+    # One run in a new process, so that the peak is the run's alone
+    command = [sys.executable, os.path.abspath(__file__), "--memory", "%d:%s" % (index, operation.name)]
+    for path in options.corpus:
+        command += ["--corpus", path]
+    if options.quick:
+        command.append("--quick")
+    proc = subprocess.Popen(command, stdout = subprocess.PIPE)
+    output = proc.communicate()[0]
+    try:
+        return json.loads(output)
+    except ValueError:
+        return {}
+
+def run_memory(spec, options):
+    index, operation_name = spec.split(":", 1)
+    name, make_doc = get_corpora(options.corpus, options.quick)[int(index)]
+    doc = make_doc()
+    operation = [operation for operation in OPERATIONS if operation.name == operation_name][0]
+    state = operation.setup(doc)
+
+    gc.collect()
+    gc.disable()
+    before = len(gc.get_objects())
+    if reset_peak_rss():
+        rss = read_memory_status()["VmRSS"]
+        operation.run(state)
+        peak = read_memory_status()["VmHWM"] - rss
+    else:
+        # Only growth past the peak setting up reached shows
+        rss = get_peak_rss_kb()
+        operation.run(state)
+        peak = get_peak_rss_kb() - rss
+    print json.dumps({"peak_rss_kb": max(peak, 0), "retained_objects": len(gc.get_objects()) - before})
+
+def measure(operation, index, name, doc, options):
+    runs = options.runs
+    state = operation.setup(doc)
+    times = []
+    for i in xrange(runs):
+        mark = time.time()
+        calls = operation.run(state)
+        times.append(time.time() - mark)
+    times.sort()
+    seconds = times[len(times) // 2]
+
+    result = {
+        "corpus": name,
+        "operation": operation.name,
+        "bytes": len(doc),
+        "lines": doc.count("\n") + 1,
+        "runs": runs,
+        "seconds": seconds,
+        "min_seconds": times[0],
+        "calls": calls,
+        "bytes_per_second": len(doc) / seconds if seconds > 0 else None,
+        "calls_per_second": calls / seconds if seconds > 0 else None,
+    }
+    result.update(measure_memory(operation, index, options))
+    return result
+
+def compare(results, baseline, tolerance):
+    # Timings more than tolerance slower than the baseline's. The fastest run
+    # is compared, being the least disturbed by whatever else the machine does.
+    previous = dict(((result["corpus"], result["operation"]), result) for result in baseline["results"])
+    regressions = []
+    for result in results:
+        old = previous.get((result["corpus"], result["operation"]))
+        if old is None or old["min_seconds"] <= 0:
+            continue
+        ratio = result["min_seconds"] / old["min_seconds"]
+        result["baseline_seconds"] = old["min_seconds"]
+        result["ratio"] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(result)
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("--corpus", action = "append", default = [], metavar = "FILE",
+        help = "also benchmark FILE (may be repeated)")
+    parser.add_option("--operation", action = "append", default = [], metavar = "NAME",
+        help = "only run NAME: %s" % ", ".join(operation.name for operation in OPERATIONS))
+    parser.add_option("--runs", type = "int", default = 3, help = "runs per measurement (default 3)")
+    parser.add_option("--quick", action = "store_true", help = "documents a tenth of the size")
+    parser.add_option("--json", metavar = "FILE", help = "write the report to FILE (- for stdout)")
+    parser.add_option("--baseline", metavar = "FILE", help = "compare with an earlier report")
+    parser.add_option("--tolerance", type = "float", default = 0.25,
+        help = "slowdown allowed against the baseline (default 0.25)")
+    parser.add_option("--memory", help = optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    os.environ['TM_TAB_SIZE'] = '2'
+    os.environ['TM_SOFT_TABS'] = 'YES'
+    os.environ.pop('TM_FILEPATH', None)
+    os.environ.pop('TM_SELECTED_TEXT', None)
+
+    if options.memory is not None:
+        run_memory(options.memory, options)
+        return
+
+    operations = [operation for operation in OPERATIONS if len(options.operation) == 0 or operation.name in options.operation]
+    log = sys.stderr if options.json == "-" else sys.stdout
+
+    results = []
+    log.write("%-22s %-13s %10s %10s %14s %14s %10s\n" % ("corpus", "operation", "bytes", "seconds", "bytes/second", "calls/second", "peak KB"))
+    for index, (name, make_doc) in enumerate(get_corpora(options.corpus, options.quick)):
+        doc = make_doc()
+        for operation in operations:
+            result = measure(operation, index, name, doc, options)
+            results.append(result)
+            log.write("%-22s %-13s %10d %10.4f %14d %14d %10s\n" % (name, operation.name, result["bytes"], result["seconds"],
+                result["bytes_per_second"] or 0, result["calls_per_second"] or 0, result.get("peak_rss_kb", "-")))
+            log.flush()
+
+    regressions = []
+    if options.baseline is not None:
+        regressions = compare(results, json.loads(read_file(options.baseline)), options.tolerance)
+        for result in regressions:
+            log.write("Slower: %s / %s %.4fs -> %.4fs (x%.2f)\n" % (result["corpus"], result["operation"],
+                result["baseline_seconds"], result["min_seconds"], result["ratio"]))
+        if len(regressions) == 0:
+            log.write("No operation is more than %d%% slower than the baseline.\n" % (options.tolerance * 100))
+
+    if options.json is not None:
+        report = json.dumps({
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": bool(options.quick),
+            "results": results,
+        }, indent = 2, sort_keys = True)
+        if options.json == "-":
+            sys.stdout.write(report + "\n")
+        else:
+            fp = open(options.json, 'w')
+            fp.write(report + "\n")
+            fp.close()
+
+    sys.exit(1 if len(regressions) > 0 else 0)
+
+if __name__ == '__main__':
+    main()
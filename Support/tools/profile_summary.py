@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Merges the profiles MATHMATE_PROFILE=YES leaves in /tmp/tmjlink/profiles
+# into one table of the hottest functions, by time spent in the function
+# itself (--sort tottime, the default) or including what it calls (--sort
+# cumtime).
+#
+#   python profile_summary.py --command reformat --document big.m --top 30
+#   python profile_summary.py --json - path/to/one.prof path/to/other.prof
+import os
+import sys
+import glob
+import json
+import pstats
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate_profile import PROFILE_FOLDER
+
+def find_profiles(folder, commands, documents):
+    # Profiles are named <command>--<document>--<time>-<pid>.prof
+    paths = []
+    for path in sorted(glob.glob(os.path.join(folder, "*.prof"))):
+        parts = os.path.basename(path)[:-len(".prof")].split("--")
+        if len(parts) != 3:
+            continue
+        command, document, stamp = parts
+        if len(commands) > 0 and command not in commands:
+            continue
+        if len(documents) > 0 and document not in documents:
+            continue
+        paths.append(path)
+    return paths
+
+def get_hot_functions(stats, sort, top):
+    rows = []
+    for (filename, line, name), (calls, total_calls, tottime, cumtime, callers) in stats.stats.items():
+        rows.append({
+            "function": name,
+            "file": filename,
+            "line": line,
+            "calls": total_calls,
+            "primitive_calls": calls,
+            "tottime": tottime,
+            "cumtime": cumtime,
+        })
+    rows.sort(key=lambda row: -row[sort])
+    return rows[:top]
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options] [profile ...]")
+    parser.add_option("--folder", default = PROFILE_FOLDER, help = "where to look for profiles (default %default)")
+    parser.add_option("--command", action = "append", default = [], help = "only this command (may be repeated)")
+    parser.add_option("--document", action = "append", default = [], help = "only this document (may be repeated)")
+    parser.add_option("--sort", default = "tottime", choices = ["tottime", "cumtime", "calls"],
+        help = "tottime, cumtime or calls (default tottime)")
+    parser.add_option("--top", type = "int", default = 25, help = "rows to show (default 25)")
+    parser.add_option("--json", metavar = "FILE", help = "write the table to FILE (- for stdout)")
+    options, args = parser.parse_args()
+
+    paths = args or find_profiles(options.folder, options.command, options.document)
+    if len(paths) == 0:
+        sys.stderr.write("No profiles found in %s. Run commands with MATHMATE_PROFILE=YES first.\n" % options.folder)
+        sys.exit(1)
+
+    stats = pstats.Stats(paths[0])
+    for path in paths[1:]:
+        stats.add(path)
+    rows = get_hot_functions(stats, options.sort, options.top)
+
+    if options.json is not None:
+        data = json.dumps({"profiles": paths, "total_seconds": stats.total_tt, "functions": rows}, indent = 2, sort_keys = True)
+        if options.json == "-":
+            sys.stdout.write(data + "\n")
+            return
+        fp = open(options.json, 'w')
+        fp.write(data + "\n")
+        fp.close()
+
+    print "%d profiles, %.3fs in total" % (len(paths), stats.total_tt)
+    print "%10s %10s %10s %6s  %s" % ("calls", "tottime", "cumtime", "share", "function")
+    for row in rows:
+        share = 100 * row["tottime"] / stats.total_tt if stats.total_tt > 0 else 0
+        print "%10d %10.4f %10.4f %5.1f%%  %s (%s:%d)" % (row["calls"], row["tottime"], row["cumtime"], share,
+            row["function"], os.path.basename(row["file"]), row["line"])
+
+if __name__ == '__main__':
+    main()
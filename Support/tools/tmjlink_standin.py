@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# Stand-in for the TextMateJLink server, for working on the bundle without
+# Mathematica. It speaks the same protocol as Session.java and writes the same
+# tmjlink.pid and tmjlink.port files, so the bundle commands, the shim and the
+# broker use it as if the real server were running:
+#
+#   python tmjlink_standin.py [options] /tmp/tmjlink
+#
+# Statements are not evaluated. Each one is echoed back as its own output, and
+# "name = ..." or "name[...] := ..." defines name so that completion and Show
+# Symbol Value have something to find. A statement containing Abort[] fails,
+# and one containing Pause[seconds] takes that long. The definitions parallel
+# runs export from one session and install in another are carried over too.
+#
+# For load and latency testing, every evaluation can be made slower
+# (--latency, --jitter), its output larger (--payload, and --image-size for
+# the files image writes), and a fraction of them can fail (--fail-rate) or
+# drop the connection without answering (--drop-rate).
+#
+# With --legacy it behaves like the tmjlink.jar that ships: the port is only
+# announced in the log, there are no batches, generations or lookups, and a reset
+# leaves every open connection of the session on the closed kernel.
+import os
+import re
+import sys
+import cgi
+import base64
+import time
+import uuid
+import random
+import socket
+import optparse
+import threading
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate_client import BufferedSocket
+
+DEFINITION = re.compile(r"^\s*([A-Za-z$][A-Za-z0-9$]*)\s*(\[[^\]]*\])?\s*:?=\s*(.*)$", re.S)
+PAUSE = re.compile(r"Pause\[\s*([0-9.]+)\s*\]")
+EXPORT = re.compile(r'Compress\[ToExpression\["([^"]*)", InputForm, Language`ExtendedDefinition\]\]')
+INSTALL = 'Scan[(Language`ExtendedFullDefinition[] = Uncompress[#]) &, {'
+CLEAR = 'ClearAll["Global`*"]'
+QUOTED = re.compile(r'"([^"]*)"')
+
+class InjectedDrop(Exception):
+    pass
+
+class Resources(object):
+    # Generations never repeat, as in Resources.java
+    generation_lock = threading.Lock()
+    generation_epoch = int(time.time() * 1000)
+    last_generation = 0
+
+    def __init__(self, sessid, options):
+        self.sessid = sessid
+        self.options = options
+        self.definitions = {}
+        self.cells = 0
+        self.closed = False
+        self.random = random.Random(options.seed)
+        self.next_generation()
+
+    def next_generation(self):
+        with Resources.generation_lock:
+            Resources.last_generation += 1
+            self.generation = "%d.%d" % (Resources.generation_epoch, Resources.last_generation)
+
+    def evaluate(self, statement):
+        options = self.options
+        delay = options.latency + self.random.uniform(0, options.jitter)
+        delay += sum(float(seconds) for seconds in PAUSE.findall(statement))
+        if delay > 0:
+            time.sleep(delay)
+
+        if options.drop_rate > 0 and self.random.random() < options.drop_rate:
+            raise InjectedDrop()
+        if options.fail_rate > 0 and self.random.random() < options.fail_rate:
+            raise Exception("Injected failure")
+        if "Abort[]" in statement:
+            raise Exception("$Aborted")
+
+        match = DEFINITION.match(statement)
+        if match is not None:
+            self.definitions[match.group(1)] = match.group(3).strip()
+        if len(statement) < options.payload:
+            return statement + " " + "x" * (options.payload - len(statement) - 1)
+        return statement
+
+    def exchange(self, code):
+        # The definitions mathmate_parallel.py moves between sessions, as
+        # "name=value" in base64 where the kernel would compress them.
+        # Returns the reply's payload, or None for anything else.
+        names = EXPORT.findall(code)
+        if len(names) > 0:
+            return "{%s}" % ", ".join('"1:%s"' % base64.b64encode("%s=%s" % (name, self.definitions[name]))
+                for name in names if name in self.definitions)
+        if code.startswith(INSTALL):
+            for data in QUOTED.findall(code):
+                name, equals, value = base64.b64decode(data[2:]).partition("=")
+                self.definitions[name] = value
+            return ""
+        if code == CLEAR:
+            self.definitions.clear()
+            return ""
+        return None
+
+    def render_cell(self, statement, result):
+        self.cells += 1
+        return "<div id='resource_%d' class='cellgroup'><div class='input'>%s</div><div class='output'>%s</div></div>" % (
+            self.cells, cgi.escape(statement), cgi.escape(result))
+
+    def render_image_cell(self, statement, cache_folder):
+        # Like a DISPLAYPKT resource: a file in the session's folder
+        self.cells += 1
+        folder = os.path.join(cache_folder, self.sessid)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, "%s.gif" % uuid.uuid4())
+        fp = open(path, 'wb')
+        fp.write("GIF89a" + "\0" * max(self.options.image_size - 6, 0))
+        fp.close()
+        return "<div id='resource_%d' class='cellgroup'><div class='input'>%s</div><div class='output'><img src='file://%s' onclick='toggle(%d)' /></div></div>" % (
+            self.cells, cgi.escape(statement), path, self.cells)
+
+    def get_suggestions(self):
+        return "[" + "".join('"%s",' % name for name in sorted(self.definitions)) + "]"
+
+class StandinServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, cache_folder, options):
+        SocketServer.TCPServer.__init__(self, ("localhost", 0), SessionHandler)
+        self.cache_folder = cache_folder
+        self.options = options
+        self.resources_lock = threading.Lock()
+        self.resources = {}
+
+    def get_resources(self, sessid, reset = False):
+        with self.resources_lock:
+            if reset or sessid not in self.resources:
+                if sessid in self.resources:
+                    self.resources[sessid].closed = True
+                self.resources[sessid] = Resources(sessid, self.options)
+            return self.resources[sessid]
+
+class SessionHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        self.sock = BufferedSocket(self.request)
+        self.batch_remaining = 0
+        self.batch_failed = False
+        resources = None
+
+        try:
+            self.send("okay")
+            while True:
+                line = self.sock.readline()
+                if line is None:
+                    break
+
+                command, space, args = line.partition(" ")
+
+                if command == "quit":
+                    self.send("okay -- Good Bye")
+                    break
+
+                if resources is None:
+                    if command == "sessid":
+                        resources = self.server.get_resources(args)
+                        self.send("okay -- Session ID set to: %s" % args)
+                    else:
+                        self.send("exception -- Invalid command (0): %s" % command)
+                    continue
+
+                # Another connection may have reset the session. The shipped
+                # jar keeps the kernel it looked up first, even once closed.
+                if not self.server.options.legacy:
+                    resources = self.server.get_resources(resources.sessid)
+                self.handle_command(resources, command, args)
+        except (socket.error, InjectedDrop):
+            pass
+        self.sock.close()
+
+    def handle_command(self, resources, command, args):
+        if resources.closed and command not in ("reset", "header"):
+            if command in ("execute", "image", "intexec", "lookup"):
+                self.sock.readtotal(int(args))
+            self.send("exception -- MathLink connection was closed")
+            return
+        if command in ("execute", "image"):
+            self.evaluate_statement(resources, self.sock.readtotal(int(args)), command == "image")
+        elif command == "intexec" or (command == "lookup" and not self.server.options.legacy):
+            try:
+                code = self.sock.readtotal(int(args))
+                # Lookups only read definitions, and keep the generation
+                if command == "intexec":
+                    resources.next_generation()
+                exchanged = resources.exchange(code)
+                if exchanged is not None:
+                    if exchanged != "":
+                        self.send_inline(exchanged)
+                    self.send("okay")
+                    return
+                result = resources.evaluate(code)
+                if result in resources.definitions:
+                    self.send_inline(resources.definitions[result])
+                self.send("okay")
+            except InjectedDrop:
+                raise
+            except Exception, e:
+                self.send("exception -- %s" % e)
+        elif command == "batch" and not self.server.options.legacy:
+            self.batch_remaining = int(args)
+            self.batch_failed = False
+            if self.batch_remaining == 0:
+                self.send("okay -- Batch complete")
+        elif command == "header":
+            self.send_inline("<div class='header'>Session ID: %s</div>" % cgi.escape(resources.sessid))
+            self.send("okay")
+        elif command == "clear":
+            self.send("okay -- Resources released: %d" % resources.cells)
+            resources.cells = 0
+        elif command == "reset":
+            self.server.get_resources(resources.sessid, reset=True)
+            self.send("okay -- All resources reset")
+        elif command == "suggest":
+            if args == "" or self.server.options.legacy:
+                self.send("suggestions %s" % resources.get_suggestions())
+            elif args == resources.generation:
+                self.send("okay -- Unchanged generation: %s" % resources.generation)
+            else:
+                self.send("suggestions %s %s" % (resources.generation, resources.get_suggestions()))
+        else:
+            self.send("exception -- Invalid command (1): %s" % command)
+
+    def evaluate_statement(self, resources, statement, image = False):
+        if self.batch_failed:
+            self.send("exception -- Skipped after an earlier exception in this batch")
+        else:
+            try:
+                resources.next_generation()
+                result = resources.evaluate(statement)
+                if image:
+                    self.send_inline(resources.render_image_cell(statement, self.server.cache_folder))
+                else:
+                    self.send_inline(resources.render_cell(statement, result))
+                self.send("okay")
+            except InjectedDrop:
+                raise
+            except Exception, e:
+                self.send("exception -- %s" % e)
+                self.batch_failed = self.batch_remaining > 0
+
+        if self.batch_remaining > 0:
+            self.batch_remaining -= 1
+            if self.batch_remaining == 0:
+                self.batch_failed = False
+                self.send("okay -- Batch complete")
+
+    def send(self, reply):
+        self.sock.send(reply + "\n")
+
+    def send_inline(self, data):
+        # Like Session.sendInline, the payload ends with the newline println adds
+        self.sock.send("inline %d\n%s\n" % (len(data) + 1, data))
+
+def write_file(path, data):
+    tmpfile = "%s.tmp" % path
+    fp = open(tmpfile, 'w')
+    fp.write(data)
+    fp.close()
+    os.rename(tmpfile, path)
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options] <cache folder>")
+    parser.add_option("--latency", type = "float", default = 0, metavar = "SECONDS",
+        help = "added to every evaluation")
+    parser.add_option("--jitter", type = "float", default = 0, metavar = "SECONDS",
+        help = "up to this much more, at random")
+    parser.add_option("--payload", type = "int", default = 0, metavar = "BYTES",
+        help = "pad every result to at least this size")
+    parser.add_option("--image-size", type = "int", default = 1024, metavar = "BYTES",
+        help = "size of the files image writes (default 1024)")
+    parser.add_option("--fail-rate", type = "float", default = 0, metavar = "FRACTION",
+        help = "evaluations answered with an exception")
+    parser.add_option("--drop-rate", type = "float", default = 0, metavar = "FRACTION",
+        help = "evaluations that close the connection instead of answering")
+    parser.add_option("--seed", type = "int", help = "seed for the jitter and the failures")
+    parser.add_option("--legacy", action = "store_true", help = "speak the protocol of the shipped tmjlink.jar")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("expected the cache folder")
+
+    cache_folder = args[0]
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder)
+
+    server = StandinServer(cache_folder, options)
+    port = server.server_address[1]
+    print "Server started on port: %d" % port
+    sys.stdout.flush()
+
+    write_file(os.path.join(cache_folder, "tmjlink.pid"), str(os.getpid()))
+    if not options.legacy:
+        write_file(os.path.join(cache_folder, "tmjlink.port"), "%d\n" % port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
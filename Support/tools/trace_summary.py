@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# Summarizes the records commands append to the trace file with
+# MATHMATE_TRACE=YES: for each command, the percentiles of its total time, of
+# each of its phases and of each kind of round trip to the server, with the
+# bytes those moved.
+#
+#   python trace_summary.py [--command inline] [--last 100] [--json -] [trace file]
+import os
+import sys
+import json
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from mathmate_trace import TRACE_FILE
+
+PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))
+
+def read_records(path):
+    records = []
+    fp = open(path, 'r')
+    for line in fp:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            # A record cut short by a full disk or a kill
+            continue
+    fp.close()
+    return records
+
+def summarize_values(values):
+    values = sorted(values)
+    summary = {"count": len(values), "max": values[-1], "mean": sum(values) / len(values)}
+    for name, fraction in PERCENTILES:
+        summary[name] = values[min(int(len(values) * fraction), len(values) - 1)]
+    return summary
+
+def summarize(records):
+    # command -> {"seconds", "phases": {name: summary}, "round_trips": {name: summary}}
+    grouped = {}
+    for record in records:
+        grouped.setdefault(record["command"], []).append(record)
+
+    result = {}
+    for command, records in grouped.items():
+        phases = {}
+        round_trips = {}
+        sent = {}
+        received = {}
+        for record in records:
+            # A phase may run more than once per command; add those up
+            totals = {}
+            for phase in record["phases"]:
+                totals[phase["name"]] = totals.get(phase["name"], 0) + phase["seconds"]
+            for name, seconds in totals.items():
+                phases.setdefault(name, []).append(seconds)
+            for trip in record["round_trips"]:
+                round_trips.setdefault(trip["command"], []).append(trip["seconds"])
+                sent.setdefault(trip["command"], []).append(trip["sent"])
+                received.setdefault(trip["command"], []).append(trip["received"])
+
+        trips = {}
+        for name, values in round_trips.items():
+            trips[name] = summarize_values(values)
+            trips[name]["sent"] = summarize_values(sent[name])
+            trips[name]["received"] = summarize_values(received[name])
+        result[command] = {
+            "seconds": summarize_values([record["seconds"] for record in records]),
+            "bytes_sent": summarize_values([record["bytes_sent"] for record in records]),
+            "bytes_received": summarize_values([record["bytes_received"] for record in records]),
+            "phases": dict((name, summarize_values(values)) for name, values in phases.items()),
+            "round_trips": trips,
+        }
+    return result
+
+def format_times(summary):
+    return "%6d %9.1f %9.1f %9.1f %9.1f" % (summary["count"], summary["p50"] * 1000,
+        summary["p90"] * 1000, summary["p99"] * 1000, summary["max"] * 1000)
+
+def print_summary(result, out):
+    for command in sorted(result, key=lambda command: -result[command]["seconds"]["count"]):
+        summary = result[command]
+        out.write("%s\n" % command)
+        out.write("  %-28s %6s %9s %9s %9s %9s\n" % ("(ms)", "count", "p50", "p90", "p99", "max"))
+        out.write("  %-28s %s\n" % ("total", format_times(summary["seconds"])))
+        for name, phase in sorted(summary["phases"].items(), key=lambda item: -item[1]["p50"]):
+            out.write("  %-28s %s\n" % ("phase " + name, format_times(phase)))
+        for name, trip in sorted(summary["round_trips"].items(), key=lambda item: -item[1]["p50"]):
+            out.write("  %-28s %s  sent %d B, received %d B (p50)\n" % ("round trip " + name, format_times(trip),
+                trip["sent"]["p50"], trip["received"]["p50"]))
+        out.write("  bytes per command (p50): sent %d, received %d\n\n" % (
+            summary["bytes_sent"]["p50"], summary["bytes_received"]["p50"]))
+
+def main():
+    parser = optparse.OptionParser(usage = "%prog [options] [trace file]")
+    parser.add_option("--command", action = "append", default = [], help = "only this command (may be repeated)")
+    parser.add_option("--last", type = "int", help = "only the last N records")
+    parser.add_option("--json", metavar = "FILE", help = "write the summary to FILE (- for stdout)")
+    options, args = parser.parse_args()
+    path = args[0] if len(args) > 0 else TRACE_FILE
+
+    try:
+        records = read_records(path)
+    except IOError:
+        sys.stderr.write("No trace at %s. Run commands with MATHMATE_TRACE=YES first.\n" % path)
+        sys.exit(1)
+    if len(options.command) > 0:
+        records = [record for record in records if record["command"] in options.command]
+    if options.last is not None:
+        records = records[-options.last:]
+
+    result = summarize(records)
+    if options.json == "-":
+        sys.stdout.write(json.dumps(result, indent = 2, sort_keys = True) + "\n")
+        return
+    if options.json is not None:
+        fp = open(options.json, 'w')
+        fp.write(json.dumps(result, indent = 2, sort_keys = True) + "\n")
+        fp.close()
+    print_summary(result, sys.stdout)
+
+if __name__ == '__main__':
+    main()